@@ -1,9 +1,13 @@
 from typing import Any
 import math
 import numpy as np
+from scipy.signal import savgol_filter, savgol_coeffs, oaconvolve
+from scipy.ndimage import gaussian_filter1d
 
 from pyramid.trials.trials import Trial, TrialEnhancer
 
+from saccade_detection import SaccadeParser
+
 # We can define utility functions for the TrialEnhancer to use.
 def ang_deg(x: float, y: float) -> float:
     """Compute an angle in degrees, in [0, 360)."""
@@ -21,6 +25,16 @@ def log10(x: float) -> float:
     else:
         return math.log10(x)
 
+def savgol_gaussian_kernel(window_size: int, poly_order: int, gaussian_std: float) -> np.ndarray:
+    """Combine a Savitzky-Golay filter and a Gaussian filter (std 0 for none) into one convolution kernel, built the same way scipy builds each."""
+    kernel = savgol_coeffs(window_size, poly_order)
+    if gaussian_std > 0:
+        radius = int(4.0 * gaussian_std + 0.5)
+        offsets = np.arange(-radius, radius + 1)
+        gaussian = np.exp(-0.5 / gaussian_std**2 * offsets**2)
+        kernel = np.convolve(kernel, gaussian / gaussian.sum())
+    return kernel
+
 # This is a rough version of the trial compute code from spmADPODR.m.
 # It's incomplete and wrong!
 # I'm hoping it shows the Pyramid version of how to get and set the same per-trial data as in FIRA.
@@ -146,27 +160,30 @@ class CustomEnhancer(TrialEnhancer):
         # Use trial.get_enhancement() to get saccade info already parsed by SaccadesEnhancer.
         broken_fixation = trial.get_time("fp_off") is None
         saccades = trial.get_enhancement("saccades")
+        if saccades is None:
+            saccades = []
+        if isinstance(saccades, dict):
+            # Compact saccades from SaccadesEnhancer are already columns, one list per saccade_detection.SACCADE_DTYPE field.
+            (sac_t_start, sac_x_end, sac_y_end) = (np.asarray(saccades[name], dtype=np.float64) for name in ["t_start", "x_end", "y_end"])
+        else:
+            (sac_t_start, sac_x_end, sac_y_end) = (np.array([saccade[name] for saccade in saccades], dtype=np.float64) for name in ["t_start", "x_end", "y_end"])
         score = -1
         if broken_fixation:
             # Broken fixation
             score = -2
-        elif not saccades or not math.isfinite(saccades[0]["t_start"]):
+        elif sac_t_start.size == 0 or not np.isfinite(sac_t_start[0]):
             # "No choice" error
             score = -1
         else:
-            # Find choice from sacccades
-            target_index = -1
-            min_angular_distance = 360
-            for i in range(len(saccades)):
-                sac_angle = ang_deg(saccades[i]["x_end"], saccades[i]["y_end"])
-                for j in range(len(target_angles)):
-                    angular_distance = ang_diff(target_angles[j], sac_angle)
-                    # print(f'i={i}, j={j}, angular_distance = {angular_distance}')
-                    if ((angular_distance <= self.min_angular_distance_to_target_deg) &
-                        (angular_distance < min_angular_distance)):
-                        min_angular_distance = angular_distance
-                        saccade_index = i
-                        target_index = j            
+            # Find choice from sacccades: the saccade and target closest in angle, within min_angular_distance_to_target_deg.
+            # Rows are saccades and columns are targets, so argmin picks the first closest pair, same as looping over both.
+            sac_angles = np.fmod(np.arctan2(sac_y_end, sac_x_end) * 180 / np.pi + 360, 360)
+            angular_distances = 180.0 - np.abs(np.abs(np.asarray(target_angles)[np.newaxis, :] - sac_angles[:, np.newaxis]) - 180.0)
+            angular_distances[~(angular_distances <= self.min_angular_distance_to_target_deg)] = np.inf
+            (saccade_index, target_index) = np.unravel_index(np.argmin(angular_distances), angular_distances.shape)
+            (saccade_index, target_index) = (int(saccade_index), int(target_index))
+            if not np.isfinite(angular_distances[saccade_index, target_index]):
+                target_index = -1
 
             # Set score
             if target_index == -1:
@@ -179,10 +196,16 @@ class CustomEnhancer(TrialEnhancer):
                     score = 0                
                     trial.add_enhancement("choice", 3-correct_target, "id")
 
+                if isinstance(saccades, dict):
+                    # Keep compact saccades compact, with the closest one as columns of one value each.
+                    scored_saccade = {name: values[saccade_index:saccade_index + 1] for name, values in saccades.items()}
+                else:
+                    scored_saccade = saccades[saccade_index]
+                all_saccades = saccades
                 trial.add_enhancement("scored_saccade_index", saccade_index, "id")      # index of the closest saccade
-                trial.add_enhancement("all_saccades", saccades, "value")                # copy of all the saccades
-                trial.add_enhancement("saccades", saccades[saccade_index], "value")     # overwrite with the closest saccade to work with existing code
-                saccade_start = saccades[saccade_index]["t_start"]
+                trial.add_enhancement("all_saccades", all_saccades, "value")            # copy of all the saccades
+                trial.add_enhancement("saccades", scored_saccade, "value")              # overwrite with the closest saccade to work with existing code
+                saccade_start = float(sac_t_start[saccade_index])
                 trial.add_enhancement("sac_on", saccade_start, "time")
 
                 fp_off_time = trial.get_time("fp_off")
@@ -223,7 +246,7 @@ class CustomEnhancer(TrialEnhancer):
             trial.add_enhancement("online_score", online_score)
             trial.add_enhancement("score_match", score == online_score)
 
-class SaccadesEnhancer(TrialEnhancer):
+class SaccadesEnhancer(SaccadeParser, TrialEnhancer):
     """Parse saccades from the x,y eye position traces in a trial using velocity and acceleration thresholds.
     This is adapted from the stand_enhancer SaccadeEnhancer, but modified to match "findSaccadesAODR.m" used in FIRA
 
@@ -249,6 +272,15 @@ class SaccadesEnhancer(TrialEnhancer):
         max_duration_ms: float = 90.0,          Maximum duration in ms of a saccade for it to count (default 90.0).
         saccades_name:                          Trial enhancement name to use when adding detected saccades (default "saccades").
         saccades_category:                      Trial category to use when adding detected saccades (default "saccades").
+        compact_saccades:                       Whether to add saccades as one dict of columns, one list per SACCADE_DTYPE field
+                                                (default False), instead of a list of dicts with the same keys.
+        session_saccades_file:                  .npz file from SaccadeParser.save_session_saccades(), with saccades already detected
+                                                for the whole session (default None -- parse each trial as it comes).
+
+    The parsing itself is in saccade_detection.SaccadeParser.
+    Saccades can also be detected for a whole session at once with detect_session(), which smooths and differentiates
+    all trials' gaze windows together.  After that, or with session_saccades_file, enhance() still centers each trial's
+    gaze at fp, but looks up the trial's precomputed saccades by fp_off time instead of parsing the trial again.
     """
 
     def __init__(
@@ -274,9 +306,18 @@ class SaccadesEnhancer(TrialEnhancer):
         min_duration_ms: float = 5.0,
         max_duration_ms: float = 90.0,
         saccades_name: str = "saccades",
-        saccades_category: str = "saccades"
+        saccades_category: str = "saccades",
+        compact_saccades: bool = False,
+        session_saccades_file: str = None
     ) -> None:
-        self.max_saccades = max_saccades
+        super().__init__(
+            max_saccades,
+            velocity_threshold_deg_per_ms,
+            velocity_peak_threshold_deg_per_ms,
+            acceleration_threshold_deg_per_ms2,
+            min_length_deg,
+            compact_saccades
+        )
         self.center_at_fp = center_at_fp
         self.x_buffer_name = x_buffer_name
         self.x_channel_id = x_channel_id
@@ -289,185 +330,161 @@ class SaccadesEnhancer(TrialEnhancer):
         self.position_smoothing_kernel_size_ms = position_smoothing_kernel_size_ms
         self.velocity_smoothing_kernel_size_ms = velocity_smoothing_kernel_size_ms
         self.acceleration_smoothing_kernel_size_ms = acceleration_smoothing_kernel_size_ms
-        self.velocity_threshold_deg_per_ms = velocity_threshold_deg_per_ms
-        self.velocity_peak_threshold_deg_per_ms = velocity_peak_threshold_deg_per_ms
-        self.acceleration_threshold_deg_per_ms2 = acceleration_threshold_deg_per_ms2
-        self.min_length_deg = min_length_deg
         self.min_latency_ms = min_latency_ms
         self.min_duration_ms = min_duration_ms
         self.max_duration_ms = max_duration_ms
         self.saccades_name = saccades_name
         self.saccades_category = saccades_category
+        self.session_saccades_file = session_saccades_file
+        if session_saccades_file is not None:
+            self.load_session_saccades(session_saccades_file)
 
     def enhance(self, trial: Trial, trial_number: int, experiment_info: dict, subject_info: dict) -> None:
+        window = self.gaze_window(trial)
+        if window is None:
+            return
+        (x_position, y_position, fp_off_time, sample_frequency) = window
+
+        # Use saccades from detect_session() or session_saccades_file, when this trial was part of the session.
+        saccades = self.lookup_session_saccades(fp_off_time)
+        if saccades is None:
+            saccades = self.detect_batch([x_position], [y_position], [fp_off_time], sample_frequency)[0]
+
+        # make sure there was data to be parsed
+        if saccades is None:
+            return
+
+        # Add the list of saccade dictionaries to trial enhancements.
+        trial.add_enhancement(self.saccades_name, saccades, self.saccades_category)
+
+    def gaze_window(self, trial: Trial) -> tuple[np.ndarray, np.ndarray, float, float]:
+        """Get x,y gaze position from fp_off to all_off, possibly centering the trial's gaze signals at fp first.
+
+        Returns a tuple of (x_position, y_position, fp_off_time, sample_frequency), or None if the trial has nothing to parse.
+        """
 
         # Get event times from trial enhancements to delimit saccade parsing.
         fp_off_time = trial.get_time(self.fp_off_name)
         all_off_time = trial.get_time(self.all_off_name)
         targAcq_time = trial.get_time("targ_acq")
         if fp_off_time is None or all_off_time is None or targAcq_time is None:
-            return
+            return None
 
         # Use trial.signals for gaze signal chunks.
         if self.x_buffer_name not in trial.signals or self.y_buffer_name not in trial.signals:  # pragma: no cover
-            return
+            return None
         x_signal = trial.signals[self.x_buffer_name]
         y_signal = trial.signals[self.y_buffer_name]
         if x_signal.end() < fp_off_time or y_signal.end() < fp_off_time:  # pragma: no cover
-            return
+            return None
 
-        # Possibly center at fp.
+        # Get x,y data from the relevant time range, fp_off to all_off.
         x_channel_index = x_signal.channel_index(self.x_channel_id)
         y_channel_index = y_signal.channel_index(self.y_channel_id)
-        if self.center_at_fp is True:
-            x_signal.apply_offset_then_gain(-x_signal.at(fp_off_time, x_channel_index), 1)
-            y_signal.apply_offset_then_gain(-y_signal.at(fp_off_time, y_channel_index), 1)
-
-        # Get x,y data from the relevant time range, fp_off to all_off.
         x_position = x_signal.values(x_channel_index, fp_off_time, all_off_time)
         y_position = y_signal.values(y_channel_index, fp_off_time, all_off_time)
 
-        # default return
-        saccades = []
+        # Possibly center at fp, the first sample at or after fp_off like SaccadeParser.detect_session().
+        if self.center_at_fp is True and x_position.size and y_position.size:
+            x_signal.apply_offset_then_gain(-x_position[0], 1)
+            y_signal.apply_offset_then_gain(-y_position[0], 1)
+            x_position = x_signal.values(x_channel_index, fp_off_time, all_off_time)
+            y_position = y_signal.values(y_channel_index, fp_off_time, all_off_time)
+        return (x_position, y_position, fp_off_time, x_signal.sample_frequency)
 
-        # for smoothing
-        smf   = np.array([0.0033, 0.0238, 0.0971, 0.2259, 0.2998, 0.2259, 0.0971, 0.0238, 0.0033])
-        hsmf  = (smf.size - 1) // 2
-        t_int = 1000 / x_signal.sample_frequency  # sample interval, in ms
+class FusedGazeSmoother(TrialEnhancer):
+    """Smooth several gaze channels with a Savitzky-Golay filter then a Gaussian filter, in one fused pass.
 
-        # make sure there's data to be parsed
-        if len(x_position) != len(y_position) or len(x_position) < len(smf):
-            return saccades
+    This gives the same result as a golay SignalSmoother followed by a gaussian SignalSmoother on each channel,
+    but stacks the channels into one buffer, reused from trial to trial, and convolves them all at once with the
+    combined Savitzky-Golay * Gaussian kernel, using FFTs.  The smoothed channels are written back into the same
+    buffer (scipy's oaconvolve still allocates its own output, which gets copied in) and from there into the trial.
+    Only samples near the trial edges, where the two filters handle edges differently from plain convolution,
+    are filtered in two stages.
 
-        # smooth the curves
-        x_position = np.convolve(x_position, smf, mode='same')
-        y_position = np.convolve(y_position, smf, mode='same')
+    Args:
+        buffer_names:   Names of Trial signal buffers to smooth together (default ["gaze_x", "gaze_y"]).
+        channel_ids:    Channel id to smooth within each of buffer_names (default ["ADC1", "ADC2"]).
+        window_size:    Savitzky-Golay window size in samples, must be odd (default 3001).
+        poly_order:     Savitzky-Golay polynomial order (default 2).
+        gaussian_std:   Gaussian standard deviation in samples, or 0 for Savitzky-Golay only (default 5).
+    """
 
-        # get velocity, sub out median
-        vel  = np.concatenate(([0], np.sqrt(np.diff(x_position)**2 + np.diff(y_position)**2) / t_int))
-        vels = vel - np.median(vel)
-        acc  = np.convolve([0.2, 0.2, 0.2, 0.2, 0.2], np.diff(vels), mode='valid')
+    def __init__(
+        self,
+        buffer_names: list[str] = None,
+        channel_ids: list[str | int] = None,
+        window_size: int = 3001,
+        poly_order: int = 2,
+        gaussian_std: float = 5
+    ) -> None:
+        if buffer_names is None:
+            buffer_names = ["gaze_x", "gaze_y"]
+        if channel_ids is None:
+            channel_ids = ["ADC1", "ADC2"]
+        self.buffer_names = buffer_names
+        self.channel_ids = channel_ids
+        self.window_size = window_size
+        self.poly_order = poly_order
+        self.gaussian_std = gaussian_std
 
-        # find all instantaneous velocities >= min peak
-        vps = np.where(vels >= self.velocity_peak_threshold_deg_per_ms)[0]
+        self.kernel = savgol_gaussian_kernel(window_size, poly_order, gaussian_std)
 
-        # so we don't have to keep checking the same samples
-        last_end = 0
+        # Samples this close to either edge are affected by the filters' own edge handling.
+        self.edge_size = self.kernel.size // 2
 
-        while len(saccades) < self.max_saccades:
-            # find first string of 5 consecutive velocities bigger than peak
-            while len(vps) > 4 and vps[4] - vps[0] != 4:
-                vps = np.delete(vps, 0)
+        # Reused from trial to trial, grown as needed.
+        self.buffer = np.empty((0, len(buffer_names)))
 
-            if len(vps) < 5:
-                break
-            
-            sac_begin = np.nan
-            # sac begins at earliest of acc > A_MIN &
-            # vel > VI_MIN -OR- acc < -A_MIN & vel < VP_MIN
-            acc_thresh = np.where(acc[last_end:vps[0]] < self.acceleration_threshold_deg_per_ms2)
-            other_thresh = np.where(np.logical_or(vels[last_end:vps[0]] <= self.velocity_threshold_deg_per_ms,
-                                                                np.logical_and(acc[last_end:vps[0]] < -self.acceleration_threshold_deg_per_ms2,
-                                                                                vels[last_end:vps[0]] < self.velocity_peak_threshold_deg_per_ms)))
-            if acc_thresh[0].size !=0:
-                acc_thresh = acc_thresh[0][-1]
-                
-                if other_thresh[0].size != 0:
-                    # other threshold also passed
-                    sac_begin = last_end + min(acc_thresh,other_thresh[0][-1])
-                else:
-                    # No other threshold besides acc
-                    sac_begin = last_end + acc_thresh
-            elif other_thresh[0].size != 0:
-                # other threshold passed
-                # ignore the acc_thresh possibility
-                inds = other_thresh[0][-1]
-                if inds.size > 1:
-                    sac_begin = last_end + min(inds)
-                else:
-                    sac_begin = last_end + inds
+    def enhance(self, trial: Trial, trial_number: int, experiment_info: dict, subject_info: dict) -> None:
+        signals = [trial.signals.get(buffer_name) for buffer_name in self.buffer_names]
+        if any(signal is None for signal in signals):  # pragma: no cover
+            return
 
-            # sac ends at first acc > -A_MIN after deceleration. the -5 accounts
-            # for the acc smoothing.
-            acc_thresh = np.where(acc[vps[4]+1:] < self.acceleration_threshold_deg_per_ms2)
-            if acc_thresh[0].size !=0:
-                decel = vps[4] + acc_thresh[0][0]
-            else:
-                decel = np.nan
+        sample_count = signals[0].sample_data.shape[0]
+        if any(signal.sample_data.shape[0] != sample_count for signal in signals):
+            # Can't stack channels of different lengths, so smooth them one at a time.
+            for signal, channel_id in zip(signals, self.channel_ids):
+                channel_index = signal.channel_index(channel_id)
+                signal.sample_data[:, channel_index] = self.smooth(signal.sample_data[:, channel_index:channel_index + 1])[:, 0]
+            return
 
-            # check if any found
-            if np.isnan(sac_begin) or np.isnan(decel):
-                # new start point
-                last_end = vps[4]
-                vps = vps[4:]
-            else:
-                # new start point
-                acc_decel_thresh = np.where(acc[decel+1:-1] > -self.acceleration_threshold_deg_per_ms2)
-                vels_decel_thresh = np.where(vels[decel:-2] <= 0.005)
-
-                if acc_decel_thresh[0].size !=0 and vels_decel_thresh[0].size !=0:
-                    acc_decel_thresh = acc_decel_thresh[0][0]
-                    vels_decel_thresh = vels_decel_thresh[0][0]
-                    sac_end = decel - 5 + max(acc_decel_thresh,vels_decel_thresh)
-                elif acc_decel_thresh[0].size !=0:
-                    acc_decel_thresh = acc_decel_thresh[0][0]
-                    sac_end = decel - 5 + acc_decel_thresh
-                elif vels_decel_thresh[0].size !=0:
-                    vels_decel_thresh = vels_decel_thresh[0][0]
-                    sac_end = decel - 5 + vels_decel_thresh
-                else:
-                    sac_end = decel - 5
-                    
-                # vector distance
-                len_ = np.sqrt((x_position[sac_end] - x_position[sac_begin-1])**2 +
-                            (y_position[sac_end] - y_position[sac_begin-1])**2)
-                # technically, the saccade could be sufficiently long, but not end up in a reasonable spot
-                end_pos_len = np.sqrt((x_position[sac_end])**2 +
-                            (y_position[sac_end])**2)
-
-                # Saccades must meet multiple criteria in addition to exceeding our velocity/acceleration thresholds:
-                # 1) The length of the saccade exceeds some threshold
-                # 2) The end position of the saccade is greater than a minimum distance threshold
-                # 3) The end position of the saccade is less than a maximum distance threshold
-                # 4) MAYBE: The saccade latency cannot be greater than Rex's recorded time that the target was acquired
-                # Get start/end times wrt fixation off.
-                sac_start_time = fp_off_time + (sac_begin + 1) / x_signal.sample_frequency
-                sac_end_time = fp_off_time + (sac_end + 1) / x_signal.sample_frequency
-                sac_duration = sac_end_time - sac_start_time
-                targAcq_latency = trial.get_time("targ_acq") - fp_off_time
-                if len_ >= self.min_length_deg and end_pos_len>5 and end_pos_len<18: #and (sac_end_time-fp_off_time)<targAcq_latency:
-                    # return stuff
-                    saccades.append({
-                        "t_start": sac_start_time,
-                        "t_end": sac_end_time,
-                        "v_max": np.max(vels[sac_begin:sac_end]),
-                        "v_avg": len_ / sac_duration,
-                        "x_start": x_position[sac_begin],
-                        "y_start": y_position[sac_begin],
-                        "x_end": x_position[sac_end],
-                        "y_end": y_position[sac_end],
-                        "raw_distance": np.sum(vels[sac_begin:sac_end])/x_signal.sample_frequency,
-                        "vector_distance": len_,
-                    })
-
-                # new start point
-                vps = vps[vps > sac_end]
-                last_end = sac_end + 1
-
-        # add final sac if eye position of final sac is different
-        # than position at 300 ms
-        if len(saccades) < self.max_saccades and (len(saccades) == 0 or saccades[-1]["t_end"] + saccades[-1]["t_start"] < 500):
-            saccades.append({
-                        "t_start": np.nan,
-                        "t_end": np.inf,
-                        "v_max": np.nan,
-                        "v_avg": np.nan,
-                        "x_start": np.nan,
-                        "y_start": np.nan,
-                        "x_end": np.nan,
-                        "y_end": np.nan,
-                        "raw_distance": np.nan,
-                        "vector_distance": np.nan,
-                    })
-        # Add the list of saccade dictionaries to trial enhancements.
-        trial.add_enhancement(self.saccades_name, saccades, self.saccades_category)
\ No newline at end of file
+        if self.buffer.shape[0] < sample_count:
+            self.buffer = np.empty((sample_count, len(signals)))
+        data = self.buffer[:sample_count]
+        channel_indices = [signal.channel_index(channel_id) for signal, channel_id in zip(signals, self.channel_ids)]
+        for column, (signal, channel_index) in enumerate(zip(signals, channel_indices)):
+            data[:, column] = signal.sample_data[:, channel_index]
+
+        self.smooth(data, out=data)
+        for column, (signal, channel_index) in enumerate(zip(signals, channel_indices)):
+            signal.sample_data[:, channel_index] = data[:, column]
+
+    def smooth_in_stages(self, data: np.ndarray) -> np.ndarray:
+        """Apply the Savitzky-Golay and Gaussian filters one after the other, down the rows of data."""
+        smoothed = savgol_filter(data, self.window_size, self.poly_order, axis=0)
+        if self.gaussian_std > 0:
+            smoothed = gaussian_filter1d(smoothed, self.gaussian_std, axis=0)
+        return smoothed
+
+    def smooth(self, data: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Apply the fused filter down the rows of data, fixing up the edges with smooth_in_stages().
+
+        The result goes into out, when given, which may be data itself.
+        """
+        if out is None:
+            out = np.empty_like(data, dtype=np.float64)
+        edge_size = self.edge_size
+        segment_size = 2 * edge_size + 1
+        sample_count = data.shape[0]
+        if sample_count <= 2 * segment_size:
+            np.copyto(out, self.smooth_in_stages(data))
+            return out
+
+        # Filter the edges before anything is written to out, in case out is data.
+        head = self.smooth_in_stages(data[:segment_size])[:edge_size]
+        tail = self.smooth_in_stages(data[-segment_size:])[-edge_size:]
+        np.copyto(out, oaconvolve(data, self.kernel[:, np.newaxis], mode="same", axes=0))
+        out[:edge_size] = head
+        out[-edge_size:] = tail
+        return out
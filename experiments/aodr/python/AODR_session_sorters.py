@@ -3,31 +3,26 @@ from pathlib import Path
 import platform
 import shutil
 import json
-import spikeinterface.full as si
-# import kilosort
-# from kilosort import io, run_kilosort
-# from kilosort.gui.launch import launcher as launch_gui
-import spikeinterface_gui
-import spikeinterface.extractors as se
-import spikeinterface.preprocessing as spre
-import spikeinterface.sorters as ss
-import spikeinterface.postprocessing as spost
-import spikeinterface.qualitymetrics as sqm
-import spikeinterface.exporters as sexp
-import spikeinterface.curation as scur
-from spikeinterface.curation import apply_curation
-from spikeinterface.widgets import plot_sorting_summary
-import spikeinterface.sortingcomponents as sc
-import spikeinterface.widgets as sw
-from spikeinterface.extractors import read_phy, read_binary
 from probeinterface import generate_tetrode, ProbeGroup, Probe, generate_linear_probe
 from probeinterface import write_probeinterface, read_probeinterface
 import subprocess, random, string, os
+import hashlib, time
 import numpy as np
-import matplotlib.pyplot as plt
 import logging
-from open_ephys.analysis import Session
-# from phy.apps.template import template_gui
+
+# spikeinterface, open_ephys, kilosort, phy, and the GUI, widget, exporter, and curation modules are imported inside the methods that use them.
+# They take several seconds to import, and scripts often only need a few methods (like read_data and overwrite_timestamps), or none
+# (like the convert step of Kilo4_Neuropixel_Binary_Example.py).  Where we do need spikeinterface, spikeinterface.core has the job kwargs and
+# analyzer functions we used from spikeinterface.full, and spikeinterface.sorters has the sorter functions.
+# Run benchmark_imports.py to see the import times.
+
+def import_analyzer_extensions():
+    # Importing these registers the analyzer extensions we compute, like templates, correlograms, and quality_metrics.
+    import spikeinterface.postprocessing
+    try:
+        import spikeinterface.qualitymetrics
+    except ImportError:
+        import spikeinterface.metrics # newer spikeinterface moved quality metrics here
 
 # Created by LWT 2025/2026
 # This is a custom spike sorter class for Open Ephys sessions using spikeinterface. It is kind of a mess and has a lot of different methods for various
@@ -46,7 +41,7 @@ class OpenEphysSessionSorter():
         session_dir:                        The open ephys session folder you'd like to sort
         stream_name:                        The data source you want to sort (e.g., 'Rhythm Data' for Open Ephys Intan Headstages)
         channel_names:                      List of integers specifying the channel numbers
-        step_names:                         List of strings that correspond to steps/methods of the current class, in order, to implement
+        step_names:                         List of strings that correspond to steps/methods of the current class, in order, to implement with run_steps()
         result_name:                        Not currently used
         sorter_name:                        The sorting engine to use, e.g., 'spykingcircus2', limited by the sorters installed
         out_folder:                         String indicating the output folder
@@ -76,6 +71,115 @@ class OpenEphysSessionSorter():
         self.freq_min = freq_min
         self.freq_max = freq_max
 
+    # Steps that write results to disk, and where.  run_steps() checkpoints these and skips them when nothing changed.
+    # Other steps (read_data, set_tetrode, bandpass, ...) are cheap and lazy in spikeinterface, so they always run.
+    def step_outputs(self, step_name):
+        sorter_folder = os.path.join(self.out_folder, self.sorter_name)
+        outputs = {
+            "run_kilosort4": [sorter_folder],
+            "single_ch_sorter_and_analyzer": [sorter_folder, os.path.join(self.out_folder, "analyzer")],
+            "sort_by_group": [sorter_folder, os.path.join(self.out_folder, "analyzer")],
+            "run_kilosort4_analyzer": [os.path.join(self.out_folder, "analyzer")],
+            "convert_to_binary": [os.path.join(self.out_folder, self.sorter_name+".bin")],
+            "export_to_phy": [self.out_folder+"phy"],
+            "overwrite_timestamps": [self.out_folder+self.sorter_name+"sorter_output/sample_times.npy"],
+        }
+        return outputs.get(step_name, None)
+
+    def restore_step(self, step_name):
+        import spikeinterface.core as si
+        import spikeinterface.sorters as ss
+        # Load what a skipped step would have left on self, for the steps after it.
+        if step_name == "sort_by_group":
+            self.sorting_analyzer = si.load_sorting_analyzer(os.path.join(self.out_folder, "analyzer"))
+            self.sorting = self.sorting_analyzer.sorting
+            return
+        if step_name in ["run_kilosort4", "single_ch_sorter_and_analyzer"]:
+            self.sorting = ss.read_sorter_folder(os.path.join(self.out_folder, self.sorter_name))
+        if step_name in ["run_kilosort4_analyzer", "single_ch_sorter_and_analyzer"]:
+            self.sorting_analyzer = si.load_sorting_analyzer(os.path.join(self.out_folder, "analyzer"))
+        if step_name == "convert_to_binary":
+            # Same as what io.spikeinterface_to_binary() returns, for run_kilosort4_gui.
+            self.filename = Path(self.out_folder) / (self.sorter_name+'.bin')
+            self.N = self.recording.get_total_samples()
+            self.fs = self.recording.get_sampling_frequency()
+
+    def step_fingerprint(self, step_name, previous_fingerprint):
+        # Each step's fingerprint covers the sorter parameters, the steps before it, and the step itself,
+        # so changing e.g. freq_max or adding a step before run_kilosort4 means re-sorting.
+        params = {
+            "session_dir": self.session_dir,
+            "stream_name": self.stream_name,
+            "channel_names": self.channel_names,
+            "sorter_name": self.sorter_name,
+            "freq_min": self.freq_min,
+            "freq_max": self.freq_max,
+            "step_name": step_name,
+            "previous": previous_fingerprint,
+        }
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def run_steps(self, step_names=None, force=False):
+        """Run the given steps (default self.step_names) in order, resuming from checkpoints where possible.
+
+        After each step that writes to disk, this writes a checkpoint marker with the step's parameter fingerprint to
+        <out_folder>/checkpoints/.  On a re-run, steps with a matching marker and existing outputs are skipped and
+        their results are loaded from disk instead.  Once a step has to run, all the steps after it run too.
+        clean_tree is skipped when resuming, since it would delete the checkpoints.  Use force=True to run everything.
+        """
+        if step_names is None:
+            step_names = self.step_names
+        checkpoint_folder = Path(self.out_folder) / "checkpoints"
+
+        fingerprints = []
+        previous = None
+        for step_name in step_names:
+            previous = self.step_fingerprint(step_name, previous)
+            fingerprints.append(previous)
+
+        def is_done(step_name, fingerprint):
+            marker = checkpoint_folder / f"{step_name}.json"
+            if not marker.exists():
+                return False
+            with open(marker, 'r') as f:
+                if json.load(f).get("fingerprint") != fingerprint:
+                    return False
+            return all(os.path.exists(output) for output in self.step_outputs(step_name))
+
+        resuming = not force and any(
+            self.step_outputs(step_name) is not None and is_done(step_name, fingerprint)
+            for step_name, fingerprint in zip(step_names, fingerprints)
+        )
+
+        must_run = force
+        for step_name, fingerprint in zip(step_names, fingerprints):
+            outputs = self.step_outputs(step_name)
+            if step_name == "clean_tree" and resuming:
+                print("Skipping clean_tree, resuming from checkpoints...")
+                continue
+            if outputs is None:
+                getattr(self, step_name)()
+                continue
+            if not must_run and is_done(step_name, fingerprint):
+                print(f"Skipping {step_name}, already done with the same parameters...")
+                self.restore_step(step_name)
+                continue
+
+            # From here on, results from this step and the ones after it are stale.
+            must_run = True
+            for stale_step in step_names[step_names.index(step_name):]:
+                (checkpoint_folder / f"{stale_step}.json").unlink(missing_ok=True)
+
+            start_time = time.time()
+            getattr(self, step_name)()
+            missing = [output for output in outputs if not os.path.exists(output)]
+            if missing:
+                raise RuntimeError(f"Step {step_name} did not write expected outputs: {missing}")
+
+            checkpoint_folder.mkdir(parents=True, exist_ok=True)
+            with open(checkpoint_folder / f"{step_name}.json", 'w') as f:
+                json.dump({"step": step_name, "fingerprint": fingerprint, "seconds": time.time() - start_time, "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=2)
+
     def clean_tree(self):
         print("Cleaning output folder...")
         # clean
@@ -87,6 +191,8 @@ class OpenEphysSessionSorter():
                 shutil.rmtree(folder)
     
     def read_data(self):
+        import spikeinterface.extractors as se
+        from open_ephys.analysis import Session
         print("Reading data from Open Ephys session...")
         sesssion = Session(self.session_dir)
         record_node = sesssion.recordnodes[0]
@@ -136,6 +242,22 @@ class OpenEphysSessionSorter():
         # set this to the recording
         self.recording = self.recording.set_probegroup(probegroup, group_mode='by_probe')
 
+    def set_tetrodes(self):
+        # Like set_tetrode, but for several tetrodes: channel_names is a list of 4-channel lists, or a flat list taken 4 at a time.
+        # Each tetrode gets its own "group", so sort_by_group can sort them in parallel.
+        print("Setting tetrode probes...")
+        if all(isinstance(channel, (list, tuple)) for channel in self.channel_names):
+            tetrode_channels = self.channel_names
+        else:
+            tetrode_channels = [self.channel_names[index:index+4] for index in range(0, len(self.channel_names), 4)]
+        probegroup = ProbeGroup()
+        for index, channels in enumerate(tetrode_channels):
+            tetrode = generate_tetrode()
+            tetrode.move([index * 200, 0]) # keep the tetrodes apart so unit locations make sense
+            tetrode.set_device_channel_indices(channels)
+            probegroup.add_probe(tetrode)
+        self.recording.set_probegroup(probegroup, group_mode='by_probe', in_place=True)
+
     def set_linear(self):
         print("Setting linear probe...")
         linear_probe = generate_linear_probe(num_elec=len(self.channel_names), ypitch=30)
@@ -151,23 +273,71 @@ class OpenEphysSessionSorter():
         self.recording = self.recording.set_probe(probe)
 
     def bandpass(self):
+        import spikeinterface.preprocessing as spre
         print("Applying bandpass filter...")
         # Filter w/bandpass
         self.recording = spre.bandpass_filter(recording=self.recording, freq_min=self.freq_min, freq_max=self.freq_max)
 
+    def preprocessed_folder(self):
+        # Cache folder for the preprocessed recording, named for what went into it, so different settings don't collide.
+        key = {
+            "session_dir": os.path.normpath(self.session_dir),
+            "stream_name": self.stream_name,
+            "channel_names": self.channel_names,
+            "freq_min": self.freq_min,
+            "freq_max": self.freq_max,
+        }
+        key_hash = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:12]
+        return Path(self.out_folder) / "preprocessed" / key_hash
+
+    def cache_preprocessed(self, format='binary', n_jobs=-1):
+        import spikeinterface.core as si
+        # Save the preprocessed recording (after read_data, probe setup, and bandpass) to disk once, using all cores,
+        # then read it back from there. So sorting, the analyzer, phy export, etc. don't each re-read and re-filter
+        # the raw NWB/binary data, and later runs of the script (like postkilosort) can load it without filtering at all.
+        # Time vectors are saved along with the traces, so overwrite_timestamps still gets the original times.
+        # format can be 'binary' (a folder of raw traces, fastest to read back) or 'zarr' (compressed, smaller).
+        folder = self.preprocessed_folder()
+        if format == 'zarr':
+            folder = folder.with_suffix('.zarr')
+        done_marker = folder.parent / (folder.name + ".done.json")
+        load = getattr(si, 'load', None) or si.load_extractor # si.load replaced si.load_extractor in newer spikeinterface
+        if folder.exists() and done_marker.exists():
+            print(f"Loading cached preprocessed recording from {folder}...")
+            self.recording = load(folder)
+            return
+
+        print(f"Saving preprocessed recording to {folder} (only needed once for these settings)...")
+        if folder.exists():
+            shutil.rmtree(folder) # left over from an interrupted save
+        job_kwargs = dict(n_jobs=n_jobs, chunk_duration='1s', progress_bar=True)
+        self.recording = self.recording.save(folder=folder, format=format, overwrite=True, **job_kwargs)
+        with open(done_marker, 'w') as f:
+            json.dump({
+                "session_dir": self.session_dir,
+                "stream_name": self.stream_name,
+                "channel_names": self.channel_names,
+                "freq_min": self.freq_min,
+                "freq_max": self.freq_max,
+                "format": format,
+            }, f, indent=2, default=str)
+
     def single_ch_sorter_and_analyzer(self):
+        import spikeinterface.core as si
+        import spikeinterface.sorters as ss
+        import_analyzer_extensions()
         print("Running MountainSort5 sorter for single channel data...")
         job_kwargs = dict(n_jobs=1, progress_bar=True)
         si.set_global_job_kwargs(**job_kwargs)
-        params = si.get_default_sorter_params('mountainsort5')
+        params = ss.get_default_sorter_params('mountainsort5')
         #params['detect_threshold'] = 4.75 # I usually start lower than default for first sort then move up
         params['npca_per_channel'] = 5 # Haven't found much of a meaningful difference changing this for single electrode
         params['scheme2_training_recording_sampling_mode'] = 'uniform' # uniform, initial
         params['filter'] = True  # For some reason,  making this false changes the detect sign. But leaving true and not using my preprocessing filter results in the data not being filtered?
-        self.sorting = si.run_sorter('mountainsort5', self.recording,
+        self.sorting = ss.run_sorter('mountainsort5', self.recording,
                                             folder=self.out_folder+"/"+self.sorter_name, 
                                             verbose=True, remove_existing_folder=True, **params)
-        #sorting = si.run_sorter(self.sorter_name, self.recording,
+        #sorting = ss.run_sorter(self.sorter_name, self.recording,
         #                                    folder=self.out_folder+"/"+self.sorter_name, 
         #                                    verbose=True, remove_existing_folder=True, **params)
         self.sorting_analyzer = si.create_sorting_analyzer(self.sorting, self.recording,
@@ -186,24 +356,77 @@ class OpenEphysSessionSorter():
         self.sorting_analyzer.compute("quality_metrics", metric_names=["snr", "firing_rate"])
         self.sorting_analyzer.compute("spike_amplitudes", **job_kwargs)
 
+    def sort_by_group(self, grouping_property='group', n_workers=None, group_by_channel=False):
+        import spikeinterface.core as si
+        import spikeinterface.sorters as ss
+        import_analyzer_extensions()
+        # Sort each channel group (e.g. each tetrode from set_tetrodes) in its own worker process, then aggregate the sortings
+        # and build one combined analyzer. With several tetrodes this is close to n_groups times faster than sorting them one
+        # after another on one core.  Set group_by_channel=True for single electrodes, to sort each channel on its own.
+        if group_by_channel or grouping_property not in self.recording.get_property_keys():
+            self.recording.set_property(grouping_property, np.arange(self.recording.get_num_channels()))
+        groups = np.unique(self.recording.get_property(grouping_property))
+        if n_workers is None:
+            n_workers = min(len(groups), os.cpu_count() or 1)
+        print(f"Running {self.sorter_name} on {len(groups)} channel groups with {n_workers} workers...")
+
+        params = ss.get_default_sorter_params(self.sorter_name)
+        if self.sorter_name == 'mountainsort5':
+            # Same settings as single_ch_sorter_and_analyzer
+            params['npca_per_channel'] = 5
+            params['scheme2_training_recording_sampling_mode'] = 'uniform'
+            params['filter'] = True
+        if 'n_jobs' in params:
+            params['n_jobs'] = max(1, (os.cpu_count() or 1) // n_workers) # share the cores between groups
+        self.sorting = ss.run_sorter_by_property(self.sorter_name, self.recording, grouping_property,
+                                                 folder=self.out_folder+"/"+self.sorter_name,
+                                                 engine='joblib', engine_kwargs={'n_jobs': n_workers},
+                                                 verbose=True, remove_existing_folder=True, **params)
+
+        # One analyzer for all the groups.  The default sparsity keeps channels within 100um of each unit,
+        # which for tetrodes from set_tetrodes (200um apart) means the channels of its own tetrode.
+        job_kwargs = dict(n_jobs=-1, progress_bar=True)
+        si.set_global_job_kwargs(**job_kwargs)
+        self.sorting_analyzer = si.create_sorting_analyzer(self.sorting, self.recording,
+                                                    format="binary_folder", folder=self.out_folder+"/analyzer",
+                                                    overwrite=True)
+        self.sorting_analyzer.compute({
+            "random_spikes": {"method": "uniform", "max_spikes_per_unit": 500},
+            "waveforms": {},
+            "templates": {},
+            "template_similarity": {},
+            "noise_levels": {},
+            "unit_locations": {"method": "monopolar_triangulation"},
+            "correlograms": {"window_ms": 100, "bin_ms": 5.},
+            "isi_histograms": {},
+            "principal_components": {"n_components": 3, "mode": "by_channel_global", "whiten": True},
+            "quality_metrics": {"metric_names": ["snr", "firing_rate"]},
+            "spike_amplitudes": {}
+        })
+
     def run_kilosort4(self):
+        import spikeinterface.core as si
+        import spikeinterface.sorters as ss
         # Does not use the gui, but instead runs kilosort4 directly from the API using default parameters.
         #job_kwargs = dict(n_jobs=12, progress_bar=True)
         #si.set_global_job_kwargs(**job_kwargs)
         #self.recording = self.recording.save(folder=self.out_folder+"/"+self.sorter_name, format='binary', **job_kwargs)
         #self.recording = read_binary(self.filename, dtype = np.int16, sampling_frequency=self.fs, num_channels=self.N)
-        params = si.get_default_sorter_params('kilosort4')
+        params = ss.get_default_sorter_params('kilosort4')
         params['delete_recording_dat'] = False # Keep the .dat file for potential re-use and computing things. You do not need to convert to binary prior to running this way.
         params['n_jobs'] = -1 # Use all available CPU cores for writing the binary file.
         params['pool_engine'] = "thread" # Using ProcessPoolExecutor (default) causes issues on windows if n_jobs=-1. Can set n_jobs to something like 8 and it will still work, just slow.
         job_kwargs = dict(n_jobs=-1, progress_bar=True)
         si.set_global_job_kwargs(**job_kwargs)
-        self.sorting = si.run_sorter(sorter_name='kilosort4', recording=self.recording,
+        self.sorting = ss.run_sorter(sorter_name='kilosort4', recording=self.recording,
                                             folder=self.out_folder+"/"+self.sorter_name, 
                                             verbose=True, docker_image=False, 
                                             remove_existing_folder=True, **params)
         
     def run_kilosort4_analyzer(self):
+        import spikeinterface.core as si
+        import spikeinterface.sorters as ss
+        import_analyzer_extensions()
         # Check if self.sorting exists
         if not hasattr(self, 'sorting') or self.sorting is None:
             print("No sorting object found. Attempting to load from output directory...")
@@ -213,7 +436,7 @@ class OpenEphysSessionSorter():
                 return
             try:
                 # Use the kilosort4 extractor from spikeinterface
-                self.sorting = si.read_sorter_folder(sorting_output_dir)
+                self.sorting = ss.read_sorter_folder(sorting_output_dir)
                 print("Loaded Kilosort4 sorting from output directory.")
             except Exception as e:
                 print(f"Failed to load Kilosort4 sorting: {e}")
@@ -242,6 +465,7 @@ class OpenEphysSessionSorter():
         
                                                     
     def convert_to_binary(self):
+        from kilosort import io
         # Create a new binary file and copy the data to it 60,000 samples at a time.
         # Depending on your system’s memory, you could increase or decrease the number of samples
         # loaded on each iteration. This will also export the associated probe information as a
@@ -266,6 +490,7 @@ class OpenEphysSessionSorter():
         # should be saved, and select a probe file.
 
     def run_kilosort4_gui(self):
+        from kilosort.gui.launch import launcher as launch_gui
         # Best practice for Kilosort4 on Windows:
 
         # Always launch the Kilosort4 GUI in a separate Python process or kernel, not from within a script that also runs other code or uses multiprocessing/threading.
@@ -295,6 +520,9 @@ class OpenEphysSessionSorter():
         
 
     def open_sigui(self):
+        import spikeinterface_gui
+        from spikeinterface.widgets import plot_sorting_summary
+        from spikeinterface.curation import apply_curation
         plot_sorting_summary(sorting_analyzer=self.sorting_analyzer, curation=True, backend='spikeinterface_gui')
 
         # Potentially load the curation JSON file
@@ -311,15 +539,16 @@ class OpenEphysSessionSorter():
             self.cured_sorting_analyzer = apply_curation(self.sorting_analyzer, curation_dict_or_model=curation_dict)
 
     def export_to_phy(self):
+        from spikeinterface.exporters import export_to_phy
         print("Exporting to Phy...")
         if hasattr(self, 'cured_sorting'):
             # self.cured_sorting exists
             print("cured_sorting is available")
-            si.export_to_phy(self.cured_sorting_analyzer, output_folder=self.out_folder+"phy", verbose=False)
+            export_to_phy(self.cured_sorting_analyzer, output_folder=self.out_folder+"phy", verbose=False)
         else:
             # self.cured_sorting does not exist
             print("cured_sorting is not available")
-            si.export_to_phy(self.sorting_analyzer, output_folder=self.out_folder+"phy", verbose=False)
+            export_to_phy(self.sorting_analyzer, output_folder=self.out_folder+"phy", verbose=False)
 
     def overwrite_timestamps(self, alt_path=None):
         print("Writing sample timestamps to interpret phy spiketime.npy sample numbers...")
@@ -331,6 +560,7 @@ class OpenEphysSessionSorter():
             np.save(alt_path+"sample_times.npy", time_vector)
 
     def open_phy(self,alt_path=None):
+        from phy.apps.template import template_gui
         if alt_path is None:
             template_gui(self.out_folder+"phy/params.py")
         else:
@@ -1,7 +1,7 @@
 import sys, os
 # import phy
-import spikeinterface.widgets as sw
 from AODR_session_sorters import OpenEphysSessionSorter as OES
+from enhancer_profiling import profiled_experiment, write_profile_report
 from pyramid import cli
 import pandas as pd
 
@@ -46,14 +46,18 @@ def run_initial_pipeline():
     sorter = OES(session_dir=dataSearchPath+sessDir+"/",
                  out_folder=sorted_out,
                  stream_name = stream_name,
-                 sorter_name='kilosort4')
-    sorter.clean_tree() # Delete previous sorting results if they exist
-    sorter.read_data() # Reads data and sets the neuropixel probe (binary files come with probe attached already!)
-    sorter.bandpass() # Bandpass filter the data
+                 sorter_name='kilosort4',
+                 # clean_tree: delete previous sorting results if they exist
+                 # read_data: reads data and sets the neuropixel probe (binary files come with probe attached already!)
+                 # bandpass: bandpass filter the data
+                 # cache_preprocessed: save the filtered data once to sorted_out/preprocessed/, so later steps and postkilosort reuse it
+                 # run_kilosort4: run Kilosort4 programmatically through spikeinterface
+                 step_names=['clean_tree', 'read_data', 'bandpass', 'cache_preprocessed', 'run_kilosort4'])
     # Really 2 methods to run Kilosort4: either call the GUI manually, or run it programmatically below.
-    # 1) Run Kilosort4 programmatically through spikeinterface:
-    sorter.run_kilosort4()
-    # 2) Alternatively, you can run the Kilosort4 GUI manually by commenting out the sorter.run_kilosort4() line above
+    # 1) Run the steps above. This checkpoints each step in sorted_out/checkpoints/, so if you run it again
+    # with the same parameters it skips clean_tree and run_kilosort4 instead of sorting again (use force=True to start over).
+    sorter.run_steps()
+    # 2) Alternatively, you can run the Kilosort4 GUI manually by removing run_kilosort4 from step_names above
     # Then, in a terminal to run the gui: python -m kilosort
     print("Kilosort4 sorting complete")
 
@@ -64,6 +68,8 @@ def run_postkilosort():
                  stream_name = stream_name,
                  sorter_name='kilosort4')
     sorter.read_data()
+    sorter.bandpass()
+    sorter.cache_preprocessed() # loads the filtered recording saved by the initial step, instead of filtering again
     # Phy GUI has some documented issues with Template and Feature views when installed in an environment with other stuff.
     # Currently I am creating a new conda environment just for phy to get around this using
     # the phy2_local.yml file in this repo. It seems to work fine if phy is installed in a clean environment:
@@ -76,7 +82,7 @@ def run_conversion():
     cli.main(["convert", 
         "--trial-file", trialFileOutputName, 
         "--search-path", pyramidSearchPath, 
-        "--experiment", convertSpecs, 
+        "--experiment", profiled_experiment(convertSpecs, [pyramidSearchPath]), 
         "--readers", 
         "ttl_reader.session_dir="+dataSearchPath+sessDir,
         "message_reader.session_dir="+dataSearchPath+sessDir,
@@ -84,6 +90,7 @@ def run_conversion():
         "gaze_y_reader.session_dir="+dataSearchPath+sessDir,
         "pupil_reader.session_dir="+dataSearchPath+sessDir,
         "phy_reader.params_file="+params_path])
+    write_profile_report(trialFileOutputName) # only writes a report if the YAML has profile_enhancers: True under trials
     print("Conversion complete.")
 
 if __name__ == "__main__":
@@ -1,6 +1,17 @@
 from pyramid import cli
 import pandas as pd
 import os
+import sys
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from enhancer_profiling import profiled_experiment, write_profile_report
+from conversion_cache import ConversionManifest, session_fingerprint, config_fingerprint
+
+# Convert every session folder in dataSearchPath, several at a time in a pool of worker processes.
+# Each worker process writes its own log file to baseSaveDir/logs/, and a summary prints at the end.
+# Sessions with an existing output file are skipped, unless overwrite = True or their inputs changed since the
+# last conversion, according to baseSaveDir/conversion_manifest.json (see conversion_cache.py).
 
 # Directory where the sorted plexon data files are stored
 dataSearchPath = "/Users/lowell/Library/CloudStorage/Box-Box/GoldLab/Data/Physiology/AODR/Data/Anubis/Raw/Behavior/"
@@ -9,34 +20,131 @@ pyramidSearchPath = "/Users/lowell/Documents/GitHub/Lab_Pipelines/experiments/ao
 convertSpecs = "/Users/lowell/Documents/GitHub/Lab_Pipelines/experiments/aodr/AODR_experiment.yaml"
 # Base directory to save the output files from pyramid (hdf5 files)
 baseSaveDir = "/Users/lowell/Library/CloudStorage/Box-Box/GoldLab/Data/Physiology/AODR/Data/Anubis/Converted/Behavior/Pyramid/"
-# Overwrite existing files or not
+# Overwrite existing files or not (True re-converts everything, False re-converts only sessions whose inputs changed)
 overwrite = False
-# List of files to process
-files = os.listdir(dataSearchPath)
-# Loop through the files and process them
-if not files:
-    print("No files found in the specified directory.")
-    exit()
-f_num = 0
-for currentFile in files:
-    f_num += 1
-    outputFname = baseSaveDir+currentFile+".hdf5"
-    if os.path.exists(outputFname) and not overwrite:
-        print(f"\nOutput file already exists, skipping: {currentFile}\n")
-        continue
-    else:
-        print(f"\nProcessing file: {f_num}/{len(files)} {currentFile}\n")
-        cli.main(["convert", 
-                "--trial-file", outputFname, 
-                "--search-path", pyramidSearchPath, 
-                "--experiment", convertSpecs, 
-                "--readers", 
+# Local python modules (custom enhancers, etc.) used by the YAML, checked for changes along with the YAML and ecode CSVs
+pythonDir = os.path.dirname(convertSpecs)+"/python/"
+# Also hash session file contents, not just sizes and mtimes (catches more, but reads every session in full)
+hashSessionContents = False
+# Trust existing output files that aren't in the manifest yet (from before there was a manifest) instead of re-converting them
+adoptUnknownOutputs = True
+# How many sessions to convert at once. Each worker needs memory for one whole conversion, so don't go too high.
+maxWorkers = max(1, (os.cpu_count() or 2) - 1)
+# Where each worker process writes its log
+logDir = baseSaveDir+"logs/"
+
+
+def session_size(sessionPath):
+    # Total bytes in a session folder, to start the biggest sessions first and balance the load across workers.
+    if os.path.isfile(sessionPath):
+        return os.path.getsize(sessionPath)
+    totalSize = 0
+    for root, dirs, files in os.walk(sessionPath):
+        for fileName in files:
+            try:
+                totalSize += os.path.getsize(os.path.join(root, fileName))
+            except OSError:
+                pass
+    return totalSize
+
+
+def init_worker(logDir):
+    # Send everything from this worker process, including pyramid's prints and logging, to its own log file.
+    os.makedirs(logDir, exist_ok=True)
+    logFile = open(os.path.join(logDir, f"worker_{os.getpid()}.log"), "a", buffering=1)
+    sys.stdout = logFile
+    sys.stderr = logFile
+    logging.basicConfig(stream=logFile, level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", force=True)
+
+
+def convert_session(currentFile, outputFname, experimentSpecs):
+    # Run one conversion in a worker process and report how it went, rather than raising.
+    print(f"\nProcessing file: {currentFile}\n", flush=True)
+    startTime = time.perf_counter()
+    try:
+        exitCode = cli.main(["convert",
+                "--trial-file", outputFname,
+                "--search-path", pyramidSearchPath,
+                "--experiment", experimentSpecs,
+                "--readers",
                 "ttl_reader.session_dir="+dataSearchPath+currentFile,
                 "message_reader.session_dir="+dataSearchPath+currentFile,
                 "gaze_x_reader.session_dir="+dataSearchPath+currentFile,
                 "gaze_y_reader.session_dir="+dataSearchPath+currentFile,
                 "pupil_reader.session_dir="+dataSearchPath+currentFile])
-    
-print("\nAll files processed.\n")
+        write_profile_report(outputFname) # only writes a report if the YAML has profile_enhancers: True under trials
+        error = None if not exitCode else f"cli exit code {exitCode}"
+    except BaseException as e: # pyramid may sys.exit() on bad arguments
+        logging.exception(f"Conversion failed for {currentFile}")
+        error = f"{e.__class__.__name__}: {e}"
+
+    if error is not None and os.path.exists(outputFname):
+        # Don't leave a partial file behind, or it would be skipped next time.
+        os.remove(outputFname)
+
+    duration = time.perf_counter() - startTime
+    print(f"\nFinished file: {currentFile} in {duration:.1f}s ({'ok' if error is None else error})\n", flush=True)
+    return {"session": currentFile, "status": "ok" if error is None else "failed", "seconds": duration, "error": error, "log": sys.stdout.name}
+
+
+def main():
+    # List of files to process
+    files = os.listdir(dataSearchPath)
+    if not files:
+        print("No files found in the specified directory.")
+        return
+
+    manifest = ConversionManifest(baseSaveDir+"conversion_manifest.json")
+    configFingerprint = config_fingerprint(convertSpecs, pyramidSearchPath, pythonDir)
+
+    results = []
+    toConvert = []
+    sessionFingerprints = {}
+    for currentFile in files:
+        outputFname = baseSaveDir+currentFile+".hdf5"
+        sessionFingerprints[currentFile] = session_fingerprint(dataSearchPath+currentFile, hashSessionContents)
+        reason = "overwrite" if overwrite else manifest.check(outputFname, sessionFingerprints[currentFile], configFingerprint, adoptUnknownOutputs)
+        if reason is None:
+            print(f"Output file is up to date, skipping: {currentFile}")
+            results.append({"session": currentFile, "status": "skipped", "seconds": 0.0, "error": None, "log": None})
+        else:
+            print(f"Will convert {currentFile}: {reason}")
+            toConvert.append((session_size(dataSearchPath+currentFile), currentFile, outputFname))
+    manifest.save()
+
+    # Largest first, so the long conversions don't all end up at the end on one worker.
+    toConvert.sort(reverse=True)
+    print(f"\nConverting {len(toConvert)} of {len(files)} sessions with {maxWorkers} workers, logs in {logDir}\n")
+
+    # The same YAML, or a copy with the enhancers wrapped for profiling if it has profile_enhancers: True (see enhancer_profiling.py).
+    experimentSpecs = profiled_experiment(convertSpecs, [pyramidSearchPath])
+
+    batchStart = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=maxWorkers, initializer=init_worker, initargs=(logDir,)) as pool:
+        futures = {pool.submit(convert_session, currentFile, outputFname, experimentSpecs): currentFile for _, currentFile, outputFname in toConvert}
+        for f_num, future in enumerate(as_completed(futures), start=1):
+            try:
+                result = future.result()
+            except Exception as e: # the worker process itself died
+                result = {"session": futures[future], "status": "failed", "seconds": float("nan"), "error": f"{e.__class__.__name__}: {e}", "log": None}
+            results.append(result)
+            outputFname = baseSaveDir+result["session"]+".hdf5"
+            if result["status"] == "ok":
+                manifest.record(outputFname, sessionFingerprints[result["session"]], configFingerprint)
+            else:
+                manifest.forget(outputFname)
+            manifest.save()
+            print(f"{f_num}/{len(toConvert)} {result['status']}: {result['session']} ({result['seconds']:.1f}s)")
+
+    summary = pd.DataFrame(results, columns=["session", "status", "seconds", "error", "log"])
+    print("\nSummary:")
+    print(summary.groupby("status")["seconds"].agg(["count", "sum", "max"]).to_string())
+    failed = summary[summary["status"] == "failed"]
+    if not failed.empty:
+        print("\nFailed sessions:")
+        print(failed[["session", "error", "log"]].to_string(index=False))
+    print(f"\nAll files processed in {time.perf_counter() - batchStart:.1f}s.\n")
 
 
+if __name__ == "__main__":
+    main()
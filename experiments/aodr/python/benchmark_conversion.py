@@ -0,0 +1,405 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Usage:
+# Time pyramid conversion end to end on synthetic Open Ephys sessions, so we can catch slowdowns without a real session from Box.
+# In a terminal, activate the gold_pipelines environment and run:
+#   python benchmark_conversion.py                              # 300 trial session, AODR and dotsRT configs
+#   python benchmark_conversion.py --trials 1000 --configs aodr # longer session, just AODR
+#   python benchmark_conversion.py --no-phy --keep              # no phy output, keep the synthetic session around to poke at
+#
+# This writes a session in Open Ephys binary format with:
+#   - TTL line 1 high during each trial (trial start and sync), line 2 high from fp on
+#   - UDP Events text messages in the <message>@<timestamp>=<sample_number> format parsed by udp_events.py
+#   - gaze x/y on ADC1/ADC2 with one saccade to the target after fp off, and pupil on ADC3
+#   - optionally, phy output with Poisson spike trains for the phy_reader
+#
+# Each conversion runs in its own process, so that imports and peak memory are counted separately for each config.
+# Results print as a table, and with --out-dir or --keep they also go to benchmark_results.json along with the session.
+
+python_dir = Path(__file__).resolve().parent
+experiments_dir = python_dir.parent.parent
+
+# Experiment configs to benchmark, with the readers that need session_dir overrides.
+benchmark_configs = {
+    "aodr": {
+        "experiment_dir": experiments_dir / "aodr",
+        "experiment": "AODR_experiment_neuropixel_binary.yaml",
+        "readers": ["ttl_reader", "message_reader", "gaze_x_reader", "gaze_y_reader", "pupil_reader"],
+        "phy_reader": "phy_reader",
+    },
+    "dotsRT": {
+        "experiment_dir": experiments_dir / "dotsRT",
+        "experiment": "dotsRT_experiment_behavior.yaml",
+        "readers": ["ttl_reader", "message_reader", "gaze_x_reader", "gaze_y_reader"],
+        "phy_reader": None,
+    },
+}
+
+sample_rate = 30000.0
+first_sample_number = 300000 # recordings rarely start at sample 0
+adc_bit_volts = 0.00015258789 # +/-5V over int16
+gaze_gain = 10.2 # deg per volt, matches OffsetThenGain in the YAMLs
+rex_clock_offset = 1000.0 # Rex client clock minus Open Ephys clock, in seconds
+
+# Event times in seconds from the start of each trial.
+trial_duration = 2.0
+fp_on_time = 0.2
+fix_acq_time = 0.5
+sample_on_time = 0.8
+fp_off_time = 1.3
+saccade_latency = 0.2
+saccade_duration = 0.04
+
+
+def rex_value(value: float, scale: float = 0.1, base: int = 7000) -> int:
+    # Inverse of RenameRescaleEnhancer for "value" ecodes with a base and scale.
+    return int(round(value / scale)) + base
+
+
+def write_npy_events(events_dir: Path, sample_numbers: np.ndarray, **arrays) -> None:
+    events_dir.mkdir(parents=True, exist_ok=True)
+    np.save(events_dir / "sample_numbers.npy", sample_numbers.astype(np.int64))
+    np.save(events_dir / "timestamps.npy", sample_numbers / sample_rate)
+    for name, array in arrays.items():
+        np.save(events_dir / f"{name}.npy", array)
+
+
+def make_trial_plan(trial_count: int, rng: np.random.Generator) -> dict[str, np.ndarray]:
+    """Choose start times, targets, and saccades for each synthetic trial."""
+    inter_trial = rng.uniform(0.3, 0.8, size=trial_count)
+    durations = trial_duration + inter_trial
+    start_times = 1.0 + np.concatenate([[0.0], np.cumsum(durations[:-1])])
+    angles = rng.choice(np.arange(0, 360, 45), size=trial_count)
+    amplitudes = rng.choice([8.0, 10.0, 12.0], size=trial_count)
+    return {
+        "start_times": start_times,
+        "session_duration": start_times[-1] + durations[-1] + 1.0,
+        "t1_x": amplitudes * np.cos(np.deg2rad(angles)),
+        "t1_y": amplitudes * np.sin(np.deg2rad(angles)),
+        "saccade_starts": start_times + fp_off_time + saccade_latency + rng.uniform(-0.05, 0.05, size=trial_count),
+    }
+
+
+def write_continuous(continuous_dir: Path, plan: dict[str, np.ndarray], rng: np.random.Generator, chunk_seconds: float = 60.0) -> int:
+    """Write ADC1-3 for gaze x, gaze y, and pupil to continuous.dat, a chunk at a time."""
+    continuous_dir.mkdir(parents=True, exist_ok=True)
+    sample_count = int(plan["session_duration"] * sample_rate)
+    chunk_size = int(chunk_seconds * sample_rate)
+    ramp_size = int(saccade_duration * sample_rate)
+    ramp = np.arange(ramp_size) / ramp_size
+    ramp = 10 * ramp**3 - 15 * ramp**4 + 6 * ramp**5 # minimum jerk profile
+
+    # Eye position in deg: at the fixation point, then on the target from the saccade until the trial ends.
+    saccade_samples = np.round(plan["saccade_starts"] * sample_rate).astype(np.int64)
+    end_samples = np.round((plan["start_times"] + trial_duration) * sample_rate).astype(np.int64)
+
+    pupil_level = 2.0
+    with open(continuous_dir / "continuous.dat", "wb") as f:
+        for chunk_start in range(0, sample_count, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, sample_count)
+            gaze = np.zeros((chunk_end - chunk_start, 2))
+            in_chunk = np.flatnonzero((saccade_samples < chunk_end) & (end_samples > chunk_start))
+            for trial in in_chunk:
+                target = (plan["t1_x"][trial], plan["t1_y"][trial])
+                for channel in range(2):
+                    on_target = slice(max(saccade_samples[trial], chunk_start) - chunk_start, min(end_samples[trial], chunk_end) - chunk_start)
+                    gaze[on_target, channel] = target[channel]
+                    ramp_start = saccade_samples[trial] - chunk_start
+                    ramp_slice = slice(max(ramp_start, 0), min(ramp_start + ramp_size, gaze.shape[0]))
+                    gaze[ramp_slice, channel] = target[channel] * ramp[ramp_slice.start - ramp_start:ramp_slice.stop - ramp_start]
+            gaze += rng.normal(0, 0.02, size=gaze.shape)
+
+            pupil = pupil_level + np.cumsum(rng.normal(0, 1e-4, size=gaze.shape[0]))
+            pupil_level = pupil[-1]
+
+            volts = np.column_stack([gaze / gaze_gain, pupil])
+            np.round(volts / adc_bit_volts).astype(np.int16).tofile(f)
+
+    write_npy_events(continuous_dir, first_sample_number + np.arange(sample_count))
+    return sample_count
+
+
+def write_ttl_and_messages(events_dir: Path, plan: dict[str, np.ndarray], rng: np.random.Generator) -> None:
+    """Write TTL lines 1 and 2 and the Rex UDP messages for each trial."""
+    start_times = plan["start_times"]
+    ttl_times = np.concatenate([start_times, start_times + trial_duration, start_times + fp_on_time, start_times + trial_duration])
+    ttl_states = np.concatenate([np.full_like(start_times, 1), np.full_like(start_times, -1), np.full_like(start_times, 2), np.full_like(start_times, -2)])
+    order = np.argsort(ttl_times, kind="stable")
+    ttl_samples = first_sample_number + np.round(ttl_times[order] * sample_rate).astype(np.int64)
+    ttl_states = ttl_states[order].astype(np.int16)
+    write_npy_events(
+        events_dir / "Acquisition_Board-100.acquisition_board" / "TTL",
+        ttl_samples,
+        states=ttl_states,
+        full_words=np.where(ttl_states > 0, 1 << (np.abs(ttl_states) - 1), 0).astype(np.uint64)
+    )
+
+    # Messages arrive at Open Ephys a little after Rex sends them, and carry Rex's own timestamp and a soft sample number.
+    messages = []
+    def send(oe_time: float, text: str) -> None:
+        rex_time = oe_time + rex_clock_offset
+        sample_number = first_sample_number + int(round(oe_time * sample_rate))
+        messages.append((oe_time + rng.uniform(0, 0.0005), f"{text}@{rex_time:.6f}={sample_number}"))
+
+    for trial, start_time in enumerate(start_times):
+        saccade_end = plan["saccade_starts"][trial] + saccade_duration
+        messages.append((start_time + rng.uniform(0, 0.0005), f"UDP Events sync on line 1@{start_time + rex_clock_offset:.6f}={first_sample_number + int(round(start_time * sample_rate))}"))
+        send(start_time + 0.001, "name=1005|type=unsigned long")
+        send(start_time + 0.002, f"name=8033|value={rex_value(1, scale=1)}|type=unsigned long")
+        send(start_time + 0.003, f"name=8017|value={rex_value(trial % 1000, scale=1)}|type=unsigned long")
+        send(start_time + 0.004, f"name=8001|value={rex_value(0)}|type=unsigned long")
+        send(start_time + 0.005, f"name=8002|value={rex_value(0)}|type=unsigned long")
+        send(start_time + 0.006, f"name=8008|value={rex_value(plan['t1_x'][trial])}|type=unsigned long")
+        send(start_time + 0.007, f"name=8009|value={rex_value(plan['t1_y'][trial])}|type=unsigned long")
+        send(start_time + fp_on_time, "name=1010|type=unsigned long")
+        send(start_time + fix_acq_time, "name=4913|type=unsigned long")
+        send(start_time + sample_on_time, "name=4930|type=unsigned long")
+        send(start_time + fp_off_time, "name=1025|type=unsigned long")
+        send(saccade_end + 0.05, "name=4919|type=unsigned long")
+        send(saccade_end + 0.3, "name=4905|type=unsigned long")
+        send(start_time + trial_duration, "name=4904|type=unsigned long")
+
+    messages.sort()
+    message_times = np.array([message[0] for message in messages])
+    write_npy_events(
+        events_dir / "MessageCenter",
+        first_sample_number + np.round(message_times * sample_rate).astype(np.int64),
+        text=np.array([message[1].encode() for message in messages])
+    )
+
+
+def write_phy(phy_dir: Path, session_duration: float, rng: np.random.Generator, cluster_count: int = 32) -> Path:
+    """Write just enough Kilosort/phy output for the phy_reader: Poisson spikes for a few good and mua clusters."""
+    phy_dir.mkdir(parents=True, exist_ok=True)
+    rates = rng.uniform(2, 20, size=cluster_count)
+    spike_counts = rng.poisson(rates * session_duration)
+    spike_clusters = np.repeat(np.arange(cluster_count), spike_counts)
+    spike_times = rng.integers(0, int(session_duration * sample_rate), size=spike_clusters.size)
+    order = np.argsort(spike_times, kind="stable")
+    np.save(phy_dir / "spike_times.npy", spike_times[order].astype(np.uint64))
+    np.save(phy_dir / "spike_clusters.npy", spike_clusters[order].astype(np.uint32))
+    np.save(phy_dir / "spike_templates.npy", spike_clusters[order].astype(np.uint32))
+    np.save(phy_dir / "amplitudes.npy", rng.uniform(10, 50, size=spike_clusters.size))
+
+    groups = np.where(np.arange(cluster_count) % 4 == 3, "mua", "good")
+    with open(phy_dir / "cluster_group.tsv", "w") as f:
+        f.write("cluster_id\tgroup\n")
+        f.writelines(f"{cluster}\t{group}\n" for cluster, group in enumerate(groups))
+    with open(phy_dir / "cluster_info.tsv", "w") as f:
+        f.write("cluster_id\tAmplitude\tContamPct\tKSLabel\tamp\tch\tdepth\tfr\tgroup\tn_spikes\n")
+        for cluster, group in enumerate(groups):
+            f.write(f"{cluster}\t30.0\t5.0\t{group}\t30.0\t{cluster}\t{20 * cluster}\t{rates[cluster]:.3f}\t{group}\t{spike_counts[cluster]}\n")
+
+    params_file = phy_dir / "params.py"
+    params_file.write_text(
+        "dat_path = 'recording.dat'\n"
+        f"n_channels_dat = {cluster_count}\n"
+        "dtype = 'int16'\n"
+        "offset = 0\n"
+        f"sample_rate = {sample_rate}\n"
+        "hp_filtered = True\n"
+    )
+    return params_file
+
+
+def write_synthetic_session(session_dir: Path, trial_count: int = 300, with_phy: bool = True, seed: int = 42) -> dict[str, object]:
+    """Write a synthetic Open Ephys binary session, and optionally phy output, with the given number of trials.
+
+    Args:
+        session_dir:    Session folder to create, like the ones under Raw/.  Any existing folder is replaced.
+        trial_count:    How many trials to generate, each about 2.5 seconds.
+        with_phy:       Whether to also write phy output to <session_dir>_phy/.
+        seed:           Random seed, so the same arguments give the same session.
+    """
+    if session_dir.exists():
+        shutil.rmtree(session_dir)
+    rng = np.random.default_rng(seed)
+    plan = make_trial_plan(trial_count, rng)
+
+    recording_dir = session_dir / "Record Node 101" / "experiment1" / "recording1"
+    stream_folder = "Acquisition_Board-100.acquisition_board"
+    sample_count = write_continuous(recording_dir / "continuous" / stream_folder, plan, rng)
+    write_ttl_and_messages(recording_dir / "events", plan, rng)
+
+    channels = [
+        {
+            "channel_name": f"ADC{number}",
+            "description": "ADC data channel",
+            "identifier": "",
+            "history": "Acquisition Board",
+            "bit_volts": adc_bit_volts,
+            "units": "V",
+            "source_processor_index": number - 1,
+            "recorded_processor_index": number - 1,
+        }
+        for number in [1, 2, 3]
+    ]
+    structure = {
+        "GUI version": "0.6.7",
+        "continuous": [{
+            "folder_name": stream_folder + "/",
+            "sample_rate": sample_rate,
+            "source_processor_name": "Acquisition Board",
+            "source_processor_id": 100,
+            "stream_name": "acquisition_board",
+            "recorded_processor": "Acquisition Board",
+            "recorded_processor_id": 100,
+            "num_channels": len(channels),
+            "channels": channels,
+        }],
+        "events": [
+            {
+                "folder_name": stream_folder + "/TTL/",
+                "channel_name": "TTL Input",
+                "description": "TTL Events from Acquisition Board",
+                "identifier": "",
+                "sample_rate": sample_rate,
+                "type": "int16",
+                "num_channels": 8,
+                "source_processor": "Acquisition Board",
+                "stream_name": "acquisition_board",
+            },
+            {
+                "folder_name": "MessageCenter/",
+                "channel_name": "Messages",
+                "description": "Broadcasts messages from the MessageCenter",
+                "identifier": "messagecenter.events",
+                "sample_rate": sample_rate,
+                "type": "string",
+                "num_channels": 1,
+                "source_processor": "Message Center",
+                "stream_name": "acquisition_board",
+            },
+        ],
+        "spikes": [],
+    }
+    with open(recording_dir / "structure.oebin", "w") as f:
+        json.dump(structure, f, indent=2)
+
+    params_file = None
+    if with_phy:
+        params_file = write_phy(Path(f"{session_dir}_phy"), plan["session_duration"], rng)
+
+    return {
+        "session_dir": session_dir,
+        "params_file": params_file,
+        "trial_count": trial_count,
+        "session_minutes": plan["session_duration"] / 60,
+        "sample_count": sample_count,
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def run_conversion(config_name: str, session_dir: str, params_file: str, trial_file: str) -> dict[str, object]:
+    """Convert one session with one config, in the current process, and return timing and memory stats."""
+    config = benchmark_configs[config_name]
+    os.chdir(config["experiment_dir"]) # YAMLs use paths relative to the experiment directory
+    sys.path.append(str(config["experiment_dir"] / "python"))
+
+    from pyramid import cli
+    from pyramid.trials.trial_file import TrialFile
+
+    reader_args = [f"{reader}.session_dir={session_dir}" for reader in config["readers"]]
+    if config["phy_reader"] is not None:
+        reader_args.append(f"{config['phy_reader']}.params_file={params_file}")
+
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    cli.main(["convert",
+        "--trial-file", trial_file,
+        "--search-path", str(config["experiment_dir"] / "ecodes"),
+        "--experiment", config["experiment"],
+        "--readers", *reader_args])
+    wall_s = time.perf_counter() - start_wall
+    cpu_s = time.process_time() - start_cpu
+
+    with TrialFile.from_file_name(trial_file) as f:
+        converted_count = sum(1 for _ in f.read_trials())
+
+    return {
+        "config": config_name,
+        "trials": converted_count,
+        "wall_s": wall_s,
+        "cpu_s": cpu_s,
+        "trials_per_s": converted_count / wall_s,
+        "peak_rss_mb": peak_rss_mb(),
+        "trial_file_mb": os.path.getsize(trial_file) / 1024 / 1024,
+    }
+
+
+def run_conversion_in_process(config_name: str, session_dir: str, params_file: str, trial_file: str) -> dict[str, object]:
+    # A fresh process per conversion gives each config its own peak RSS and its own module imports
+    # (aodr/python and dotsRT/python both have a udp_events.py, for example).
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_conversion, (config_name, session_dir, params_file, trial_file))
+
+
+def main(argv: list[str] = None) -> list[dict[str, object]]:
+    parser = argparse.ArgumentParser(description="Time pyramid conversion on synthetic Open Ephys sessions.")
+    parser.add_argument("--trials", type=int, default=300, help="number of trials in the synthetic session")
+    parser.add_argument("--configs", nargs="+", default=list(benchmark_configs.keys()), choices=list(benchmark_configs.keys()), help="experiment configs to convert")
+    parser.add_argument("--repeats", type=int, default=1, help="conversions per config, to average out noise")
+    parser.add_argument("--out-dir", default=None, help="where to write the session and trial files (default: a temp dir)")
+    parser.add_argument("--no-phy", action="store_true", help="skip phy output and configs that need it")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic session and trial files")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the synthetic session")
+    cli_args = parser.parse_args(argv)
+
+    if cli_args.out_dir is None:
+        import tempfile
+        out_dir = Path(tempfile.mkdtemp(prefix="pyramid_benchmark_"))
+    else:
+        out_dir = Path(cli_args.out_dir).resolve()
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+    start_time = time.perf_counter()
+    session = write_synthetic_session(out_dir / "Synthetic_2000-01-01_00-00-00", cli_args.trials, not cli_args.no_phy, cli_args.seed)
+    print(f"Wrote {session['trial_count']} trials ({session['session_minutes']:.1f} min) to {session['session_dir']} in {time.perf_counter() - start_time:.1f}s")
+
+    results = []
+    for config_name in cli_args.configs:
+        if benchmark_configs[config_name]["phy_reader"] is not None and session["params_file"] is None:
+            print(f"Skipping {config_name}, which needs phy output.")
+            continue
+        for repeat in range(cli_args.repeats):
+            trial_file = str(out_dir / f"{config_name}_{repeat}.hdf5")
+            result = run_conversion_in_process(config_name, str(session["session_dir"]), str(session["params_file"]), trial_file)
+            result["repeat"] = repeat
+            results.append(result)
+            if result["trials"] != session["trial_count"]:
+                print(f"Warning: {config_name} converted {result['trials']} trials but the session has {session['trial_count']}.")
+
+    print(f"{'config':<10}{'trials':>8}{'wall s':>10}{'cpu s':>10}{'trials/s':>10}{'peak MB':>10}{'file MB':>10}")
+    for result in results:
+        print(f"{result['config']:<10}{result['trials']:>8}{result['wall_s']:>10.2f}{result['cpu_s']:>10.2f}{result['trials_per_s']:>10.1f}{result['peak_rss_mb']:>10.1f}{result['trial_file_mb']:>10.1f}")
+
+    with open(out_dir / "benchmark_results.json", "w") as f:
+        json.dump({"trials": session["trial_count"], "session_minutes": session["session_minutes"], "results": results}, f, indent=2)
+
+    if cli_args.keep or cli_args.out_dir is not None:
+        print(f"Results and files are in {out_dir}")
+    else:
+        shutil.rmtree(out_dir)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+# Usage:
+# Measure how long it takes to import AODR_session_sorters, compared to importing everything it used to import at the top.
+# In a terminal, activate the gold_pipelines environment, cd to this directory, and run:
+#   python benchmark_imports.py
+#   python benchmark_imports.py --repeats 10 --top 15
+#
+# Each import runs in a fresh python process, so nothing is cached in sys.modules between runs
+# (the OS file cache still helps after the first run, so the first run is usually the slowest).
+
+python_dir = Path(__file__).resolve().parent
+
+# What AODR_session_sorters imported at module level before the heavy imports moved into its methods.
+eager_imports = [
+    "spikeinterface.full",
+    "spikeinterface_gui",
+    "spikeinterface.extractors",
+    "spikeinterface.preprocessing",
+    "spikeinterface.sorters",
+    "spikeinterface.postprocessing",
+    "spikeinterface.qualitymetrics",
+    "spikeinterface.exporters",
+    "spikeinterface.curation",
+    "spikeinterface.widgets",
+    "spikeinterface.sortingcomponents",
+    "probeinterface",
+    "matplotlib.pyplot",
+    "open_ephys.analysis",
+]
+
+benchmarks = {
+    "lazy": "import AODR_session_sorters",
+    "eager": "\n".join(f"try:\n    import {module}\nexcept ImportError:\n    pass" for module in eager_imports) + "\nimport AODR_session_sorters",
+}
+
+
+def time_import(code: str) -> float:
+    # Time in a subprocess, from just before the imports to just after.
+    timed_code = f"import time\nstart = time.perf_counter()\n{code}\nprint(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", timed_code], cwd=python_dir, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(code: str, top: int) -> list[tuple[float, str]]:
+    # Parse python -X importtime output, which goes to stderr like: "import time:  self [us] | cumulative | imported package"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=python_dir, capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        (_, cumulative, module) = line[len("import time:"):].split("|")
+        if not module.startswith(" ") or module.startswith("  "):
+            continue # only top-level imports, not their dependencies
+        times.append((int(cumulative) / 1e6, module.strip()))
+    return sorted(times, reverse=True)[:top]
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare import time of AODR_session_sorters with and without its old eager imports.")
+    parser.add_argument("--repeats", type=int, default=5, help="fresh processes per benchmark")
+    parser.add_argument("--top", type=int, default=10, help="how many of the slowest top-level imports to list")
+    cli_args = parser.parse_args(argv)
+
+    medians = {}
+    for name, code in benchmarks.items():
+        times = [time_import(code) for _ in range(cli_args.repeats)]
+        medians[name] = statistics.median(times)
+        print(f"{name:<6} median {medians[name]:.3f}s  min {min(times):.3f}s  max {max(times):.3f}s  ({cli_args.repeats} runs)")
+    print(f"lazy imports start {medians['eager'] / medians['lazy']:.1f}x faster, saving {medians['eager'] - medians['lazy']:.3f}s per script\n")
+
+    for name, code in benchmarks.items():
+        print(f"Slowest top-level imports, {name}:")
+        for seconds, module in slowest_imports(code, cli_args.top):
+            print(f"  {seconds:8.3f}s  {module}")
+
+
+if __name__ == "__main__":
+    main()
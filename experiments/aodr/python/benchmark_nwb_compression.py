@@ -0,0 +1,143 @@
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from trim_rec import trim_recording, default_continuous_name, default_ttl_name, default_messages_name
+
+# Usage:
+# Compare HDF5 chunking and compression options for trim_rec.py output: file size, write speed, and read speed with spikeinterface.
+# In a terminal, activate the gold_pipelines environment, cd to this directory, and run:
+#   python benchmark_nwb_compression.py                                     # 60s synthetic 32 channel recording
+#   python benchmark_nwb_compression.py --seconds 300 --channels 64
+#   python benchmark_nwb_compression.py --input "Raw/MrM_2025-09-26_13-28-03/Record Node 107/experiment1.nwb" --end 600
+#
+# Real data is better than synthetic, since how well it compresses depends on the noise and spikes in the signal.
+# The synthetic recording is int16 band-limited noise with occasional spikes, about like a 0.195 uV/bit Intan headstage.
+#
+# Reads go through spikeinterface's read_nwb_recording, like AODR_session_sorters.py, in 1s blocks of all channels (like
+# preprocessing and sorting do) and in 1s blocks of 4 channels (like looking at a few channels in a viewer).
+
+# name: trim_recording keyword args
+layouts = {
+    "uncompressed": {"compression": None},
+    "lzf": {"compression": "lzf", "shuffle": False},
+    "lzf+shuffle": {"compression": "lzf", "shuffle": True},
+    "gzip1+shuffle": {"compression": "gzip", "compression_level": 1, "shuffle": True},
+    "gzip4": {"compression": "gzip", "compression_level": 4, "shuffle": False},
+    "gzip4+shuffle": {"compression": "gzip", "compression_level": 4, "shuffle": True},
+    "gzip4+shuffle 0.1s chunks": {"compression": "gzip", "compression_level": 4, "shuffle": True, "chunk_rows": 3000},
+    "gzip4+shuffle 16ch chunks": {"compression": "gzip", "compression_level": 4, "shuffle": True, "chunk_channels": 16},
+    "gzip9+shuffle": {"compression": "gzip", "compression_level": 9, "shuffle": True},
+}
+
+
+def write_synthetic_nwb(file_path: str, seconds: float, channels: int, sample_rate: float = 30000.0):
+    # Write a recording that looks like the Open Ephys NWB output trim_rec.py expects.
+    from pynwb import NWBHDF5IO, NWBFile, TimeSeries
+    from pynwb.misc import AnnotationSeries
+    from pynwb.ecephys import ElectricalSeries
+
+    rng = np.random.default_rng(0)
+    sample_count = int(seconds * sample_rate)
+
+    # Smooth the noise a bit so neighboring samples are correlated, like real band-limited signals.
+    noise = rng.normal(0, 40, (sample_count + 8, channels))
+    samples = np.cumsum(noise, axis=0)
+    samples = (samples[8:] - samples[:-8]) / 8 * 3
+    spike_rows = rng.integers(0, sample_count - 30, int(seconds * 20))
+    spike_shape = -400 * np.exp(-((np.arange(30) - 8) / 3.0) ** 2)
+    for row in spike_rows:
+        samples[row:row + 30, rng.integers(0, channels)] += spike_shape
+    samples = np.clip(samples, -32768, 32767).astype(np.int16)
+
+    nwb = NWBFile(
+        session_description="synthetic recording for benchmark_nwb_compression.py",
+        identifier="benchmark",
+        session_start_time=datetime.datetime.now(datetime.timezone.utc),
+    )
+    device = nwb.create_device(name="Acquisition Board")
+    group = nwb.create_electrode_group(name="0", description="synthetic", location="unknown", device=device)
+    for channel in range(channels):
+        nwb.add_electrode(group=group, location="unknown", x=0.0, y=float(channel * 20), z=0.0)
+    nwb.add_acquisition(ElectricalSeries(
+        name=default_continuous_name,
+        data=samples,
+        timestamps=np.arange(sample_count) / sample_rate,
+        electrodes=nwb.create_electrode_table_region(list(range(channels)), "all channels"),
+        channel_conversion=np.full(channels, 0.195),
+    ))
+    ttl_times = np.arange(0, seconds, 1.0)
+    nwb.add_acquisition(TimeSeries(name=default_ttl_name, data=np.ones(ttl_times.size, dtype=int), timestamps=ttl_times, unit="n/a"))
+    nwb.add_acquisition(AnnotationSeries(name=default_messages_name, data=["sync"] * ttl_times.size, timestamps=ttl_times))
+    with NWBHDF5IO(file_path, "w") as io:
+        io.write(nwb)
+
+
+def time_reads(file_path: str, continuous_name: str, block_samples: int = 30000, channel_count: int = None, max_blocks: int = 120) -> float:
+    # Read 1s blocks front to back with spikeinterface and return MB/s of samples read.
+    import spikeinterface.extractors as se
+
+    recording = se.read_nwb_recording(file_path=file_path, electrical_series_path=f"acquisition/{continuous_name}")
+    channel_ids = recording.channel_ids if channel_count is None else recording.channel_ids[:channel_count]
+    frame_count = min(recording.get_num_samples(), block_samples * max_blocks)
+    start = time.perf_counter()
+    bytes_read = 0
+    for start_frame in range(0, frame_count, block_samples):
+        traces = recording.get_traces(start_frame=start_frame, end_frame=min(start_frame + block_samples, frame_count), channel_ids=channel_ids)
+        bytes_read += traces.nbytes
+    return bytes_read / 1e6 / (time.perf_counter() - start)
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare HDF5 chunking and compression options for trimmed NWB recordings.")
+    parser.add_argument("--input", default=None, help="NWB recording to trim, instead of a synthetic one")
+    parser.add_argument("--start", type=float, default=None, help="start time in seconds to trim --input from")
+    parser.add_argument("--end", type=float, default=None, help="end time in seconds to trim --input to (keep this short-ish, it's trimmed once per layout)")
+    parser.add_argument("--seconds", type=float, default=60.0, help="length of the synthetic recording")
+    parser.add_argument("--channels", type=int, default=32, help="channels in the synthetic recording")
+    parser.add_argument("--continuous", default=default_continuous_name, help="name of the continuous ElectricalSeries")
+    parser.add_argument("--out-dir", default=None, help="where to write trimmed files and benchmark_nwb_compression.json (default a temp dir)")
+    cli_args = parser.parse_args(argv)
+
+    out_dir = Path(cli_args.out_dir or tempfile.mkdtemp(prefix="nwb_compression_"))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    input_path = cli_args.input
+    if input_path is None:
+        input_path = str(out_dir / "synthetic.nwb")
+        print(f"Writing {cli_args.seconds}s synthetic recording with {cli_args.channels} channels to {input_path}")
+        write_synthetic_nwb(input_path, cli_args.seconds, cli_args.channels)
+
+    results = []
+    for name, options in layouts.items():
+        output_path = str(out_dir / (name.replace(" ", "_").replace("+", "_") + ".nwb"))
+        start = time.perf_counter()
+        trim_recording(input_path, output_path, cli_args.start, cli_args.end, continuous_name=cli_args.continuous, **options)
+        write_seconds = time.perf_counter() - start
+        results.append({
+            "layout": name,
+            "options": options,
+            "size_mb": os.path.getsize(output_path) / 1e6,
+            "write_s": write_seconds,
+            "read_all_mb_s": time_reads(output_path, cli_args.continuous),
+            "read_4ch_mb_s": time_reads(output_path, cli_args.continuous, channel_count=4),
+        })
+
+    baseline = results[0]["size_mb"]
+    print(f"\n{'layout':<28}{'size MB':>10}{'ratio':>8}{'write s':>10}{'read all MB/s':>15}{'read 4ch MB/s':>15}")
+    for result in results:
+        result["ratio"] = baseline / result["size_mb"]
+        print(f"{result['layout']:<28}{result['size_mb']:>10.1f}{result['ratio']:>8.2f}{result['write_s']:>10.2f}{result['read_all_mb_s']:>15.1f}{result['read_4ch_mb_s']:>15.1f}")
+
+    with open(out_dir / "benchmark_nwb_compression.json", "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"\nTrimmed files and benchmark_nwb_compression.json are in {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any
+
+import yaml
+
+# Track what each converted trial file was made from, so batch runs can re-convert only sessions whose inputs changed.
+#
+# For each output trial file the manifest records two fingerprints:
+#   - session: the size and mtime of every file in the session folder, plus optional content hashes
+#   - config: content hashes of the experiment YAML, the ecode rule CSVs, and the local python modules the YAML uses
+#
+# See Pyramid_Batch_OE.py for how this is used.
+
+
+def hash_file(file_path: str, block_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_entries(entries: list[Any]) -> str:
+    return hashlib.sha256(json.dumps(entries, sort_keys=True).encode()).hexdigest()
+
+
+def session_fingerprint(session_path: str, hash_contents: bool = False) -> str:
+    """Fingerprint a session folder (or single file) from each file's relative path, size, and mtime.
+
+    Args:
+        session_path:   Session folder or file to fingerprint.
+        hash_contents:  Whether to also hash the contents of every file.  This catches changes that keep
+                        the same size and mtime, but it reads the whole session, so it's slow for big sessions.
+    """
+    session_path = Path(session_path)
+    if session_path.is_file():
+        files = [session_path]
+    else:
+        files = sorted(path for path in session_path.rglob("*") if path.is_file())
+
+    entries = []
+    for file_path in files:
+        stat = file_path.stat()
+        entry = [file_path.relative_to(session_path).as_posix() if file_path != session_path else file_path.name, stat.st_size, stat.st_mtime_ns]
+        if hash_contents:
+            entry.append(hash_file(file_path))
+        entries.append(entry)
+    return hash_entries(entries)
+
+
+def find_yaml_modules(experiment_yaml: str) -> set[str]:
+    # Top-level module names of all the classes in the YAML, like "AODR_custom_enhancers" or "pyramid".
+    with open(experiment_yaml) as f:
+        experiment = yaml.safe_load(f)
+
+    modules = set()
+    def visit(node):
+        if isinstance(node, dict):
+            class_name = node.get("class", None)
+            if isinstance(class_name, str):
+                modules.add(class_name.split(".")[0])
+            for value in node.values():
+                visit(value)
+        elif isinstance(node, list):
+            for value in node:
+                visit(value)
+    visit(experiment)
+    return modules
+
+
+def find_local_modules(module_names: set[str], python_dir: str) -> list[Path]:
+    """Find the .py files in python_dir for the given modules, and any other local modules those import."""
+    python_dir = Path(python_dir)
+    found = {}
+    to_visit = list(module_names)
+    while to_visit:
+        module_name = to_visit.pop()
+        module_path = python_dir / f"{module_name}.py"
+        if module_name in found or not module_path.is_file():
+            continue
+        found[module_name] = module_path
+        imports = re.findall(r"^\s*(?:from|import)\s+([A-Za-z_]\w*)", module_path.read_text(), flags=re.MULTILINE)
+        to_visit.extend(imports)
+    return sorted(found.values())
+
+
+def config_fingerprint(experiment_yaml: str, search_path: str, python_dir: str) -> str:
+    """Fingerprint the contents of the experiment YAML, ecode rule CSVs in search_path, and local python modules used by the YAML."""
+    files = [Path(experiment_yaml)]
+    files += sorted(Path(search_path).glob("*.csv"))
+    files += find_local_modules(find_yaml_modules(experiment_yaml), python_dir)
+    return hash_entries([[file_path.name, hash_file(file_path)] for file_path in files])
+
+
+class ConversionManifest():
+    """JSON file recording the session and config fingerprints each output trial file was converted from.
+
+    Args:
+        manifest_file:  Where to read and write the manifest, like <baseSaveDir>/conversion_manifest.json.
+    """
+
+    def __init__(self, manifest_file: str) -> None:
+        self.manifest_file = manifest_file
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def check(self, output_file: str, session: str, config: str, adopt_unknown: bool = False) -> str:
+        """Return the reason output_file needs converting, or None if it's up to date.
+
+        With adopt_unknown=True, an existing output file with no manifest entry is assumed to be up to date
+        and recorded as such -- this is for outputs from before we had a manifest.
+        """
+        if not os.path.exists(output_file):
+            return "no output file"
+        entry = self.entries.get(os.path.basename(output_file), None)
+        if entry is None:
+            if adopt_unknown:
+                self.record(output_file, session, config)
+                return None
+            return "not in manifest"
+        if entry["output_size"] != os.path.getsize(output_file):
+            return "output file changed"
+        if entry["session"] != session:
+            return "session files changed"
+        if entry["config"] != config:
+            return "YAML, ecodes, or python modules changed"
+        return None
+
+    def record(self, output_file: str, session: str, config: str) -> None:
+        self.entries[os.path.basename(output_file)] = {
+            "session": session,
+            "config": config,
+            "output_size": os.path.getsize(output_file),
+            "converted": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+    def forget(self, output_file: str) -> None:
+        self.entries.pop(os.path.basename(output_file), None)
+
+    def save(self) -> None:
+        # Write to a temp file first so an interrupted run can't leave a truncated manifest.
+        temp_file = self.manifest_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(temp_file, self.manifest_file)
@@ -0,0 +1,273 @@
+import csv
+import importlib
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import yaml
+
+from pyramid.trials.trials import Trial, TrialEnhancer, TrialCollecter
+
+# Profile the enhancer and collecter chains of a conversion by turning on a flag in the experiment YAML:
+#
+#  trials:
+#    profile_enhancers: True # wall time, CPU time, and peak allocation per enhancer/collecter per trial
+#    profile_memory: True    # optional, set False to skip tracing allocations, which slows things down a bit
+#    enhancers:
+#      ...
+#
+# Only profiled_experiment() reads these flags, not Pyramid, so they only work through scripts that call it,
+# like Pyramid_Batch_OE.py and Kilo4_Neuropixel_Binary_Example.py.  A plain "pyramid convert" doesn't profile.
+#
+#   experiment_yaml = profiled_experiment("AODR_experiment.yaml", search_path=[ecodes_dir])
+#   cli.main(["convert", "--trial-file", trial_file, "--experiment", experiment_yaml, ...])
+#   write_profile_report(trial_file)
+#
+# When the YAML has the flags, profiled_experiment() writes AODR_experiment_profiled.yaml next to the original,
+# without the flags so Pyramid never sees them, and returns its path.  With profile_enhancers: True, the copy has
+# the enhancers nested under one ProfiledEnhancers and the collecters under one ProfiledCollecters.
+# Without the flags it just returns the original path.
+# write_profile_report() writes <trial_file>.enhancer_profile.json and .csv with p50/p95/max per enhancer and collecter.
+
+
+class EnhancerTimings():
+    """Per-trial wall time, CPU time, and peak Python/NumPy allocation for each of several enhancers."""
+
+    def __init__(self) -> None:
+        self.samples = {}
+
+    def clear(self) -> None:
+        self.samples = {}
+
+    def record(self, label: str, wall_s: float, cpu_s: float, peak_bytes: int) -> None:
+        self.samples.setdefault(label, []).append((wall_s, cpu_s, peak_bytes))
+
+    def summary(self) -> list[dict[str, Any]]:
+        rows = []
+        for label, samples in self.samples.items():
+            values = np.array(samples, dtype=np.float64)
+            row = {"enhancer": label, "trials": values.shape[0], "total_wall_s": float(values[:, 0].sum())}
+            for column, (name, scale) in enumerate([("wall_ms", 1e3), ("cpu_ms", 1e3), ("peak_kb", 1 / 1024)]):
+                (p50, p95) = np.percentile(values[:, column], [50, 95]) * scale
+                row[f"{name}_p50"] = float(p50)
+                row[f"{name}_p95"] = float(p95)
+                row[f"{name}_max"] = float(values[:, column].max() * scale)
+            rows.append(row)
+        return rows
+
+    def write(self, json_path: str, csv_path: str = None) -> list[dict[str, Any]]:
+        rows = self.summary()
+        with open(json_path, "w") as f:
+            json.dump(rows, f, indent=2)
+        if csv_path is not None and rows:
+            with open(csv_path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
+        return rows
+
+
+# Shared by all ProfiledEnhancers in this process, so scripts can write a report after cli.main().
+timings = EnhancerTimings()
+
+# Whether ProfiledEnhancers started tracemalloc, so write_profile_report() knows to stop it.
+started_tracing = False
+
+
+def write_profile_report(trial_file: str) -> list[dict[str, Any]]:
+    """Write the enhancer profile summary next to the given trial file, as JSON and CSV, and start over.
+
+    Does nothing when no ProfiledEnhancers recorded anything.
+    """
+    global started_tracing
+    if started_tracing:
+        tracemalloc.stop()
+        started_tracing = False
+
+    if not timings.samples:
+        return []
+    trial_path = Path(trial_file)
+    rows = timings.write(
+        trial_path.with_name(trial_path.name + ".enhancer_profile.json"),
+        trial_path.with_name(trial_path.name + ".enhancer_profile.csv")
+    )
+    for row in rows:
+        logging.info(f"{row['enhancer']}: wall p50 {row['wall_ms_p50']:.3f}ms p95 {row['wall_ms_p95']:.3f}ms max {row['wall_ms_max']:.3f}ms")
+    timings.clear()
+    return rows
+
+
+def profiled_experiment(experiment_yaml: str, search_path: list[str] = None) -> str:
+    """Get the experiment YAML to convert with, which profiles the enhancers and collecters if the YAML has "profile_enhancers: True" under trials.
+
+    Args:
+        experiment_yaml:    Experiment YAML to convert with
+        search_path:        Same folders passed to Pyramid with --search-path, for finding each enhancer's package_path
+
+    Returns experiment_yaml itself when it has no profiling flags.  Otherwise writes a copy next to it, named like
+    AODR_experiment_profiled.yaml, without the flags, and returns the copy's path.  With profile_enhancers: True
+    the copy has the enhancers nested under one ProfiledEnhancers and the collecters under one ProfiledCollecters.
+    """
+    if search_path is None:
+        search_path = []
+    experiment_path = Path(experiment_yaml)
+    with open(experiment_path) as f:
+        experiment = yaml.safe_load(f)
+
+    trials_config = experiment.get("trials") or {}
+    if "profile_enhancers" not in trials_config and "profile_memory" not in trials_config:
+        return experiment_yaml
+    profile = trials_config.pop("profile_enhancers", False)
+    trace_memory = trials_config.pop("profile_memory", True)
+
+    if profile:
+        # Pyramid looks for package_path relative to the experiment YAML's folder, and the --search-path folders.
+        package_search_path = [str(experiment_path.resolve().parent)] + [str(Path(folder).resolve()) for folder in search_path]
+        for (key, class_name) in [("enhancers", "ProfiledEnhancers"), ("collecters", "ProfiledCollecters")]:
+            if trials_config.get(key):
+                trials_config[key] = [{
+                    "class": f"enhancer_profiling.{class_name}",
+                    "package_path": str(Path(__file__).resolve().parent),
+                    "args": {
+                        "enhancers": trials_config[key],
+                        "trace_memory": trace_memory,
+                        "search_path": package_search_path
+                    }
+                }]
+    profiled_path = experiment_path.with_name(experiment_path.stem + "_profiled.yaml")
+    with open(profiled_path, "w") as f:
+        yaml.safe_dump(experiment, f, sort_keys=False)
+    return str(profiled_path)
+
+
+def find_package_path(package_path: str, search_path: list[str] = None) -> str:
+    """Find a package_path from the experiment YAML: as is if absolute, otherwise in the first search_path folder that has it."""
+    if package_path is None or Path(package_path).is_absolute():
+        return package_path
+    for folder in search_path or []:
+        candidate = Path(folder, package_path)
+        if candidate.exists():
+            return str(candidate)
+    return package_path
+
+
+def import_class(class_name: str, package_path: str = None) -> type:
+    """Import a class like "module.submodule.ClassName", possibly from a local package_path."""
+    if package_path is not None and package_path not in sys.path:
+        sys.path.append(package_path)
+    (module_name, _, short_name) = class_name.rpartition(".")
+    return getattr(importlib.import_module(module_name), short_name)
+
+
+class ProfiledEnhancers(TrialEnhancer):
+    """Run a chain of enhancers in order, recording wall time, CPU time, and peak allocation for each one, per trial.
+
+    This is usually set up by profiled_experiment(), above, rather than written into the YAML by hand.
+
+    Args:
+        enhancers:      List of enhancer specs, each a dict with "class", and optional "args", "package_path", and "when", like in the experiment YAML.
+        profile:        Whether to record timings at all (default True).  When False the chain runs as usual with no overhead.
+        trace_memory:   Whether to also trace peak allocation with tracemalloc, which slows things down a bit (default True).
+        search_path:    Folders to look in for relative package_paths, like the experiment YAML's folder (default None -- the working directory).
+    """
+
+    def __init__(
+        self,
+        enhancers: list[dict[str, Any]] = None,
+        profile: bool = True,
+        trace_memory: bool = True,
+        search_path: list[str] = None
+    ) -> None:
+        self.enhancers = []
+        self.labels = []
+        self.whens = []
+        for index, spec in enumerate(enhancers or []):
+            package_path = find_package_path(spec.get("package_path", None), search_path)
+            enhancer_class = import_class(spec["class"], package_path)
+            self.enhancers.append(enhancer_class(**spec.get("args", {})))
+            self.labels.append(f"{index:02d} {enhancer_class.__name__}")
+            # Like Pyramid, only run enhancers with a "when" expression on trials where it's true.
+            when = spec.get("when", None)
+            self.whens.append(None if when is None else (when, compile(when, "<when>", "eval")))
+        self.profile = profile
+        self.trace_memory = trace_memory
+
+    def should_enhance(self, index: int, trial: Trial) -> bool:
+        if self.whens[index] is None:
+            return True
+        (when, expression) = self.whens[index]
+        try:
+            return bool(eval(expression, {}, trial.enhancements))
+        except Exception as e:
+            logging.warning(f"Skipping {self.labels[index]}, error evaluating when: {when}: {e}")
+            return False
+
+    def run(self, index: int, method_name: str, trial: Trial, trial_number: int, experiment_info: dict, subject_info: dict) -> None:
+        """Call one enhancer's enhance() or collect() on the trial, when its "when" is true, recording timings if profiling."""
+        if not self.should_enhance(index, trial):
+            return
+        method = getattr(self.enhancers[index], method_name)
+        if not self.profile:
+            method(trial, trial_number, experiment_info, subject_info)
+            return
+
+        global started_tracing
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            (start_bytes, _) = tracemalloc.get_traced_memory()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+
+        method(trial, trial_number, experiment_info, subject_info)
+
+        wall_s = time.perf_counter() - start_wall
+        cpu_s = time.process_time() - start_cpu
+        if self.trace_memory:
+            (_, peak_bytes) = tracemalloc.get_traced_memory()
+            peak_bytes -= start_bytes
+        else:
+            peak_bytes = 0
+        timings.record(self.label(index, method_name), wall_s, cpu_s, peak_bytes)
+
+    def label(self, index: int, method_name: str) -> str:
+        return self.labels[index]
+
+    def enhance(
+        self,
+        trial: Trial,
+        trial_number: int,
+        experiment_info: dict[str: Any],
+        subject_info: dict[str: Any]
+    ) -> None:
+        for index in range(len(self.enhancers)):
+            self.run(index, "enhance", trial, trial_number, experiment_info, subject_info)
+
+
+class ProfiledCollecters(ProfiledEnhancers, TrialCollecter):
+    """Run a chain of collecters in order, recording timings for each one's collect() and enhance(), per trial.
+
+    This is usually set up by profiled_experiment(), above.  Takes the same args as ProfiledEnhancers,
+    with collecter specs in place of enhancer specs.  Timings are labeled like "collecter 00 TACPCollecter collect".
+    """
+
+    def label(self, index: int, method_name: str) -> str:
+        return f"collecter {self.labels[index]} {method_name}"
+
+    def collect(
+        self,
+        trial: Trial,
+        trial_number: int,
+        experiment_info: dict[str: Any],
+        subject_info: dict[str: Any]
+    ) -> None:
+        for index in range(len(self.enhancers)):
+            self.run(index, "collect", trial, trial_number, experiment_info, subject_info)
@@ -0,0 +1,184 @@
+import json
+import math
+import os
+import tempfile
+
+import numpy as np
+
+# Min/max envelopes of analog data at several levels of decimation, for drawing long recordings quickly without hiding spikes or glitches.
+#
+# Level 0 is the data itself.  Level k has the min and max of each channel over buckets of factor**k samples, computed once from the
+# level below.  To draw a time window, pick the coarsest level that still has about one bucket per screen pixel, and draw each bucket
+# as a vertical min-max segment.  Each redraw then touches about as many points as there are pixels, at any zoom, and any sample
+# that sticks out still shows up as the top or bottom of its bucket.
+#
+# The levels together take about 2 / (factor - 1) as much memory as the data, so they go in temporary memory-mapped files when large.
+# With a cache_dir they go in .npy files there instead, and the next time they're just memory-mapped without reading the data again.
+#
+# The data and timestamps can be lazy, like h5py datasets.  Building the levels reads them front to back a chunk at a time,
+# and after that only the samples in view are read, along with a few timestamps to find them.
+#
+#   pyramid = MinMaxPyramid(data, timestamps)
+#   (t, y, bucket_samples) = pyramid.window(t_start, t_end, max_points=int(ax.bbox.width))
+#   ax.plot(t, y)
+
+
+class MinMaxPyramid:
+    """Multi-level min/max envelopes of 2D analog data (samples x channels).
+
+    Args:
+        data:           Array-like (samples x channels), such as a numpy array or an h5py dataset, read in row chunks
+        timestamps:     Array-like of sample times, the same length as data, read in chunks too
+        factor:         How many buckets of each level go into one bucket of the next level up
+        min_buckets:    Stop adding levels when a level would have fewer buckets than this
+        chunk_samples:  How many samples of data to read at once when building the first level
+        memmap_bytes:   Put levels bigger than this many bytes in temporary memory-mapped files, instead of in memory
+        memmap_dir:     Directory for the temporary memory-mapped files, or None for the system temp dir
+        cache_dir:      Directory to save the levels in and load them from next time, or None to build them every time
+    """
+
+    def __init__(
+        self,
+        data,
+        timestamps,
+        factor: int = 8,
+        min_buckets: int = 2000,
+        chunk_samples: int = 1_000_000,
+        memmap_bytes: int = 64_000_000,
+        memmap_dir: str = None,
+        cache_dir: str = None
+    ):
+        self.data = data
+        self.timestamps = timestamps
+        self.factor = factor
+        self.memmap_bytes = memmap_bytes
+        self.memmap_dir = memmap_dir
+        self.cache_dir = cache_dir
+        (self.sample_count, self.channel_count) = data.shape
+        self.dtype = np.dtype(data.dtype)
+        self.memmap_files = []
+
+        # Each level is (bucket_samples, bucket_times, mins, maxs).
+        self.levels = []
+        if cache_dir is not None and self._load_cache():
+            return
+
+        bucket_samples = factor
+        while math.ceil(self.sample_count / bucket_samples) >= min_buckets:
+            if not self.levels:
+                self.levels.append(self._first_level(chunk_samples))
+            else:
+                self.levels.append(self._next_level(*self.levels[-1]))
+            bucket_samples *= factor
+
+        if cache_dir is not None:
+            self._save_cache()
+
+    def _cache_info(self):
+        return {"sample_count": self.sample_count, "channel_count": self.channel_count, "dtype": self.dtype.str, "factor": self.factor}
+
+    def _load_cache(self) -> bool:
+        info_file = os.path.join(self.cache_dir, "pyramid.json")
+        if not os.path.isfile(info_file):
+            return False
+        with open(info_file) as f:
+            info = json.load(f)
+        if info["data"] != self._cache_info():
+            return False
+        for level, bucket_samples in enumerate(info["bucket_samples"]):
+            arrays = [np.load(os.path.join(self.cache_dir, f"level_{level}_{name}.npy"), mmap_mode="r") for name in ["times", "mins", "maxs"]]
+            self.levels.append((bucket_samples, *arrays))
+        return True
+
+    def _save_cache(self):
+        # Write the marker last, so a half-built cache gets rebuilt.
+        for (_, *arrays) in self.levels:
+            for array in arrays:
+                array.flush()
+        info = {"data": self._cache_info(), "bucket_samples": [level[0] for level in self.levels]}
+        with open(os.path.join(self.cache_dir, "pyramid.json"), "w") as f:
+            json.dump(info, f)
+
+    def _allocate(self, level: int, bucket_count: int):
+        shape = (bucket_count, self.channel_count)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            return tuple(
+                np.lib.format.open_memmap(os.path.join(self.cache_dir, f"level_{level}_{name}.npy"), mode="w+", dtype=dtype, shape=array_shape)
+                for name, dtype, array_shape in [("times", np.float64, (bucket_count,)), ("mins", self.dtype, shape), ("maxs", self.dtype, shape)]
+            )
+        if (2 * self.channel_count * self.dtype.itemsize + 8) * bucket_count <= self.memmap_bytes:
+            return (np.empty(bucket_count, dtype=np.float64), np.empty(shape, dtype=self.dtype), np.empty(shape, dtype=self.dtype))
+        # Keep the temp files open as long as the pyramid, they're deleted when closed.
+        self.memmap_files += [tempfile.TemporaryFile(dir=self.memmap_dir, suffix=".minmax") for _ in range(3)]
+        return (
+            np.memmap(self.memmap_files[-3], dtype=np.float64, mode="w+", shape=(bucket_count,)),
+            np.memmap(self.memmap_files[-2], dtype=self.dtype, mode="w+", shape=shape),
+            np.memmap(self.memmap_files[-1], dtype=self.dtype, mode="w+", shape=shape),
+        )
+
+    def _first_level(self, chunk_samples: int):
+        # Read the data a chunk at a time, so it can be an HDF5 dataset or memmap that doesn't fit in memory.
+        chunk_samples = max(chunk_samples // self.factor, 1) * self.factor
+        (times, mins, maxs) = self._allocate(0, math.ceil(self.sample_count / self.factor))
+        for start in range(0, self.sample_count, chunk_samples):
+            chunk = np.asarray(self.data[start:start + chunk_samples])
+            bucket_starts = np.arange(0, chunk.shape[0], self.factor)
+            first_bucket = start // self.factor
+            buckets = slice(first_bucket, first_bucket + bucket_starts.size)
+            times[buckets] = np.asarray(self.timestamps[start:start + chunk_samples])[::self.factor]
+            mins[buckets] = np.minimum.reduceat(chunk, bucket_starts, axis=0)
+            maxs[buckets] = np.maximum.reduceat(chunk, bucket_starts, axis=0)
+        return (self.factor, times, mins, maxs)
+
+    def _next_level(self, lower_bucket_samples, lower_times, lower_mins, lower_maxs):
+        (times, mins, maxs) = self._allocate(len(self.levels), math.ceil(lower_mins.shape[0] / self.factor))
+        bucket_starts = np.arange(0, lower_mins.shape[0], self.factor)
+        times[:] = lower_times[::self.factor]
+        mins[:] = np.minimum.reduceat(lower_mins, bucket_starts, axis=0)
+        maxs[:] = np.maximum.reduceat(lower_maxs, bucket_starts, axis=0)
+        return (lower_bucket_samples * self.factor, times, mins, maxs)
+
+    def find_sample(self, time: float) -> int:
+        """Like np.searchsorted(timestamps, time), but reading only a bucket's worth of timestamps."""
+        if not self.levels:
+            return int(np.searchsorted(np.asarray(self.timestamps[:]), time, side='left'))
+        # The first level has the time of every factor-th sample, which narrows it down to one bucket.
+        bucket = int(np.searchsorted(self.levels[0][1], time, side='left'))
+        start = max(bucket - 1, 0) * self.factor
+        end = min(bucket * self.factor + 1, self.sample_count)
+        return start + int(np.searchsorted(np.asarray(self.timestamps[start:end]), time, side='left'))
+
+    def sample_range(self, t_start: float, t_end: float):
+        # Samples with t_start <= time < t_end.
+        start = self.find_sample(t_start)
+        end = self.find_sample(t_end)
+        return (start, max(start, end))
+
+    def window(self, t_start: float, t_end: float, max_points: int = 2000):
+        """Get times and values to plot between t_start and t_end, using about max_points buckets.
+
+        Returns (t, y, bucket_samples), where y has one column per channel.  With bucket_samples == 1 these are the samples themselves.
+        Otherwise each bucket appears twice in a row, at its start time, once with the min and once with the max of each channel.
+        """
+        (start, end) = self.sample_range(t_start, t_end)
+        # Include a sample or bucket on each side, so lines run off the edges of the plot instead of stopping short.
+        start = max(start - 1, 0)
+        end = min(end + 1, self.sample_count)
+
+        # The coarsest level with at least max_points buckets, or the data itself when zoomed in that far.
+        level = None
+        for candidate in self.levels:
+            if (end - start) / candidate[0] >= max_points:
+                level = candidate
+        if level is None:
+            return (np.asarray(self.timestamps[start:end]), np.asarray(self.data[start:end]), 1)
+
+        (bucket_samples, bucket_times, mins, maxs) = level
+        first = start // bucket_samples
+        last = math.ceil(end / bucket_samples)
+        t = np.repeat(bucket_times[first:last], 2)
+        y = np.empty((2 * (last - first), self.channel_count), dtype=self.dtype)
+        y[0::2] = mins[first:last]
+        y[1::2] = maxs[first:last]
+        return (t, y, bucket_samples)
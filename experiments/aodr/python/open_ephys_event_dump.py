@@ -13,6 +13,13 @@
 #   conda activate gold_pipelines
 #   python open_ephys_event_dump.py > events.csv
 #
+# Or give the session and output file on the command line.  A .parquet output is much smaller and faster to load with pandas.
+#
+#   python open_ephys_event_dump.py --directory /path/to/session --output events.csv
+#   python open_ephys_event_dump.py --directory /path/to/session --output events.parquet --end-time 3600
+#
+# The events are already sorted by Open Ephys timestamp, then by stream name, then by stream index (as in the sort described below).
+#
 # Make a new Google Sheet.
 # Import events.csv:
 #   - replace the current sheet
@@ -38,39 +45,99 @@
 #   - text is exactly "1=1" have magenta background
 #   - text contains "UDP Events sync" have purple background
 #
-# Estimate the FIRA trial index that each event would go to.
-#   - cell F1 add header: "approx trial"
-#   - cell F2 add number: 1
-#   - cell F3 add formula: =F2+and(A3="TTL Rhythm Data", E3="1=1")
-#   - fill down column F with this formula
+# Column F "approx trial" estimates the FIRA trial index that each event would go to.
+# It's computed here the same way as this spreadsheet formula we used to fill down from F3, starting at 1 in F2:
+#   =F2+and(A3="TTL Rhythm Data", E3="1=1")
 #
 # Select column F and apply some conditional formatting to distinguish trials:
 #   - custom formula is: =isodd(F1) have gray background
 
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
 from open_ephys.analysis import Session
 
 # Edit this to be your local path to a data session.
 directory = '/Users/lowell/Library/CloudStorage/Box-Box/GoldLab/Data/Physiology/AODR/dlPFC/MrM/Raw/Neuronal/SingleEL/MrM_2025-09-26_13-28-03'
-session = Session(directory)
 
 # Lower this limit if CSV size is unmanageable.
 end_time = 1e6
 
-# Print a CSV header row.
-print("stream name&stream index&timestamp&sample number&data")
-
-# Dump out TTL events.
-recording = session.recordnodes[0].recordings[0]
-ttl_events = recording.events
-for index, row in ttl_events.iterrows():
-    if row.timestamp <= end_time:
-        print(f"TTL {row.stream_name}&{index}&{row.timestamp}&{row.sample_number}&{row.line}={row.state}")
-
-# Dump out text events.
-message_count = len(recording.nwb['acquisition']['messages']['data'])
-for index in range(message_count):
-    text = recording.nwb['acquisition']['messages']['data'][index]
-    timestamp = recording.nwb['acquisition']['messages']['timestamps'][index]
-    sync = recording.nwb['acquisition']['messages']['sync'][index]
-    if timestamp <= end_time:
-        print(f"TEXT&{index}&{timestamp}&{sync}&{text}")
+# Which TTL event starts a new trial, for the "approx trial" column.
+trial_start_stream = "TTL Rhythm Data"
+trial_start_data = "1=1"
+
+columns = ["stream name", "stream index", "timestamp", "sample number", "data"]
+
+
+def ttl_event_table(recording, end_time):
+    # All the TTL events at once, from the DataFrame open_ephys already loaded.
+    ttl_events = recording.events
+    ttl_events = ttl_events[ttl_events.timestamp <= end_time]
+    return pd.DataFrame({
+        "stream name": "TTL " + ttl_events.stream_name.astype(str),
+        "stream index": ttl_events.index,
+        "timestamp": ttl_events.timestamp.to_numpy(),
+        "sample number": ttl_events.sample_number.to_numpy(),
+        "data": ttl_events.line.astype(str) + "=" + ttl_events.state.astype(str),
+    })
+
+
+def text_event_table(recording, end_time):
+    # Read each messages dataset in one go, rather than one HDF5 read per message.
+    messages = recording.nwb['acquisition']['messages']
+    timestamps = messages['timestamps'][:]
+    keep = np.flatnonzero(timestamps <= end_time)
+    return pd.DataFrame({
+        "stream name": "TEXT",
+        "stream index": keep,
+        "timestamp": timestamps[keep],
+        "sample number": messages['sync'][:][keep],
+        "data": messages['data'].asstr(errors='replace')[:][keep],
+    })
+
+
+def event_table(directory, end_time=end_time):
+    """Read TTL and text events from an Open Ephys session into one table, sorted by time.
+
+    Args:
+        directory:  Open Ephys session directory
+        end_time:   Only include events at or before this time
+    """
+    session = Session(directory)
+    recording = session.recordnodes[0].recordings[0]
+    events = pd.concat([ttl_event_table(recording, end_time), text_event_table(recording, end_time)], ignore_index=True)
+
+    # Sort by timestamp, break ties by stream name and stream index.
+    events = events.sort_values(["timestamp", "stream name", "stream index"], kind="stable", ignore_index=True)
+
+    # Count trial starts, like the spreadsheet formula, which starts at 1 and adds trial starts from the second row on.
+    trial_starts = (events["stream name"] == trial_start_stream).to_numpy() & (events["data"] == trial_start_data).to_numpy()
+    trial_starts[:1] = False
+    events["approx trial"] = 1 + np.cumsum(trial_starts)
+    return events
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dump TTL and text events from an Open Ephys session, sorted by time.")
+    parser.add_argument("--directory", default=directory, help="Open Ephys session directory")
+    parser.add_argument("--end-time", type=float, default=end_time, help="only include events at or before this time")
+    parser.add_argument("--output", default=None, help="file to write, .csv (& delimited) or .parquet (needs pyarrow, default: print CSV)")
+    cli_args = parser.parse_args(argv)
+
+    events = event_table(cli_args.directory, cli_args.end_time)
+    if cli_args.output is not None and cli_args.output.endswith(".parquet"):
+        try:
+            events.to_parquet(cli_args.output, index=False)
+        except ImportError as e:
+            # Parquet needs pyarrow or fastparquet, which aren't in environment.yml.
+            parser.error(f"can't write {cli_args.output}, {e}\nInstall pyarrow (pip install pyarrow), or use a .csv --output instead.")
+    else:
+        # "&" avoids conflicts with commas "," and pipes "|" within the event data.
+        events.to_csv(cli_args.output if cli_args.output is not None else sys.stdout, sep="&", index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 import spikeinterface.extractors as se
 import matplotlib.pyplot as plt
 from matplotlib.widgets import SpanSelector
+from matplotlib.collections import LineCollection
 import numpy as np
 from open_ephys.analysis import Session
 from collections import defaultdict
+import hashlib
+import os
+import tempfile
+from minmax_pyramid import MinMaxPyramid
+from stream_lag import stream_lags
+from message_index import MessageIndex
 
 
 # --- CONFIG ---
@@ -11,56 +18,232 @@ NWB_FILE = r"C:\NeuronalData\Raw\MrM_NP_2_2026-01-20_13-52-42\Record Node 107\ex
 SESSION_DIR = r"C:\NeuronalData\Raw\MrM_NP_2_2026-01-20_13-52-42"  # Set this to your Open Ephys session folder
 ANALOG_CHANNELS = [0, 1]  # Acquisition board channels to plot
 WINDOW_SEC = 5.0  # Default view window in seconds
+MAX_LAG_SEC = 0.05  # Largest lag to look for between the acquisition board and NI-DAQ analog streams
+PYRAMID_CACHE_DIR = os.path.join(tempfile.gettempdir(), "analog_pyramids")  # Where to keep min/max overviews and the lag curve between runs, or None to rebuild each time
+ECODE_RULES_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ecodes", "AODR_ecode_rules.csv")  # Ecode names for message categories
 
 # --- LOAD session data ---
 session = Session(SESSION_DIR)
 recording = session.recordnodes[0].recordings[0]
 
+
+class LazyAnalogChannels:
+    """Some channels of an HDF5 (or memmapped binary) samples x channels dataset, read from disk only when sliced.
+
+    Args:
+        samples:    Samples x channels dataset, like recording.nwb['acquisition'][stream]['data']
+        channels:   Which channels (columns) to read
+    """
+
+    def __init__(self, samples, channels):
+        self.samples = samples
+        self.channels = list(channels)
+        # HDF5 wants increasing column indices, so read those and put them back in the requested order.
+        self.sorted_channels = sorted(set(self.channels))
+        self.order = [self.sorted_channels.index(channel) for channel in self.channels]
+        self.shape = (samples.shape[0], len(self.channels))
+        self.dtype = samples.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        (rows, columns) = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(rows, (int, np.integer)):
+            rows = slice(rows, rows + 1 if rows != -1 else None)
+            return self[rows, columns][0]
+        data = np.asarray(self.samples[rows, self.sorted_channels])[:, self.order]
+        return data[:, columns]
+
+
+def pyramid_cache_dir(item, channels):
+    # One cache per file, stream, and channels, which changes if the file does.
+    if PYRAMID_CACHE_DIR is None:
+        return None
+    file_name = recording.nwb.filename
+    file_stat = os.stat(file_name)
+    key = f"{os.path.abspath(file_name)}|{item}|{list(channels)}|{file_stat.st_size}|{file_stat.st_mtime_ns}"
+    return os.path.join(PYRAMID_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def cached_stream_lags(cache_dirs, *args, **kwargs):
+    """Call stream_lags() with the given args, or load its result from last time, saved next to the streams' min/max overviews.
+
+    The lag curve takes a pass over both whole streams, so this keeps startup fast after the first run for each file.
+    cache_dirs are from pyramid_cache_dir() for each stream, which change if the file does.
+    """
+    if PYRAMID_CACHE_DIR is None or None in cache_dirs:
+        return stream_lags(*args, **kwargs)
+    lag_settings = {name: value for name, value in kwargs.items() if name != "progress"}
+    key = f"{list(cache_dirs)}|{sorted(lag_settings.items())}"
+    cache_file = os.path.join(PYRAMID_CACHE_DIR, f"stream_lags_{hashlib.sha1(key.encode()).hexdigest()[:16]}.npz")
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            return {name: cached[name] for name in cached.files}
+
+    lag_result = stream_lags(*args, **kwargs)
+    os.makedirs(PYRAMID_CACHE_DIR, exist_ok=True)
+    # Write then rename, so an interrupted run doesn't leave a partial cache file behind.
+    partial_file = cache_file + ".partial.npz"
+    np.savez(partial_file, **lag_result)
+    os.replace(partial_file, cache_file)
+    return lag_result
+
+
 # --- LOAD ANALOG DATA ---
-# Use recording.nwb['acquisition'] to get analog data and timestamps efficiently
+# Keep lazy handles to the samples and timestamps in recording.nwb['acquisition'], instead of reading them all into memory.
+# The plots read just the samples in view, plus min/max overviews that are built once and cached in PYRAMID_CACHE_DIR.
 analog_data = None
 analog_timestamps = None
 sampling_rate = None
+analog_cache_dir = None
 additional_analog_data = None
 additional_analog_timestamps = None
 additional_sampling_rate = None
+additional_analog_cache_dir = None
 datasets = list(recording.nwb["acquisition"].keys())
 for item in datasets:
     # Acquisition board stream
     if "acquisition_board" in item and "TTL" not in item:
-        cont = recording.Continuous(recording.nwb, item)
-        analog_data = cont.samples[:, ANALOG_CHANNELS]
-        analog_timestamps = cont.timestamps
+        analog_data = LazyAnalogChannels(recording.nwb["acquisition"][item]["data"], ANALOG_CHANNELS)
+        analog_timestamps = recording.nwb["acquisition"][item]["timestamps"]
+        analog_cache_dir = pyramid_cache_dir(item, ANALOG_CHANNELS)
         if len(analog_timestamps) > 1:
-            sampling_rate = 1.0 / np.mean(np.diff(analog_timestamps))
+            sampling_rate = (len(analog_timestamps) - 1) / (analog_timestamps[-1] - analog_timestamps[0])
         else:
             sampling_rate = None
     # NI-DAQmx stream
     elif "PXIe-6363" in item and "TTL" not in item:
-        cont = recording.Continuous(recording.nwb, item)
-        additional_analog_data = cont.samples[:, ANALOG_CHANNELS]
-        additional_analog_timestamps = cont.timestamps
+        additional_analog_data = LazyAnalogChannels(recording.nwb["acquisition"][item]["data"], ANALOG_CHANNELS)
+        additional_analog_timestamps = recording.nwb["acquisition"][item]["timestamps"]
+        additional_analog_cache_dir = pyramid_cache_dir(item, ANALOG_CHANNELS)
         if len(additional_analog_timestamps) > 1:
-            additional_sampling_rate = 1.0 / np.mean(np.diff(additional_analog_timestamps))
+            additional_sampling_rate = (len(additional_analog_timestamps) - 1) / (additional_analog_timestamps[-1] - additional_analog_timestamps[0])
         else:
             additional_sampling_rate = None
+additional_start_time = additional_analog_timestamps[0] if additional_analog_timestamps is not None else 0.0
 
 
 # Get TTL events (only when bit is high)
 ttl_events = recording.events
-ttl_pulses = []  # List of (timestamp, line) for TTL high events
-for _, row in ttl_events.iterrows():
-    if row.state == 1:  # Only plot when bit is high
-        ttl_pulses.append((row.timestamp, row.line))
+ttl_high = ttl_events[ttl_events.state == 1]
+ttl_pulses = list(zip(ttl_high.timestamp, ttl_high.line))  # List of (timestamp, line) for TTL high events
+
+
+class TtlEdgeIndex:
+    """TTL high intervals for each (stream, line), sorted once at load time so redraws only need a searchsorted.
+
+    Args:
+        ttl_events:     DataFrame of TTL events from open_ephys, with stream_name, line, timestamp, and state columns
+    """
+
+    def __init__(self, ttl_events):
+        self.starts = {}
+        self.ends = {}
+        events = ttl_events.sort_values("timestamp", kind="stable")
+        for (stream_name, line), group in events.groupby(["stream_name", "line"], sort=False):
+            times = group.timestamp.to_numpy(dtype=float)
+            high = group.state.to_numpy() == 1
+            # A rising edge starts an interval unless the line was already high, and the next falling edge ends it.
+            previous_high = np.concatenate([[False], high[:-1]])
+            start_rows = np.flatnonzero(high & ~previous_high)
+            fall_rows = np.flatnonzero(~high)
+            next_fall = np.searchsorted(fall_rows, start_rows)
+            has_fall = next_fall < fall_rows.size
+            ends = np.full(start_rows.size, np.inf)  # still high at the end of the recording
+            ends[has_fall] = times[fall_rows[next_fall[has_fall]]]
+            self.starts[(stream_name, int(line))] = times[start_rows]
+            self.ends[(stream_name, int(line))] = ends
+
+    def lines(self, stream_name):
+        return sorted(line for (stream, line) in self.starts if stream == stream_name)
+
+    def intervals(self, stream_name, line, t_start, t_end):
+        """Return (starts, ends) of the intervals where a line is high, clipped to the window t_start to t_end."""
+        starts = self.starts.get((stream_name, line), np.empty(0))
+        ends = self.ends.get((stream_name, line), np.empty(0))
+        # Intervals are sorted and don't overlap, so both starts and ends are sorted.
+        first = np.searchsorted(ends, t_start, side='right')
+        last = np.searchsorted(starts, t_end, side='left')
+        return (np.maximum(starts[first:last], t_start), np.minimum(ends[first:last], t_end))
+
+
+ttl_edges = TtlEdgeIndex(ttl_events)
+
+# Min/max envelopes of the analog data, so the full-data plot can zoom and pan without striding over spikes and glitches.
+# These are memory-mapped files in PYRAMID_CACHE_DIR, read from the data the first time and just mapped after that.
+analog_pyramid = MinMaxPyramid(analog_data, analog_timestamps, cache_dir=analog_cache_dir)
+additional_analog_pyramid = None
+if additional_analog_data is not None:
+    additional_analog_pyramid = MinMaxPyramid(additional_analog_data, additional_analog_timestamps, cache_dir=additional_analog_cache_dir)
+
+
+def draw_envelope(ax, pyramid, t_start, t_end, lines=None, labels=None):
+    # Draw the analog data from t_start to t_end at about one min/max bucket per pixel, or update lines already drawn.
+    (t, y, bucket_samples) = pyramid.window(t_start, t_end, max_points=max(int(ax.bbox.width), 100))
+    if lines is None:
+        lines = ax.plot(t, y)
+        for line, label in zip(lines, labels or []):
+            line.set_label(label)
+    else:
+        for i, line in enumerate(lines):
+            line.set_data(t, y[:, i])
+    return (lines, bucket_samples)
 
-# Get messages
-messages = []  # List of (timestamp, text)
+
+def draw_ttl_intervals(ax, t_start, t_end, include_pxi=False):
+    # Draw TTL high intervals in the window, one hlines call per line:
+    # acquisition_board lines at y=line, ProbeA-AP line 1 at y=0, and optionally PXIe-6363 lines at y=-line.
+    streams = [("acquisition_board", 1, None), ("ProbeA-AP", 0, [1])]
+    if include_pxi:
+        streams.append(("PXIe-6363", -1, None))
+    ttl_lines = set()
+    artists = []
+    for stream_name, y_sign, only_lines in streams:
+        for line in (only_lines or ttl_edges.lines(stream_name)):
+            if line >= 16:
+                continue
+            (starts, ends) = ttl_edges.intervals(stream_name, line, t_start, t_end)
+            if starts.size == 0:
+                continue
+            y = y_sign * line
+            artists.append(ax.hlines(np.full(starts.size, y), starts, ends, color=f"C{line%10}", alpha=0.8, linewidth=2))
+            ttl_lines.add(y)
+    return (ttl_lines, artists)
+
+
+# Get messages, decoded and sorted into categories once, like "udp_sync" and "fix_acq" (name=4913), so plots can pick out the ones in view
+message_timestamps = np.empty(0)
+message_data = np.empty(0, dtype=str)
 if 'messages' in recording.nwb['acquisition']:
-    message_count = len(recording.nwb['acquisition']['messages']['data'])
-    for index in range(message_count):
-        text = recording.nwb['acquisition']['messages']['data'][index]
-        timestamp = recording.nwb['acquisition']['messages']['timestamps'][index]
-        messages.append((timestamp, text))
+    # Read each dataset in one go, rather than one HDF5 read per message
+    message_timestamps = recording.nwb['acquisition']['messages']['timestamps'][:]
+    message_data = recording.nwb['acquisition']['messages']['data'][:]
+messages = MessageIndex(message_timestamps, message_data, ECODE_RULES_CSV if os.path.isfile(ECODE_RULES_CSV) else None)
+udp_color = f"C{1%10}"  # TTL line 1 color
+name4913_color = f"C{3%10}"  # TTL line 3 color
+
+
+def draw_message_lines(axes, t_start, t_end):
+    """Draw dashed lines at UDP sync and fix_acq (name=4913) messages between t_start and t_end, one collection per category per axis.
+
+    Returns a list of the artists, to remove when the view changes.
+    """
+    artists = []
+    for category, color in [("udp_sync", udp_color), ("fix_acq", name4913_color)]:
+        times = messages.timestamps[messages.window(category, t_start, t_end)]
+        if times.size == 0:
+            continue
+        # One segment per message, with x in data coordinates and y from the bottom to the top of the axis, like axvline
+        segments = np.zeros((times.size, 2, 2))
+        segments[:, :, 0] = times[:, np.newaxis]
+        segments[:, 1, 1] = 1
+        for ax in axes:
+            lines = LineCollection(segments, transform=ax.get_xaxis_transform(), colors=color, linestyles='--', alpha=0.5)
+            # Leave the axis limits alone, like axvline does
+            artists.append(ax.add_collection(lines, autolim=False))
+    return artists
+
 
 # --- PLOTTING ---
 class InteractivePlot:
@@ -74,12 +257,9 @@ class InteractivePlot:
         self.additional_analog_data = additional_analog_data
         self.additional_sampling_rate = additional_sampling_rate
         self.additional_start_time = additional_start_time
-        # Get the actual start time from the recording object
-        if hasattr(recording_analog, 'get_start_time'):
-            self.start_time = recording_analog.get_start_time()
-        else:
-            self.start_time = 0.0
-        self.t = self.start_time + np.arange(self.n_samples) / sampling_rate
+        # Lazy timestamps from the NWB file, so only the samples in the window get read
+        self.t = analog_timestamps
+        self.start_time = self.t[0]
         self.start_idx = 0
         self.end_idx = int(window_sec * sampling_rate)
         from matplotlib.widgets import Slider, TextBox
@@ -136,159 +316,42 @@ class InteractivePlot:
         self.ax_ttl.cla()
         t_start = self.t[self.start_idx]
         t_end = self.t[self.end_idx-1] if self.end_idx > 0 else self.t[self.start_idx]
-        # Plot analog channels (top)
+        # Plot analog channels (top), reading just this window from disk
+        t_window = self.t[self.start_idx:self.end_idx]
+        analog_window = self.analog_data[self.start_idx:self.end_idx]
         for i in range(self.analog_data.shape[1]):
-            self.ax_analog.plot(self.t[self.start_idx:self.end_idx],
-                               self.analog_data[self.start_idx:self.end_idx, i],
-                               label=f"Analog {ANALOG_CHANNELS[i]}")
+            self.ax_analog.plot(t_window, analog_window[:, i], label=f"Analog {ANALOG_CHANNELS[i]}")
         # Plot additional analog channels if present
         if self.additional_analog_data is not None and hasattr(self, 'ax_additional'):
-            # Calculate time axis for additional analog data
-            n_samples_additional = self.additional_analog_data.shape[0]
-            t_additional = self.additional_start_time + np.arange(n_samples_additional) / self.additional_sampling_rate
-            # Find indices for window
-            start_idx_additional = np.searchsorted(t_additional, t_start, side='left')
-            end_idx_additional = np.searchsorted(t_additional, t_end, side='right')
+            # Find indices for window from the overview, then read just those samples and timestamps
+            (start_idx_additional, end_idx_additional) = additional_analog_pyramid.sample_range(t_start, t_end)
+            end_idx_additional = min(end_idx_additional + 1, self.additional_analog_data.shape[0])
+            t_additional = additional_analog_timestamps[start_idx_additional:end_idx_additional]
+            additional_window = self.additional_analog_data[start_idx_additional:end_idx_additional]
             for i in range(self.additional_analog_data.shape[1]):
-                self.ax_additional.plot(t_additional[start_idx_additional:end_idx_additional],
-                                       self.additional_analog_data[start_idx_additional:end_idx_additional, i],
-                                       label=f"NI-DAQmx Ch {i}")
+                self.ax_additional.plot(t_additional, additional_window[:, i], label=f"NI-DAQmx Ch {i}")
             self.ax_additional.set_ylabel("Additional Analog Value")
             self.ax_additional.set_title("NI-DAQmx-131.PXIe-6363 Analog Data")
             self.ax_additional.legend(loc='upper right')
-        # Plot message lines (vertical lines on analog)
+        # Plot message lines (vertical lines on analog), just the UDP sync and name=4913 messages in the window
         self.message_lines = []
         msg_in_window = False
-        for ts, msg in self.messages:
-            if t_start <= ts < t_end:
-                # Decode bytes to string if needed
-                if isinstance(msg, bytes):
-                    msg_str = msg.decode(errors='replace')
-                else:
-                    msg_str = str(msg)
-                label_text = None
-                if 'UDP' in msg_str:
-                    color = 'green'
-                    # Extract timestamp between '@' and '='
-                    try:
-                        at_idx = msg_str.index('@')
-                        eq_idx = msg_str.index('=', at_idx)
-                        extracted = msg_str[at_idx+1:eq_idx]
-                        extracted_ts = float(extracted)
-                        udp_diff_val = ts - extracted_ts
-                        label_text = f"{udp_diff_val:.6f}"
-                    except Exception:
-                        label_text = None
-                elif 'name=4913' in msg_str:
-                    color = 'blue'
-                    # Try to extract udp_diff_val if possible
-                    udp_diff_val = None
-                    try:
-                        at_idx = msg_str.index('@')
-                        eq_idx = msg_str.index('=', at_idx)
-                        extracted = msg_str[at_idx+1:eq_idx]
-                        extracted_ts = float(extracted)
-                        udp_diff_val = ts - extracted_ts
-                    except Exception:
-                        udp_diff_val = None
-                    # Plot udp_diff_val label if found
-                    if udp_diff_val is not None:
-                        ylim = self.ax_analog.get_ylim()
-                        y_pos = ylim[1] - 0.05 * (ylim[1] - ylim[0])
-                        self.ax_analog.text(ts, y_pos, f"{udp_diff_val:.6f}", color='blue', fontsize=8, rotation=90, va='top', ha='left', backgroundcolor='white')
-                else:
-                    continue
+        ylim = self.ax_analog.get_ylim()
+        y_pos = ylim[1] - 0.05 * (ylim[1] - ylim[0])
+        for category, color in [("udp_sync", 'green'), ("fix_acq", 'blue')]:
+            rows = self.messages.window(category, t_start, t_end)
+            # Recorded timestamp minus the one UDPEvents put after '@', nan if there wasn't one
+            udp_diffs = self.messages.at_offsets(rows)
+            for ts, msg_str, udp_diff_val in zip(self.messages.timestamps[rows], self.messages.text[rows], udp_diffs):
                 line = self.ax_analog.axvline(ts, color=color, linestyle='--', alpha=0.7)
-                # Add label next to the vertical line for UDP messages
-                if label_text is not None:
-                    ylim = self.ax_analog.get_ylim()
-                    y_pos = ylim[1] - 0.05 * (ylim[1] - ylim[0])
-                    self.ax_analog.text(ts, y_pos, label_text, color='green', fontsize=8, rotation=90, va='top', ha='left', backgroundcolor='white')
+                # Add label next to the vertical line
+                if not np.isnan(udp_diff_val):
+                    self.ax_analog.text(ts, y_pos, f"{udp_diff_val:.6f}", color=color, fontsize=8, rotation=90, va='top', ha='left', backgroundcolor='white')
                 self.message_lines.append((line, msg_str))
                 msg_in_window = True
-        # Plot TTL pulses (bottom)\
-        ttl_in_window = False
-        ttl_lines = set()
-        for line in range(16):
-            # Separate events for ProbeA-AP and acquisition_board
-            probe_events = [(row.timestamp, row.state) for _, row in ttl_events.iterrows() if row.line == line and row.stream_name == "ProbeA-AP" and row.timestamp < t_end]
-            acq_events = [(row.timestamp, row.state) for _, row in ttl_events.iterrows() if row.line == line and row.stream_name == "acquisition_board" and row.timestamp < t_end]
-
-            # Handle ProbeA-AP (only line 1, plotted at y=0)
-            if line == 1:
-                # Find last state before window start for ProbeA-AP
-                prev_state_probe = 0
-                for ts, state in probe_events:
-                    if ts < t_start:
-                        prev_state_probe = state
-                i = 0
-                while i < len(probe_events) and probe_events[i][0] < t_start:
-                    i += 1
-                if prev_state_probe == 1:
-                    end_ts = t_end
-                    for j in range(i, len(probe_events)):
-                        if probe_events[j][1] == 0:
-                            end_ts = probe_events[j][0]
-                            break
-                    self.ax_ttl.hlines(0, t_start, end_ts, color=f"C{line%10}", alpha=0.8, linewidth=2)
-                    ttl_lines.add(0)
-                    ttl_in_window = True
-                # Plot new rising edges in window for ProbeA-AP
-                while i < len(probe_events):
-                    if probe_events[i][1] == 1:
-                        start_ts = probe_events[i][0]
-                        end_ts = t_end
-                        j_found = False
-                        for j in range(i+1, len(probe_events)):
-                            if probe_events[j][1] == 0:
-                                end_ts = probe_events[j][0]
-                                i = j
-                                j_found = True
-                                break
-                        self.ax_ttl.hlines(0, start_ts, end_ts, color=f"C{line%10}", alpha=0.8, linewidth=2)
-                        ttl_lines.add(0)
-                        ttl_in_window = True
-                        if not j_found:
-                            i += 1
-                    else:
-                        i += 1
-
-            # Handle acquisition_board (all lines except ProbeA-AP)
-            prev_state_acq = 0
-            for ts, state in acq_events:
-                if ts < t_start:
-                    prev_state_acq = state
-            i = 0
-            while i < len(acq_events) and acq_events[i][0] < t_start:
-                i += 1
-            if prev_state_acq == 1:
-                end_ts = t_end
-                for j in range(i, len(acq_events)):
-                    if acq_events[j][1] == 0:
-                        end_ts = acq_events[j][0]
-                        break
-                self.ax_ttl.hlines(line, t_start, end_ts, color=f"C{line%10}", alpha=0.8, linewidth=2)
-                ttl_lines.add(line)
-                ttl_in_window = True
-            # Plot new rising edges in window for acquisition_board
-            while i < len(acq_events):
-                if acq_events[i][1] == 1:
-                    start_ts = acq_events[i][0]
-                    end_ts = t_end
-                    j_found = False
-                    for j in range(i+1, len(acq_events)):
-                        if acq_events[j][1] == 0:
-                            end_ts = acq_events[j][0]
-                            i = j
-                            j_found = True
-                            break
-                    self.ax_ttl.hlines(line, start_ts, end_ts, color=f"C{line%10}", alpha=0.8, linewidth=2)
-                    ttl_lines.add(line)
-                    ttl_in_window = True
-                    if not j_found:
-                        i += 1
-                else:
-                    i += 1
+        # Plot TTL pulses (bottom), just the intervals in the window
+        (ttl_lines, _) = draw_ttl_intervals(self.ax_ttl, t_start, t_end)
+        ttl_in_window = bool(ttl_lines)
         # Set axis labels and limits
         self.ax_analog.set_ylabel("Analog Value")
         self.ax_analog.set_title("Analog Data + Messages")
@@ -356,49 +419,16 @@ def plot_full_data_with_linked_zoom():
         ax_corr = None
     # If additional analog data is present, plot cross-correlation over time
     if ax_corr is not None and additional_analog_data is not None:
-        # Use first channel from each source for comparison
-        # Downsample both signals to the same rate and length
-        main = analog_data[:, 0]
-        add = additional_analog_data[:, 0]
-        # Resample to lowest sampling rate
-        min_rate = min(sampling_rate, additional_sampling_rate)
-        # Use timestamps arrays directly for time vectors
-        t_main = analog_timestamps
-        t_add = additional_analog_timestamps
-        # Interpolate both to common time base
-        t_common_start = max(t_main[0], t_add[0])
-        t_common_end = min(t_main[-1], t_add[-1])
-        t_common = np.arange(t_common_start, t_common_end, 1.0/min_rate)
-        main_interp = np.interp(t_common, t_main, main)
-        add_interp = np.interp(t_common, t_add, add)
-        # Sliding window cross-correlation
-        window_sec = 10.0
-        step_sec = 2.0
-        window_samples = int(window_sec * min_rate)
-        step_samples = int(step_sec * min_rate)
-        corrs = []
-        lags = []
-        times = []
-        from scipy.signal import correlate, correlation_lags
-        try:
-            from tqdm import tqdm
-            use_tqdm = True
-        except ImportError:
-            use_tqdm = False
-        loop_range = range(0, len(t_common) - window_samples, step_samples)
-        if use_tqdm:
-            loop_range = tqdm(loop_range, desc='Cross-correlation')
-        for start in loop_range:
-            seg_main = main_interp[start:start+window_samples]
-            seg_add = add_interp[start:start+window_samples]
-            corr = correlate(seg_main - np.mean(seg_main), seg_add - np.mean(seg_add), mode='full')
-            lags_arr = correlation_lags(len(seg_main), len(seg_add), mode='full') / min_rate
-            peak_idx = np.argmax(corr)
-            peak = corr[peak_idx] / (np.std(seg_main) * np.std(seg_add) * window_samples)
-            lag = lags_arr[peak_idx]
-            corrs.append(peak)
-            lags.append(lag)
-            times.append(t_common[start + window_samples//2])
+        # Use first channel from each source for comparison, at the lower of the two sample rates.
+        # stream_lag reads both streams a batch of windows at a time and correlates each batch with FFTs,
+        # and it can run without the viewer too, like: python stream_lag.py experiment1.nwb --plot drift.png
+        # The result is cached in PYRAMID_CACHE_DIR, so only the first launch for a file waits for it.
+        lag_result = cached_stream_lags([analog_cache_dir, additional_analog_cache_dir],
+                                        analog_timestamps, analog_data, additional_analog_timestamps, additional_analog_data,
+                                        channel=0, window_sec=10.0, step_sec=2.0, max_lag_sec=MAX_LAG_SEC, progress=True)
+        times = lag_result["time"]
+        corrs = lag_result["peak"]
+        lags = lag_result["lag"]
         ax_corr.plot(times, corrs, label='Peak Correlation', color='purple')
         ax_corr.plot(times, lags, label='Lag (s)', color='orange')
         ax_corr.set_ylabel('Correlation / Lag (s)')
@@ -406,128 +436,31 @@ def plot_full_data_with_linked_zoom():
         ax_corr.legend(loc='upper right')
         ax_corr.set_xlabel('Time (s)')
 
-    # Plot all analog data using timestamps array, downsample if needed
-    n_samples = analog_data.shape[0]
-    max_points = 100_000
-    ds_factor = max(1, n_samples // max_points)
-    idxs = np.arange(0, n_samples, ds_factor)
-    t_analog = analog_timestamps[idxs]
-    for i in range(analog_data.shape[1]):
-        ax_analog.plot(t_analog, analog_data[idxs, i], label=f"Analog {ANALOG_CHANNELS[i]}")
+    # Plot all analog data as min/max envelopes, redrawn at the right level of detail on zoom/pan
+    (analog_lines, bucket_samples) = draw_envelope(ax_analog, analog_pyramid, analog_timestamps[0], analog_timestamps[-1],
+                                                   labels=[f"Analog {channel}" for channel in ANALOG_CHANNELS])
     ax_analog.set_ylabel("Analog Value")
-    ax_analog.set_title(f"Full Analog Data (downsampled by {ds_factor}x)")
+    ax_analog.set_title(f"Full Analog Data (min/max of {bucket_samples} samples per point)")
     ax_analog.legend(loc='upper right')
     ax_analog.set_xlabel("Time (s)")
 
-    # Add vertical lines for 'UDP' and 'name=4913' messages to all subplots (no text)
-    udp_color = f"C{1%10}"  # TTL line 1 color
-    name4913_color = f"C{3%10}"  # TTL line 3 color
-    udp_lines = [ts for ts, msg in messages if 'UDP' in (msg.decode(errors='replace') if isinstance(msg, bytes) else str(msg))]
-    name4913_lines = [ts for ts, msg in messages if 'name=4913' in (msg.decode(errors='replace') if isinstance(msg, bytes) else str(msg))]
-    # Plot UDP lines
-    for ts in udp_lines:
-        ax_analog.axvline(ts, color=udp_color, linestyle='--', alpha=0.5)
-    if ax_additional is not None and additional_analog_data is not None and additional_analog_timestamps is not None:
-        for ts in udp_lines:
-            ax_additional.axvline(ts, color=udp_color, linestyle='--', alpha=0.5)
-    for ts in udp_lines:
-        ax_ttl.axvline(ts, color=udp_color, linestyle='--', alpha=0.5)
-    if ax_corr is not None:
-        for ts in udp_lines:
-            ax_corr.axvline(ts, color=udp_color, linestyle='--', alpha=0.5)
-    # Plot name=4913 lines
-    for ts in name4913_lines:
-        ax_analog.axvline(ts, color=name4913_color, linestyle='--', alpha=0.5)
-    if ax_additional is not None and additional_analog_data is not None and additional_analog_timestamps is not None:
-        for ts in name4913_lines:
-            ax_additional.axvline(ts, color=name4913_color, linestyle='--', alpha=0.5)
-    for ts in name4913_lines:
-        ax_ttl.axvline(ts, color=name4913_color, linestyle='--', alpha=0.5)
-    if ax_corr is not None:
-        for ts in name4913_lines:
-            ax_corr.axvline(ts, color=name4913_color, linestyle='--', alpha=0.5)
+    # Add vertical lines for UDP sync and name=4913 messages to all subplots (no text), redrawn for just the messages in view on zoom/pan
+    message_axes = [ax for ax in [ax_analog, ax_additional, ax_ttl, ax_corr] if ax is not None]
+    message_artists = draw_message_lines(message_axes, -np.inf, np.inf)
 
     # Plot all additional analog data if present, downsample if needed
     if ax_additional is not None and additional_analog_data is not None and additional_analog_timestamps is not None:
-        n_samples_additional = additional_analog_data.shape[0]
-        ds_factor_add = max(1, n_samples_additional // max_points)
-        idxs_add = np.arange(0, n_samples_additional, ds_factor_add)
-        t_additional = additional_analog_timestamps[idxs_add]
-        for i in range(additional_analog_data.shape[1]):
-            ax_additional.plot(t_additional, additional_analog_data[idxs_add, i], label=f"NI-DAQmx Ch {i}")
+        (additional_lines, bucket_samples_add) = draw_envelope(ax_additional, additional_analog_pyramid, additional_analog_timestamps[0], additional_analog_timestamps[-1],
+                                                               labels=[f"NI-DAQmx Ch {i}" for i in range(additional_analog_data.shape[1])])
         ax_additional.set_ylabel("Additional Analog Value")
-        ax_additional.set_title(f"Full NI-DAQmx-131.PXIe-6363 Analog Data (downsampled by {ds_factor_add}x)")
+        ax_additional.set_title(f"Full NI-DAQmx-131.PXIe-6363 Analog Data (min/max of {bucket_samples_add} samples per point)")
         ax_additional.legend(loc='upper right')
         ax_additional.set_xlabel("Time (s)")
 
-    # Plot all TTL events
-    ttl_lines = set()
-    for line in range(16):
-        probe_events = [(row.timestamp, row.state) for _, row in ttl_events.iterrows() if row.line == line and row.stream_name == "ProbeA-AP"]
-        acq_events = [(row.timestamp, row.state) for _, row in ttl_events.iterrows() if row.line == line and row.stream_name == "acquisition_board"]
-        # ProbeA-AP (line 1)
-        if line == 1:
-            prev_state_probe = 0
-            for ts, state in probe_events:
-                prev_state_probe = state
-            i = 0
-            while i < len(probe_events):
-                if probe_events[i][1] == 1:
-                    start_ts = probe_events[i][0]
-                    end_ts = analog_timestamps[-1]
-                    j_found = False
-                    for j in range(i+1, len(probe_events)):
-                        if probe_events[j][1] == 0:
-                            end_ts = probe_events[j][0]
-                            i = j
-                            j_found = True
-                            break
-                    ax_ttl.hlines(0, start_ts, end_ts, color=f"C{line%10}", alpha=0.8, linewidth=2)
-                    ttl_lines.add(0)
-                    if end_ts == analog_timestamps[-1]:
-                        i += 1
-                else:
-                    i += 1
-        # acquisition_board (all lines except ProbeA-AP)
-        i = 0
-        while i < len(acq_events):
-            if acq_events[i][1] == 1:
-                start_ts = acq_events[i][0]
-                end_ts = analog_timestamps[-1]
-                j_found = False
-                for j in range(i+1, len(acq_events)):
-                    if acq_events[j][1] == 0:
-                        end_ts = acq_events[j][0]
-                        i = j
-                        j_found = True
-                        break
-                ax_ttl.hlines(line, start_ts, end_ts, color=f"C{line%10}", alpha=0.8, linewidth=2)
-                ttl_lines.add(line)
-                if end_ts == analog_timestamps[-1]:
-                    i += 1
-            else:
-                i += 1
-
-    # If additional analog data is present, plot PXIe-6363 TTL events at negative line numbers
-    if ax_additional is not None and additional_analog_data is not None and additional_analog_timestamps is not None:
-        for line in range(16):
-            pxi_events = [(row.timestamp, row.state) for _, row in ttl_events.iterrows() if row.line == line and row.stream_name == "PXIe-6363"]
-            i = 0
-            while i < len(pxi_events):
-                if pxi_events[i][1] == 1:
-                    start_ts = pxi_events[i][0]
-                    end_ts = additional_analog_timestamps[-1]
-                    for j in range(i+1, len(pxi_events)):
-                        if pxi_events[j][1] == 0:
-                            end_ts = pxi_events[j][0]
-                            i = j
-                            break
-                    ax_ttl.hlines(-line, start_ts, end_ts, color=f"C{line%10}", alpha=0.8, linewidth=2)
-                    ttl_lines.add(-line)
-                    if end_ts == additional_analog_timestamps[-1]:
-                        i += 1
-                else:
-                    i += 1
+    # Plot all TTL events, and PXIe-6363 TTL events at negative line numbers if additional analog data is present
+    include_pxi = ax_additional is not None and additional_analog_data is not None and additional_analog_timestamps is not None
+    t_full_end = max(analog_timestamps[-1], additional_analog_timestamps[-1]) if include_pxi else analog_timestamps[-1]
+    (ttl_lines, ttl_artists) = draw_ttl_intervals(ax_ttl, -np.inf, t_full_end, include_pxi)
     ax_ttl.set_xlabel("Time (s)")
     ax_ttl.set_ylabel("TTL Line")
     ax_ttl.set_title("Full TTL Pulses")
@@ -542,49 +475,23 @@ def plot_full_data_with_linked_zoom():
             return
         syncing['active'] = True
         new_xlim = event_ax.get_xlim()
-        # Plot all TTL events (full recording, not windowed)
-        ttl_lines = set()
-        for line in range(16):
-            probe_events = [(row.timestamp, row.state) for _, row in ttl_events.iterrows() if row.line == line and row.stream_name == "ProbeA-AP"]
-            acq_events = [(row.timestamp, row.state) for _, row in ttl_events.iterrows() if row.line == line and row.stream_name == "acquisition_board"]
-            # ProbeA-AP (line 1)
-            if line == 1:
-                i = 0
-                while i < len(probe_events):
-                    if probe_events[i][1] == 1:
-                        start_ts = probe_events[i][0]
-                        # Find next falling edge or end of recording
-                        end_ts = recording_analog.get_start_time() + (n_samples - 1) / sampling_rate
-                        for j in range(i+1, len(probe_events)):
-                            if probe_events[j][1] == 0:
-                                end_ts = probe_events[j][0]
-                                i = j
-                                break
-                        ax_ttl.hlines(0, start_ts, end_ts, color=f"C{line%10}", alpha=0.8, linewidth=2)
-                        ttl_lines.add(0)
-                        if end_ts == recording_analog.get_start_time() + (n_samples - 1) / sampling_rate:
-                            i += 1
-                    else:
-                        i += 1
-            # acquisition_board (all lines except ProbeA-AP)
-            i = 0
-            while i < len(acq_events):
-                if acq_events[i][1] == 1:
-                    start_ts = acq_events[i][0]
-                    end_ts = recording_analog.get_start_time() + (n_samples - 1) / sampling_rate
-                    for j in range(i+1, len(acq_events)):
-                        if acq_events[j][1] == 0:
-                            end_ts = acq_events[j][0]
-                            i = j
-                            break
-                    ax_ttl.hlines(line, start_ts, end_ts, color=f"C{line%10}", alpha=0.8, linewidth=2)
-                    ttl_lines.add(line)
-                    if end_ts == recording_analog.get_start_time() + (n_samples - 1) / sampling_rate:
-                        i += 1
-                else:
-                    i += 1
-        # ...existing code...
-    # ...existing code...
+        # Redraw the analog envelopes at the level of detail for the new view
+        (_, bucket_samples) = draw_envelope(ax_analog, analog_pyramid, new_xlim[0], new_xlim[1], lines=analog_lines)
+        ax_analog.set_title(f"Full Analog Data (min/max of {bucket_samples} samples per point)" if bucket_samples > 1 else "Full Analog Data")
+        if include_pxi:
+            (_, bucket_samples_add) = draw_envelope(ax_additional, additional_analog_pyramid, new_xlim[0], new_xlim[1], lines=additional_lines)
+            ax_additional.set_title(f"Full NI-DAQmx-131.PXIe-6363 Analog Data (min/max of {bucket_samples_add} samples per point)" if bucket_samples_add > 1 else "Full NI-DAQmx-131.PXIe-6363 Analog Data")
+        # Redraw just the TTL intervals in view, instead of every interval in the recording
+        for artist in ttl_artists:
+            artist.remove()
+        (_, new_artists) = draw_ttl_intervals(ax_ttl, new_xlim[0], min(new_xlim[1], t_full_end), include_pxi)
+        ttl_artists[:] = new_artists
+        for artist in message_artists:
+            artist.remove()
+        message_artists[:] = draw_message_lines(message_axes, new_xlim[0], new_xlim[1])
+        ax_ttl.figure.canvas.draw_idle()
+        syncing['active'] = False
+    ax_ttl.callbacks.connect('xlim_changed', on_xlim_changed)
     plt.tight_layout()
     plt.show()
     plt.close(fig)
@@ -605,38 +512,18 @@ if __name__ == "__main__":
     # Always show static full-data plot when not interactive
     plot_full_data_with_linked_zoom()
     # --- STATIC UDP TIMESTAMP DIFFERENCE PLOT ---
-    udp_ts = []
-    udp_diff = []
-    rex_diff = []
-    synced_diff = []
-    extracted_diff = []
-    rex_offset = None
-    for ts, msg in messages:
-        # Decode bytes to string if needed
-        if isinstance(msg, bytes):
-            msg_str = msg.decode(errors='replace')
-        else:
-            msg_str = str(msg)
-        if 'UDP' in msg_str:
-            # Extract timestamp between '@' and '='
-            try:
-                at_idx = msg_str.index('@')
-                eq_idx = msg_str.index('=', at_idx)
-                extracted = msg_str[at_idx+1:eq_idx]
-                extracted_ts = float(extracted)
-                # Extract REX timestamp after '='
-                rex_str = msg_str[eq_idx+1:]
-                rex_ts = float(rex_str.split()[0])
-                if rex_offset is None:
-                    rex_offset = rex_ts
-                rex_ts -= rex_offset
-                udp_ts.append(ts)
-                udp_diff.append(ts - extracted_ts)
-                rex_diff.append(ts - rex_ts)
-                extracted_diff.append(extracted_ts - rex_ts)
-            except Exception:
-                continue
-    if udp_ts:
+    # Recorded timestamp, timestamp after '@', and REX timestamp after '=' of each UDP sync message, from the message index
+    udp_rows = messages.rows("udp_sync")
+    udp_rows = udp_rows[~np.isnan(messages.at_times[udp_rows]) & ~np.isnan(messages.equals_values[udp_rows])]
+    udp_ts = messages.timestamps[udp_rows]
+    extracted_ts = messages.at_times[udp_rows]
+    rex_ts = messages.equals_values[udp_rows]
+    if udp_ts.size:
+        rex_ts = rex_ts - rex_ts[0]
+    udp_diff = udp_ts - extracted_ts
+    rex_diff = udp_ts - rex_ts
+    extracted_diff = extracted_ts - rex_ts
+    if udp_ts.size:
         fig = plt.figure(figsize=(10, 8))
         ax1 = plt.subplot(3, 1, 1)
         line1, = ax1.plot(udp_ts, udp_diff, marker='o', linestyle='-', color='green')
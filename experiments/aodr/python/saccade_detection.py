@@ -0,0 +1,362 @@
+import numpy as np
+
+# Saccade detection for gaze position windows, kept apart from Pyramid so it can run and be tested on plain arrays.
+#
+# SaccadesEnhancer in AODR_custom_enhancers.py uses SaccadeParser to parse saccades from each trial's gaze.
+# The thresholds and search follow "findSaccadesAODR.m" used in FIRA.
+#
+#   parser = SaccadeParser(max_saccades=3)
+#   saccades = parser.detect_batch([x_window], [y_window], [fp_off_time], sample_frequency)[0]
+#
+# For a whole session at once, pass whole-session gaze and each trial's fp_off and all_off times to detect_session().
+# This smooths, differentiates, and parses all the trials together.  save_session_saccades() writes the results to an .npz
+# file, which SaccadesEnhancer can load with its session_saccades_file arg to look up each trial's saccades by fp_off time.
+#
+#   parser.detect_session(x_data, y_data, sample_frequency, fp_off_times, all_off_times, first_sample_time)
+#   parser.save_session_saccades("session_saccades.npz")
+
+
+# Fields of each parsed saccade, in order.  Saccades are parsed into rows of float64 values with one column per field.
+# The compact form returned to SaccadesEnhancer is one list per field, rather than a structured array with this dtype,
+# so that trial files can write saccades with the field names intact.
+SACCADE_DTYPE = np.dtype([
+    ("t_start", np.float64),
+    ("t_end", np.float64),
+    ("v_max", np.float64),
+    ("v_avg", np.float64),
+    ("x_start", np.float64),
+    ("y_start", np.float64),
+    ("x_end", np.float64),
+    ("y_end", np.float64),
+    ("raw_distance", np.float64),
+    ("vector_distance", np.float64),
+])
+
+# Placeholder row for "no saccade found".
+NO_SACCADE = (np.nan, np.inf, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan)
+
+def run_starts(is_above: np.ndarray, run_length: int) -> np.ndarray:
+    """Find every index where run_length consecutive True values begin (runs may overlap)."""
+    if is_above.size < run_length:
+        return np.empty(0, dtype=np.intp)
+    # A window of run_length samples is all True when its count of True samples equals run_length.
+    counts = np.concatenate(([0], np.cumsum(is_above, dtype=np.intp)))
+    return np.flatnonzero(counts[run_length:] - counts[:-run_length] == run_length)
+
+def saccade_rows(saccades: list[dict] | dict[str, list]) -> np.ndarray:
+    """Stack saccades, as a list of dicts or a dict of columns, into a 2D array with one column per SACCADE_DTYPE field."""
+    if isinstance(saccades, dict):
+        columns = [np.asarray(saccades[name], dtype=np.float64) for name in SACCADE_DTYPE.names]
+        return np.column_stack(columns).reshape(-1, len(SACCADE_DTYPE.names))
+    else:
+        rows = [[saccade[name] for name in SACCADE_DTYPE.names] for saccade in saccades]
+        return np.array(rows, dtype=np.float64).reshape(-1, len(SACCADE_DTYPE.names))
+
+
+class SaccadeParser():
+    """Parse saccades from windows of x,y gaze position using velocity and acceleration thresholds.
+
+    Args:
+        max_saccades:                           Parse this number of saccades, at most (default 1).
+        velocity_threshold_deg_per_ms:          Threshold for the start of a saccade by velocity in gaze deg/ms (default 0.3).
+        velocity_peak_threshold_deg_per_ms:     Threshold for peak velocity in gaze deg/ms (default 0.04).
+        acceleration_threshold_deg_per_ms2:     Threshold for detecting saccades by acceleration in gaze deg/ms^2 (default 4).
+        min_length_deg:                         Minimum length for a saccade to count in gaze deg (default 3.0).
+        compact_saccades:                       Whether to return saccades as one dict of columns, one list per SACCADE_DTYPE field
+                                                (default False), instead of a list of dicts with the same keys.
+    """
+
+    def __init__(
+        self,
+        max_saccades: int = 1,
+        velocity_threshold_deg_per_ms: float = 0.3,
+        velocity_peak_threshold_deg_per_ms: float = 0.04,
+        acceleration_threshold_deg_per_ms2: float = 4,
+        min_length_deg: float = 3.0,
+        compact_saccades: bool = False
+    ) -> None:
+        self.max_saccades = max_saccades
+        self.velocity_threshold_deg_per_ms = velocity_threshold_deg_per_ms
+        self.velocity_peak_threshold_deg_per_ms = velocity_peak_threshold_deg_per_ms
+        self.acceleration_threshold_deg_per_ms2 = acceleration_threshold_deg_per_ms2
+        self.min_length_deg = min_length_deg
+        self.compact_saccades = compact_saccades
+        self.session_sample_frequency = None
+        self.session_fp_off_times = None
+        self.session_saccades = None
+
+    def format_saccades(self, rows: np.ndarray) -> list[dict] | dict[str, list]:
+        """Convert saccade rows, like from saccade_rows(), to a dict of columns or a list of dicts, depending on compact_saccades."""
+        if self.compact_saccades:
+            return {name: rows[:, index].tolist() for index, name in enumerate(SACCADE_DTYPE.names)}
+        else:
+            return [dict(zip(SACCADE_DTYPE.names, row)) for row in rows.tolist()]
+
+    def detect_session(
+        self,
+        x_data: np.ndarray,
+        y_data: np.ndarray,
+        sample_frequency: float,
+        fp_off_times: np.ndarray,
+        all_off_times: np.ndarray,
+        first_sample_time: float = 0.0,
+        center_at_fp: bool = True
+    ) -> list[list[dict] | dict[str, list]]:
+        """Detect saccades for all trials of a session at once, from whole-session gaze signals.
+
+        Each trial's window runs from the first sample at or after its fp_off time, up to its all_off time.
+        With center_at_fp, each window is re-zeroed at its first sample, like SaccadesEnhancer does per trial.
+        Results are returned in trial order, with None for trials with nothing to parse (like a missing fp_off),
+        and also kept for lookup_session_saccades() and save_session_saccades().
+        """
+        fp_off_times = np.asarray(fp_off_times, dtype=np.float64)
+        all_off_times = np.asarray(all_off_times, dtype=np.float64)
+        sample_times = first_sample_time + np.arange(len(x_data)) / sample_frequency
+        starts = np.searchsorted(sample_times, fp_off_times, side="left")
+        ends = np.maximum(starts, np.searchsorted(sample_times, all_off_times, side="left"))
+        x_windows = [x_data[start:end] for start, end in zip(starts, ends)]
+        y_windows = [y_data[start:end] for start, end in zip(starts, ends)]
+        if center_at_fp:
+            x_windows = [x_window - x_window[0] if x_window.size else x_window for x_window in x_windows]
+            y_windows = [y_window - y_window[0] if y_window.size else y_window for y_window in y_windows]
+        results = self.detect_batch(x_windows, y_windows, fp_off_times, sample_frequency)
+
+        self.keep_session_saccades(sample_frequency, fp_off_times, [None if saccades is None else saccade_rows(saccades) for saccades in results])
+        return results
+
+    def keep_session_saccades(self, sample_frequency: float, fp_off_times: np.ndarray, session_saccades: list[np.ndarray]) -> None:
+        """Keep saccade rows for each trial, sorted by fp_off time for lookup_session_saccades()."""
+        order = np.argsort(fp_off_times, kind="stable")
+        order = order[np.isfinite(fp_off_times[order])]
+        self.session_sample_frequency = sample_frequency
+        self.session_fp_off_times = fp_off_times[order]
+        self.session_saccades = [session_saccades[index] for index in order]
+
+    def lookup_session_saccades(self, fp_off_time: float) -> list[dict] | dict[str, list]:
+        """Get saccades from detect_session() or load_session_saccades() for the trial with the given fp_off time, or None."""
+        if self.session_fp_off_times is None:
+            return None
+        index = np.searchsorted(self.session_fp_off_times, fp_off_time)
+        for candidate in (index - 1, index):
+            if 0 <= candidate < self.session_fp_off_times.size:
+                # Allow for fp_off times that went through a different float computation, within half a sample.
+                if abs(self.session_fp_off_times[candidate] - fp_off_time) < 0.5 / self.session_sample_frequency:
+                    rows = self.session_saccades[candidate]
+                    return None if rows is None else self.format_saccades(rows)
+        return None
+
+    def save_session_saccades(self, file_name: str) -> None:
+        """Write saccades from detect_session() to an .npz file, for load_session_saccades()."""
+        counts = np.array([-1 if rows is None else rows.shape[0] for rows in self.session_saccades])
+        found = [rows for rows in self.session_saccades if rows is not None]
+        all_rows = np.concatenate(found) if found else np.empty((0, len(SACCADE_DTYPE.names)))
+        np.savez(
+            file_name,
+            sample_frequency=self.session_sample_frequency,
+            fp_off_times=self.session_fp_off_times,
+            counts=counts,
+            saccades=all_rows
+        )
+
+    def load_session_saccades(self, file_name: str) -> None:
+        """Read saccades written by save_session_saccades(), for lookup_session_saccades()."""
+        with np.load(file_name) as session:
+            sample_frequency = float(session["sample_frequency"])
+            fp_off_times = session["fp_off_times"]
+            counts = session["counts"]
+            all_rows = session["saccades"]
+        offsets = np.concatenate(([0], np.cumsum(np.maximum(counts, 0))))
+        session_saccades = [None if count < 0 else all_rows[offset:offset + count] for count, offset in zip(counts, offsets)]
+        self.keep_session_saccades(sample_frequency, fp_off_times, session_saccades)
+
+    def detect_batch(
+        self,
+        x_windows: list[np.ndarray],
+        y_windows: list[np.ndarray],
+        fp_off_times: list[float],
+        sample_frequency: float
+    ) -> list[list[dict] | dict[str, list]]:
+        """Detect saccades in several gaze windows, smoothing and differentiating all windows together.
+
+        The windows are laid end to end with zero padding in between, so one convolution over the
+        whole layout gives the same result as smoothing each window on its own.
+        Windows too short to parse get None instead of a list of saccades.
+        """
+        results = [None] * len(x_windows)
+
+        # for smoothing
+        smf   = np.array([0.0033, 0.0238, 0.0971, 0.2259, 0.2998, 0.2259, 0.0971, 0.0238, 0.0033])
+        hsmf  = (smf.size - 1) // 2
+        t_int = 1000 / sample_frequency  # sample interval, in ms
+
+        # make sure there's data to be parsed
+        usable = [index for index, (x_position, y_position) in enumerate(zip(x_windows, y_windows))
+                  if len(x_position) == len(y_position) and len(x_position) >= len(smf)]
+        if not usable:
+            return results
+
+        # lay out windows with hsmf zeros between them, and note where each window landed
+        lengths = np.array([len(x_windows[index]) for index in usable])
+        padding = np.zeros(hsmf)
+        x_layout = np.concatenate([padding] + [part for index in usable for part in (x_windows[index], padding)])
+        y_layout = np.concatenate([padding] + [part for index in usable for part in (y_windows[index], padding)])
+        layout_starts = hsmf + np.concatenate(([0], np.cumsum(lengths + hsmf)[:-1]))
+        flat_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        flat_to_layout = np.arange(lengths.sum()) + np.repeat(layout_starts - flat_starts, lengths)
+
+        # smooth the curves
+        x_smooth = np.convolve(x_layout, smf, mode='same')
+        y_smooth = np.convolve(y_layout, smf, mode='same')
+
+        # get velocity, starting each window at 0
+        vel = np.concatenate(([0], np.sqrt(np.diff(x_smooth)**2 + np.diff(y_smooth)**2) / t_int))
+        vel[layout_starts] = 0
+        vel = vel[flat_to_layout]
+
+        # sub out each window's median
+        # (a partition per window is cheaper here than one sort over all windows)
+        medians = np.array([np.median(vel[flat_start:flat_start + length]) for flat_start, length in zip(flat_starts, lengths)])
+        vels = vel - np.repeat(medians, lengths)
+        acc  = np.convolve([0.2, 0.2, 0.2, 0.2, 0.2], np.diff(vels), mode='valid')
+
+        for index, layout_start, flat_start, length in zip(usable, layout_starts, flat_starts, lengths):
+            results[index] = self.parse_saccades(
+                x_smooth[layout_start:layout_start + length],
+                y_smooth[layout_start:layout_start + length],
+                vels[flat_start:flat_start + length],
+                acc[flat_start:flat_start + length - 5],
+                fp_off_times[index],
+                sample_frequency
+            )
+        return results
+
+    def parse_saccades(
+        self,
+        x_position: np.ndarray,
+        y_position: np.ndarray,
+        vels: np.ndarray,
+        acc: np.ndarray,
+        fp_off_time: float,
+        sample_frequency: float
+    ) -> list[dict] | dict[str, list]:
+        """Parse saccades from one window of smoothed gaze position, median-subtracted velocity, and acceleration."""
+
+        # default return, filled in place as saccades are found, one row per saccade and one column per SACCADE_DTYPE field
+        saccades = np.empty((self.max_saccades, len(SACCADE_DTYPE.names)))
+        saccade_count = 0
+
+        # find the start of every string of 5 consecutive velocities >= min peak, all at once
+        peak_runs = run_starts(vels >= self.velocity_peak_threshold_deg_per_ms, 5)
+
+        # so we don't have to keep checking the same samples
+        last_end = 0
+        search_from = 0
+
+        while saccade_count < self.max_saccades:
+            # find first string of 5 consecutive velocities bigger than peak
+            run_index = np.searchsorted(peak_runs, search_from)
+            if run_index >= peak_runs.size:
+                break
+            run_begin = peak_runs[run_index]
+            run_end = run_begin + 4
+
+            sac_begin = np.nan
+            # sac begins at earliest of acc > A_MIN &
+            # vel > VI_MIN -OR- acc < -A_MIN & vel < VP_MIN
+            acc_thresh = np.where(acc[last_end:run_begin] < self.acceleration_threshold_deg_per_ms2)
+            other_thresh = np.where(np.logical_or(vels[last_end:run_begin] <= self.velocity_threshold_deg_per_ms,
+                                                                np.logical_and(acc[last_end:run_begin] < -self.acceleration_threshold_deg_per_ms2,
+                                                                                vels[last_end:run_begin] < self.velocity_peak_threshold_deg_per_ms)))
+            if acc_thresh[0].size !=0:
+                acc_thresh = acc_thresh[0][-1]
+                
+                if other_thresh[0].size != 0:
+                    # other threshold also passed
+                    sac_begin = last_end + min(acc_thresh,other_thresh[0][-1])
+                else:
+                    # No other threshold besides acc
+                    sac_begin = last_end + acc_thresh
+            elif other_thresh[0].size != 0:
+                # other threshold passed
+                # ignore the acc_thresh possibility
+                inds = other_thresh[0][-1]
+                if inds.size > 1:
+                    sac_begin = last_end + min(inds)
+                else:
+                    sac_begin = last_end + inds
+
+            # sac ends at first acc > -A_MIN after deceleration. the -5 accounts
+            # for the acc smoothing.
+            acc_thresh = np.where(acc[run_end+1:] < self.acceleration_threshold_deg_per_ms2)
+            if acc_thresh[0].size !=0:
+                decel = run_end + acc_thresh[0][0]
+            else:
+                decel = np.nan
+
+            # check if any found
+            if np.isnan(sac_begin) or np.isnan(decel):
+                # new start point
+                last_end = run_end
+                search_from = run_end
+            else:
+                # new start point
+                acc_decel_thresh = np.where(acc[decel+1:-1] > -self.acceleration_threshold_deg_per_ms2)
+                vels_decel_thresh = np.where(vels[decel:-2] <= 0.005)
+
+                if acc_decel_thresh[0].size !=0 and vels_decel_thresh[0].size !=0:
+                    acc_decel_thresh = acc_decel_thresh[0][0]
+                    vels_decel_thresh = vels_decel_thresh[0][0]
+                    sac_end = decel - 5 + max(acc_decel_thresh,vels_decel_thresh)
+                elif acc_decel_thresh[0].size !=0:
+                    acc_decel_thresh = acc_decel_thresh[0][0]
+                    sac_end = decel - 5 + acc_decel_thresh
+                elif vels_decel_thresh[0].size !=0:
+                    vels_decel_thresh = vels_decel_thresh[0][0]
+                    sac_end = decel - 5 + vels_decel_thresh
+                else:
+                    sac_end = decel - 5
+                    
+                # vector distance
+                len_ = np.sqrt((x_position[sac_end] - x_position[sac_begin-1])**2 +
+                            (y_position[sac_end] - y_position[sac_begin-1])**2)
+                # technically, the saccade could be sufficiently long, but not end up in a reasonable spot
+                end_pos_len = np.sqrt((x_position[sac_end])**2 +
+                            (y_position[sac_end])**2)
+
+                # Saccades must meet multiple criteria in addition to exceeding our velocity/acceleration thresholds:
+                # 1) The length of the saccade exceeds some threshold
+                # 2) The end position of the saccade is greater than a minimum distance threshold
+                # 3) The end position of the saccade is less than a maximum distance threshold
+                # 4) MAYBE: The saccade latency cannot be greater than Rex's recorded time that the target was acquired
+                # Get start/end times wrt fixation off.
+                sac_start_time = fp_off_time + (sac_begin + 1) / sample_frequency
+                sac_end_time = fp_off_time + (sac_end + 1) / sample_frequency
+                sac_duration = sac_end_time - sac_start_time
+                if len_ >= self.min_length_deg and end_pos_len>5 and end_pos_len<18: #and (sac_end_time-fp_off_time)<targAcq_latency:
+                    # return stuff
+                    saccades[saccade_count] = (
+                        sac_start_time,
+                        sac_end_time,
+                        np.max(vels[sac_begin:sac_end]),
+                        len_ / sac_duration,
+                        x_position[sac_begin],
+                        y_position[sac_begin],
+                        x_position[sac_end],
+                        y_position[sac_end],
+                        np.sum(vels[sac_begin:sac_end])/sample_frequency,
+                        len_,
+                    )
+                    saccade_count += 1
+
+                # new start point
+                search_from = max(run_begin, sac_end + 1)
+                last_end = sac_end + 1
+
+        # add final sac if eye position of final sac is different
+        # than position at 300 ms
+        # (columns 0 and 1 are t_start and t_end)
+        if saccade_count < self.max_saccades and (saccade_count == 0 or saccades[saccade_count - 1, 1] + saccades[saccade_count - 1, 0] < 500):
+            saccades[saccade_count] = NO_SACCADE
+            saccade_count += 1
+
+        return self.format_saccades(saccades[:saccade_count])
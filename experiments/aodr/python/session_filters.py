@@ -0,0 +1,197 @@
+import importlib
+import logging
+
+import numpy as np
+from scipy.signal import oaconvolve
+
+from pyramid.model.model import BufferData
+from pyramid.model.signals import SignalChunk
+from pyramid.neutral_zone.readers.readers import Reader
+from pyramid.neutral_zone.transformers.transformers import Transformer
+
+from AODR_custom_enhancers import FusedGazeSmoother
+
+
+class StreamingSmoother(Transformer):
+    """Smooth a continuous signal once for the whole session, chunk by chunk as a reader streams it.
+
+    This applies a Savitzky-Golay filter, optionally followed by a Gaussian filter, using overlap-save:
+    each chunk is convolved along with the tail of the previous chunks, and samples are only passed on
+    once the next chunk has arrived with enough samples to filter them fully.  So output chunks lag the
+    input by half the filter length.  At the end of the session, flush() passes on the held back samples,
+    with the same edge handling as at the start.  Pyramid doesn't tell transformers when a stream ends,
+    so use SmoothingReader, below, to get the flush.
+
+    Compared to smoothing each trial with SignalSmoother, this smooths overlapping trial windows only once
+    and has no edge artifacts at trial boundaries.  The session's first and last samples get the same edge
+    handling that savgol_filter and gaussian_filter1d would give when filtering the whole session at once.
+
+    Args:
+        window_size:    Savitzky-Golay window size in samples, must be odd (default 3001).
+        poly_order:     Savitzky-Golay polynomial order (default 2).
+        gaussian_std:   Gaussian standard deviation in samples, or 0 for Savitzky-Golay only (default 0).
+    """
+
+    def __init__(
+        self,
+        window_size: int = 3001,
+        poly_order: int = 2,
+        gaussian_std: float = 0
+    ) -> None:
+        self.window_size = window_size
+        self.poly_order = poly_order
+        self.gaussian_std = gaussian_std
+
+        # Same combined kernel and two-stage edge filtering as the per-trial FusedGazeSmoother.
+        self.fused_smoother = FusedGazeSmoother(buffer_names=[], channel_ids=[], window_size=window_size, poly_order=poly_order, gaussian_std=gaussian_std)
+        self.kernel = self.fused_smoother.kernel
+        self.edge_size = self.fused_smoother.edge_size
+
+        # Input samples carried over from previous chunks, the time of the first one,
+        # and how many of them at the end haven't been passed on yet.
+        self.held_samples = None
+        self.held_start_time = None
+        self.pending_count = 0
+        self.started = False
+        self.sample_frequency = None
+        self.channel_ids = None
+
+    def smooth_chunk(self, chunk: SignalChunk) -> SignalChunk:
+        if self.held_samples is None:
+            samples = chunk.sample_data
+            start_time = chunk.first_sample_time
+        else:
+            samples = np.concatenate([self.held_samples, chunk.sample_data], axis=0)
+            start_time = self.held_start_time
+        self.sample_frequency = chunk.sample_frequency
+        self.channel_ids = chunk.channel_ids
+
+        edge_size = self.edge_size
+        sample_count = samples.shape[0]
+        first_pending = sample_count - self.pending_count - chunk.sample_data.shape[0]
+        if sample_count < self.kernel.size:
+            # Not enough to filter anything yet.
+            smoothed = samples[:0]
+            output_start_time = start_time
+        elif not self.started:
+            # The very start of the session: use the filters' own edge handling, then convolve the rest.
+            head = self.fused_smoother.smooth_in_stages(samples[:self.kernel.size])[:edge_size]
+            interior = oaconvolve(samples, self.kernel[:, np.newaxis], mode="valid", axes=0)
+            smoothed = np.concatenate([head, interior], axis=0)
+            output_start_time = start_time
+            self.started = True
+        else:
+            # Held samples before first_pending were already passed on and are here only as context.
+            smoothed = oaconvolve(samples[first_pending - edge_size:], self.kernel[:, np.newaxis], mode="valid", axes=0)
+            output_start_time = start_time + first_pending / chunk.sample_frequency
+
+        # Carry over enough samples to filter the ones not passed on yet, now or in flush().
+        if self.started:
+            self.pending_count = edge_size
+            carry_count = min(sample_count, self.kernel.size)
+        else:
+            self.pending_count = sample_count
+            carry_count = sample_count
+        self.held_samples = samples[sample_count - carry_count:].copy()
+        self.held_start_time = start_time + (sample_count - carry_count) / chunk.sample_frequency
+
+        return SignalChunk(smoothed, chunk.sample_frequency, output_start_time, chunk.channel_ids)
+
+    def flush(self) -> SignalChunk:
+        """Pass on the samples still held back at the end of the session, or None if there aren't any."""
+        if self.held_samples is None or self.pending_count == 0:
+            return None
+
+        held_count = self.held_samples.shape[0]
+        if held_count >= self.kernel.size:
+            # The very end of the session: use the filters' own edge handling, like at the start.
+            smoothed = self.fused_smoother.smooth_in_stages(self.held_samples[-self.kernel.size:])[-self.pending_count:]
+        elif held_count >= self.window_size:
+            smoothed = self.fused_smoother.smooth_in_stages(self.held_samples)[-self.pending_count:]
+        else:
+            logging.warning(f"StreamingSmoother got only {held_count} samples, fewer than window_size {self.window_size}, passing them on unsmoothed.")
+            smoothed = self.held_samples[-self.pending_count:]
+        output_start_time = self.held_start_time + (held_count - self.pending_count) / self.sample_frequency
+
+        self.held_samples = None
+        self.pending_count = 0
+        return SignalChunk(smoothed, self.sample_frequency, output_start_time, self.channel_ids)
+
+    def transform(self, data: BufferData):
+        if isinstance(data, SignalChunk):
+            return self.smooth_chunk(data)
+        else:
+            logging.warning(f"StreamingSmoother doesn't know how to apply to {data.__class__.__name__}")
+        return data
+
+
+class SmoothingReader(Reader):
+    """Wrap another Pyramid reader and smooth its signal results with StreamingSmoother.
+
+    When the wrapped reader runs out, this returns one more result with each smoother's flush(),
+    so the end of the session isn't lost.  Any args not listed below go to the wrapped reader,
+    so command line overrides like --readers gaze_x_reader.session_dir=... still work.
+
+    Smoothed results lag the wrapped reader's by half the filter length (about 51 ms for window_size 3001
+    and gaussian_std 5 at 30 kHz), until the flush.  That's OK for trials: Pyramid reads each reader until
+    the data in its buffers reach past the end of the trial being delimited, going by sample times, so a trial
+    that ends near the end of a chunk just waits for the next read to get the rest of its samples.
+    test_session_filters.py checks this, reading trial windows the same way.
+
+    Args:
+        reader_class:   Import spec of the reader to wrap, like "pyramid.neutral_zone.readers.open_ephys_session.OpenEphysSessionTimeSeriesReader".
+        result_names:   Names of the wrapped reader's results to smooth (default None -- all signal results).
+        window_size:    Savitzky-Golay window size in samples, must be odd (default 3001).
+        poly_order:     Savitzky-Golay polynomial order (default 2).
+        gaussian_std:   Gaussian standard deviation in samples, or 0 for Savitzky-Golay only (default 0).
+    """
+
+    def __init__(
+        self,
+        reader_class: str,
+        result_names: list[str] = None,
+        window_size: int = 3001,
+        poly_order: int = 2,
+        gaussian_std: float = 0,
+        **reader_args
+    ) -> None:
+        (module_name, _, class_name) = reader_class.rpartition(".")
+        self.reader = getattr(importlib.import_module(module_name), class_name)(**reader_args)
+        self.result_names = result_names
+        self.window_size = window_size
+        self.poly_order = poly_order
+        self.gaussian_std = gaussian_std
+        self.smoothers = {}
+        self.exhausted = False
+
+    def __enter__(self):
+        self.reader.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.reader.__exit__(exc_type, exc_value, traceback)
+
+    def get_initial(self) -> dict[str, BufferData]:
+        return self.reader.get_initial()
+
+    def read_next(self) -> dict[str, BufferData]:
+        if self.exhausted:
+            raise StopIteration
+
+        try:
+            results = self.reader.read_next()
+        except StopIteration:
+            self.exhausted = True
+            flushed = {name: smoother.flush() for name, smoother in self.smoothers.items()}
+            flushed = {name: chunk for name, chunk in flushed.items() if chunk is not None}
+            if not flushed:
+                raise
+            return flushed
+
+        if results:
+            for name, data in results.items():
+                if isinstance(data, SignalChunk) and (self.result_names is None or name in self.result_names):
+                    if name not in self.smoothers:
+                        self.smoothers[name] = StreamingSmoother(self.window_size, self.poly_order, self.gaussian_std)
+                    results[name] = self.smoothers[name].smooth_chunk(data)
+        return results
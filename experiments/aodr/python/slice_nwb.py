@@ -0,0 +1,240 @@
+import argparse
+
+import numpy as np
+from pynwb import NWBHDF5IO, NWBFile, TimeSeries
+from pynwb.misc import AnnotationSeries
+from pynwb.ecephys import ElectricalSeries
+from hdmf.common.table import DynamicTableRegion
+from hdmf.data_utils import GenericDataChunkIterator
+
+from trim_rec import find_time_range, copy_electrodes, compressed
+from trim_rec import default_chunk_rows, default_compression, default_compression_level, default_shuffle
+
+# Usage:
+# Slice one or more time windows (in seconds) out of every acquisition series in an Open Ephys NWB file, like:
+#   python slice_nwb.py experiment1.nwb sliced.nwb --window 100 400 --window 1200 1500
+#   python slice_nwb.py experiment1.nwb sliced.nwb --window 100 400 --window 1200 1500 --split  # writes sliced_0.nwb and sliced_1.nwb
+#
+# This finds all the TimeSeries in the acquisition group, including ElectricalSeries for neuropixel AP/LFP, NI-DAQ streams,
+# TTL events, and messages, and keeps the samples of each with timestamps in any of the windows.  By default the windows are
+# concatenated into one output file, with explicit timestamps so the gaps are still visible.  With --split, each window goes to its own file.
+#
+# Like trim_rec.py, window boundaries are found by binary search and continuous data is copied a chunk at a time.  Windows are sorted
+# by start time, so each source dataset is read once, front to back, however many windows there are (unless the windows overlap).
+# Continuous data is chunked and compressed the same way as trim_rec.py, with the same --chunk-rows, --compression, and --shuffle options.
+
+
+class RangesIterator(GenericDataChunkIterator):
+    """Write several row ranges of a source, one after another, a buffer of rows at a time.
+
+    Args:
+        read_rows:      Function that takes start and stop rows and returns those rows from the source, like dataset[start:stop]
+        row_shape:      Shape of each row, after the first dimension, like (num_channels,) or ()
+        dtype:          Data type of the rows
+        ranges:         List of [start, stop) row ranges to write, in order
+        buffer_rows:    How many rows to read and write at once
+        chunk_rows:     How many rows in each HDF5 chunk of the output (default 1s at 30kHz)
+    """
+
+    def __init__(self, read_rows, row_shape: tuple, dtype: np.dtype, ranges: list[tuple[int, int]], buffer_rows: int = 300000, chunk_rows: int = default_chunk_rows, **kwargs):
+        self.read_rows = read_rows
+        self.row_shape = tuple(row_shape)
+        self.row_dtype = np.dtype(dtype)
+        self.ranges = ranges
+        # Where each range starts in the output.
+        self.output_starts = np.cumsum([0] + [stop - start for start, stop in ranges])
+
+        # Buffers need to be a whole number of chunks, as GenericDataChunkIterator requires.
+        row_count = max(int(self.output_starts[-1]), 1)
+        chunk_rows = min(chunk_rows, row_count)
+        buffer_rows = min(max(buffer_rows // chunk_rows, 1) * chunk_rows, row_count)
+        super().__init__(
+            buffer_shape=(buffer_rows,) + self.row_shape,
+            chunk_shape=(chunk_rows,) + self.row_shape,
+            display_progress=kwargs.pop('display_progress', False),
+            **kwargs
+        )
+
+    def _get_data(self, selection: tuple[slice]) -> np.ndarray:
+        # Map output rows back to source rows, possibly spanning the end of one range and the start of the next.
+        rows = selection[0]
+        pieces = []
+        for (start, stop), output_start in zip(self.ranges, self.output_starts):
+            low = max(rows.start, output_start)
+            high = min(rows.stop, output_start + stop - start)
+            if low < high:
+                pieces.append(self.read_rows(start + low - output_start, start + high - output_start))
+        data = np.concatenate(pieces, axis=0) if len(pieces) > 1 else pieces[0]
+        return data[(slice(None),) + tuple(selection[1:])]
+
+    def _get_maxshape(self) -> tuple[int]:
+        return (int(self.output_starts[-1]),) + self.row_shape
+
+    def _get_dtype(self) -> np.dtype:
+        return self.row_dtype
+
+
+def series_times(series):
+    # Timestamps for a series, as a dataset, or as a function of row for series with a starting time and rate.
+    if series.timestamps is not None:
+        timestamps = series.timestamps
+        return (timestamps, lambda start, stop: timestamps[start:stop])
+    starting_time = series.starting_time or 0.0
+    rate = series.rate
+    return (None, lambda start, stop: starting_time + np.arange(start, stop) / rate)
+
+
+def window_rows(series, windows: list[tuple[float, float]]) -> list[tuple[int, int]]:
+    """Find the [start, stop) rows of the series with timestamps in each window."""
+    (timestamps, _) = series_times(series)
+    row_count = len(series.data)
+    ranges = []
+    for (start_time, end_time) in windows:
+        if timestamps is not None:
+            (start, stop) = find_time_range(timestamps, start_time, end_time)
+        else:
+            starting_time = series.starting_time or 0.0
+            start = min(max(int(np.ceil((start_time - starting_time) * series.rate)), 0), row_count)
+            stop = min(max(int(np.ceil((end_time - starting_time) * series.rate)), 0), row_count)
+        ranges.append((start, max(start, stop)))
+    return ranges
+
+
+def read_ranges(dataset, ranges: list[tuple[int, int]]):
+    # For small or non-numeric series like messages, just read the ranges.
+    pieces = [dataset[start:stop] for start, stop in ranges if stop > start]
+    if not pieces:
+        return dataset[0:0]
+    return np.concatenate(pieces, axis=0)
+
+
+def slice_series(series, ranges: list[tuple[int, int]], nwb_out: NWBFile, buffer_rows: int, layout: dict):
+    """Make a copy of the given acquisition series with just the given row ranges.
+
+    Layout has HDF5 options for continuous data: chunk_rows, compression, compression_level, and shuffle, as in trim_rec.py.
+    """
+    (timestamps, read_times) = series_times(series)
+    data = series.data
+    row_count = sum(stop - start for start, stop in ranges)
+
+    if row_count == 0 or data.dtype.kind not in 'biuf':
+        new_data = read_ranges(data, ranges)
+        new_timestamps = read_ranges(timestamps, ranges) if timestamps is not None else np.concatenate([read_times(start, stop) for start, stop in ranges] + [np.empty(0)])
+    else:
+        chunk_rows = layout.get('chunk_rows', default_chunk_rows)
+        new_data = RangesIterator(lambda start, stop: data[start:stop], data.shape[1:], data.dtype, ranges, buffer_rows, chunk_rows, display_progress=True)
+        compression = layout.get('compression', default_compression)
+        compression_level = layout.get('compression_level', default_compression_level)
+        new_data = compressed(new_data, compression, compression_level, layout.get('shuffle', default_shuffle))
+        new_timestamps = RangesIterator(read_times, (), np.float64, ranges, buffer_rows, chunk_rows)
+        new_timestamps = compressed(new_timestamps, compression, compression_level)
+
+    kwargs = dict(name=series.name, data=new_data, timestamps=new_timestamps, description=series.description, comments=series.comments)
+
+    if isinstance(series, ElectricalSeries):
+        electrodes_region = DynamicTableRegion(
+            name='electrodes',
+            data=series.electrodes.data[:],
+            description=series.electrodes.description,
+            table=nwb_out.electrodes
+        )
+        return ElectricalSeries(
+            electrodes=electrodes_region,
+            channel_conversion=series.channel_conversion[:] if series.channel_conversion is not None else None,
+            filtering=series.filtering,
+            conversion=series.conversion,
+            offset=series.offset,
+            **kwargs
+        )
+    elif isinstance(series, AnnotationSeries):
+        return AnnotationSeries(name=series.name, data=new_data, timestamps=new_timestamps, description=series.description)
+    else:
+        return TimeSeries(unit=series.unit, conversion=series.conversion, offset=series.offset, **kwargs)
+
+
+def new_nwb_file(nwb_in, suffix: str) -> NWBFile:
+    # Create new NWBFile, copying metadata
+    return NWBFile(
+        session_description=nwb_in.session_description,
+        identifier=nwb_in.identifier + suffix,
+        session_start_time=nwb_in.session_start_time,
+        experimenter=nwb_in.experimenter,
+        lab=nwb_in.lab,
+        institution=nwb_in.institution,
+        experiment_description=nwb_in.experiment_description,
+        subject=nwb_in.subject,
+    )
+
+
+def write_windows(nwb_in, output_path: str, windows: list[tuple[float, float]], suffix: str, buffer_rows: int, layout: dict):
+    nwb_out = new_nwb_file(nwb_in, suffix)
+    if nwb_in.electrodes is not None:
+        copy_electrodes(nwb_in, nwb_out)
+
+    for series in nwb_in.acquisition.values():
+        if not isinstance(series, TimeSeries):
+            print(f"Skipping {series.name}, which is a {series.__class__.__name__}, not a TimeSeries")
+            continue
+        ranges = window_rows(series, windows)
+        print(f"{series.name}: keeping {sum(stop - start for start, stop in ranges)} of {len(series.data)} rows")
+        nwb_out.add_acquisition(slice_series(series, ranges, nwb_out, buffer_rows, layout))
+
+    with NWBHDF5IO(output_path, 'w') as out_io:
+        out_io.write(nwb_out)
+
+
+def slice_nwb(input_path: str, output_path: str, windows: list[tuple[float, float]], split: bool = False, buffer_rows: int = 300000, **layout) -> list[str]:
+    """Slice the given time windows out of every acquisition series of an NWB file.
+
+    Args:
+        input_path:     NWB file to read
+        output_path:    NWB file to write, or with split=True the pattern for several, like "sliced.nwb" for "sliced_0.nwb", "sliced_1.nwb", ...
+        windows:        List of [start, end) times in seconds
+        split:          Whether to write each window to its own file, instead of concatenating them all into one
+        buffer_rows:    How many samples of continuous data to copy at a time, which bounds memory use
+        layout:         HDF5 chunk_rows, compression, compression_level, and shuffle for continuous data, as in trim_rec.py
+    """
+    windows = sorted((float(start), float(end)) for start, end in windows)
+    with NWBHDF5IO(input_path, 'r') as io:
+        nwb_in = io.read()
+        if not split:
+            write_windows(nwb_in, output_path, windows, "_sliced", buffer_rows, layout)
+            return [output_path]
+
+        output_paths = []
+        (stem, dot, extension) = output_path.rpartition(".")
+        for index, window in enumerate(windows):
+            window_path = f"{stem}_{index}.{extension}" if dot else f"{output_path}_{index}"
+            print(f"Writing window {window} to {window_path}")
+            write_windows(nwb_in, window_path, [window], f"_window_{index}", buffer_rows, layout)
+            output_paths.append(window_path)
+        return output_paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Slice time windows out of every acquisition series in an NWB file.")
+    parser.add_argument("input", help="NWB file to read")
+    parser.add_argument("output", help="NWB file to write (with --split, files named like output_0.nwb, output_1.nwb, ...)")
+    parser.add_argument("--window", nargs=2, type=float, action="append", required=True, metavar=("START", "END"), help="a time window in seconds, can be repeated")
+    parser.add_argument("--split", action="store_true", help="write each window to its own file instead of concatenating them")
+    parser.add_argument("--chunk-samples", type=int, default=300000, help="samples of continuous data to copy at a time (default 300000, 10s at 30kHz)")
+    parser.add_argument("--chunk-rows", type=int, default=default_chunk_rows, help=f"samples per HDF5 chunk of continuous output (default {default_chunk_rows})")
+    parser.add_argument("--compression", choices=["none", "gzip", "lzf"], default=default_compression, help=f"lossless compression for continuous output (default {default_compression})")
+    parser.add_argument("--compression-level", type=int, default=default_compression_level, help=f"gzip level 0-9 (default {default_compression_level})")
+    parser.add_argument("--shuffle", action=argparse.BooleanOptionalAction, default=default_shuffle, help="shuffle bytes before compression, good for int16 samples")
+    cli_args = parser.parse_args(argv)
+    slice_nwb(
+        cli_args.input,
+        cli_args.output,
+        cli_args.window,
+        cli_args.split,
+        cli_args.chunk_samples,
+        chunk_rows=cli_args.chunk_rows,
+        compression=cli_args.compression,
+        compression_level=cli_args.compression_level,
+        shuffle=cli_args.shuffle
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import argparse
+import json
+
+import h5py
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+
+# Usage:
+# Check the lag (and drift) between two analog streams that record the same signal, like the acquisition board and the NI-DAQ,
+# without opening the viewer.  In a terminal, activate the gold_pipelines environment, cd to this directory, and run:
+#   python stream_lag.py "Raw/MrM_2025-09-26_13-28-03/Record Node 107/experiment1.nwb"
+#   python stream_lag.py experiment1.nwb --stream-a acquisition_board --stream-b PXIe-6363 --channel 0 --max-lag 0.05 --output drift.csv --plot drift.png
+#
+# Both streams are interpolated onto a common time base at the lower of their sample rates, cut into overlapping windows,
+# and each window of one stream is cross-correlated with the same window of the other.  Instead of one scipy correlate() per window,
+# a batch of windows goes through one set of FFTs, with overlapping windows sharing the work (see windowed_lags()), and only lags up
+# to --max-lag are searched.  The streams are read a batch at a time, so memory doesn't depend on session length.
+#
+# A positive lag means stream A is behind stream B: something that happens at time t in B shows up at t + lag in A.
+# If the streams are aligned the lag stays near 0.  A lag that grows steadily over the session is clock drift.
+
+
+def find_index(timestamps, time: float) -> int:
+    # Like np.searchsorted(timestamps, time), but reading only log2(n) values from a possibly huge HDF5 dataset.
+    if isinstance(timestamps, np.ndarray):
+        return int(np.searchsorted(timestamps, time, side='left'))
+    low = 0
+    high = len(timestamps)
+    while low < high:
+        mid = (low + high) // 2
+        if timestamps[mid] < time:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+
+def read_interpolated(timestamps, data, channel: int, t_common: np.ndarray) -> np.ndarray:
+    # Read just the samples around t_common and interpolate them onto it.
+    start = max(find_index(timestamps, t_common[0]) - 1, 0)
+    end = min(find_index(timestamps, t_common[-1]) + 2, len(timestamps))
+    return np.interp(t_common, np.asarray(timestamps[start:end]), np.asarray(data[start:end, channel], dtype=np.float64))
+
+
+def windowed_lags(x: np.ndarray, y: np.ndarray, blocks_per_window: int, step_samples: int, max_lag_samples: int):
+    """Cross-correlate sliding windows of x and y with batched FFTs, searching lags from -max_lag_samples to max_lag_samples.
+
+    x has max_lag_samples extra samples on each side of y, so x[n + max_lag_samples] is at the same time as y[n].
+    Each window is blocks_per_window consecutive blocks of step_samples, and consecutive windows start one block apart.
+    Rather than correlating each window separately, which would transform every sample blocks_per_window times, this correlates
+    each block of y with the matching stretch of x (plus max_lag_samples on each side) once, in one batch of FFTs,
+    and adds up the blocks in each window (overlap-add).  Samples of x just outside a window count at nonzero lags,
+    instead of zeros, so there's no edge effect either.
+
+    Returns (lags, peaks) for each window, where lags are in samples, with parabolic interpolation between samples,
+    and peaks are the correlation coefficient at the best lag, normalized like a Pearson correlation.
+    """
+    lag_count = 2 * max_lag_samples + 1
+    block_count = len(y) // step_samples
+    window_count = block_count - blocks_per_window + 1
+    window_samples = blocks_per_window * step_samples
+    # Removing overall means doesn't change the correlations, and keeps the cumulative sums below accurate.
+    x = x - x.mean()
+    y = y - y.mean()
+
+    # Sums over each block, at each lag, of x[n + max_lag_samples + lag] * y[n].
+    y_blocks = y[:block_count * step_samples].reshape(block_count, step_samples)
+    x_blocks = np.lib.stride_tricks.sliding_window_view(x, step_samples + 2 * max_lag_samples)[::step_samples][:block_count]
+    fft_length = next_fast_len(step_samples + 2 * max_lag_samples)
+    block_products = irfft(rfft(x_blocks, fft_length, axis=1, workers=-1) * np.conj(rfft(y_blocks, fft_length, axis=1, workers=-1)), fft_length, axis=1, workers=-1)
+    block_products = block_products[:, :lag_count]
+
+    # Sums over each window, from cumulative sums over blocks.
+    cumulative = np.concatenate([np.zeros((1, lag_count)), np.cumsum(block_products, axis=0)])
+    products = cumulative[blocks_per_window:] - cumulative[:window_count]
+
+    # Remove each window's means: sum((x[n + lag] - mean_x) * (y[n] - mean_y)) = sum(x[n + lag] * y[n]) - mean_y * sum(x[n + lag]), since sum(y[n] - mean_y) = 0.
+    x_cumulative = np.concatenate([[0.0], np.cumsum(x)])
+    x_squared_cumulative = np.concatenate([[0.0], np.cumsum(x * x)])
+    y_cumulative = np.concatenate([[0.0], np.cumsum(y)])
+    y_squared_cumulative = np.concatenate([[0.0], np.cumsum(y * y)])
+    window_starts = np.arange(window_count) * step_samples
+    window_ends = window_starts + window_samples
+    shifted_starts = window_starts[:, np.newaxis] + np.arange(lag_count)
+    x_shifted_sums = x_cumulative[shifted_starts + window_samples] - x_cumulative[shifted_starts]
+    y_sums = y_cumulative[window_ends] - y_cumulative[window_starts]
+    correlation = products - (y_sums / window_samples)[:, np.newaxis] * x_shifted_sums
+
+    # Normalize by the unshifted windows, like the Pearson correlation at lag 0.
+    x_starts = window_starts + max_lag_samples
+    x_ends = window_ends + max_lag_samples
+    x_sums = x_cumulative[x_ends] - x_cumulative[x_starts]
+    x_variance = x_squared_cumulative[x_ends] - x_squared_cumulative[x_starts] - x_sums ** 2 / window_samples
+    y_variance = y_squared_cumulative[window_ends] - y_squared_cumulative[window_starts] - y_sums ** 2 / window_samples
+    norms = np.sqrt(np.clip(x_variance, 0, None) * np.clip(y_variance, 0, None))
+    norms[norms == 0] = np.inf
+    correlation /= norms[:, np.newaxis]
+
+    best = np.argmax(correlation, axis=1)
+    rows = np.arange(window_count)
+    peaks = correlation[rows, best]
+    # Fit a parabola through the peak and its neighbors, for lags finer than one sample.
+    inside = (best > 0) & (best < lag_count - 1)
+    left = correlation[rows[inside], best[inside] - 1]
+    center = peaks[inside]
+    right = correlation[rows[inside], best[inside] + 1]
+    denominator = left - 2 * center + right
+    offsets = np.zeros(window_count)
+    offsets[inside] = np.where(denominator != 0, 0.5 * (left - right) / np.where(denominator != 0, denominator, 1), 0.0)
+    lags = best - max_lag_samples + offsets
+    return (lags, peaks)
+
+
+def stream_lags(
+    timestamps_a,
+    data_a,
+    timestamps_b,
+    data_b,
+    channel: int = 0,
+    window_sec: float = 10.0,
+    step_sec: float = 2.0,
+    max_lag_sec: float = 0.05,
+    rate: float = None,
+    batch_windows: int = 256,
+    progress: bool = False
+) -> dict:
+    """Track the lag between two streams over time, with windowed cross-correlation.
+
+    Args:
+        timestamps_a:   Sample times of stream A, a numpy array or h5py dataset
+        data_a:         Samples x channels of stream A, a numpy array, h5py dataset, or anything sliced like data[start:end, channel]
+        timestamps_b:   Sample times of stream B
+        data_b:         Samples x channels of stream B
+        channel:        Which channel of each stream to compare
+        window_sec:     Length of each correlation window, rounded to a whole number of steps
+        step_sec:       Time between the starts of consecutive windows
+        max_lag_sec:    Only look for lags up to this big, either way
+        rate:           Sample rate for the common time base, or None for the lower rate of the two streams
+        batch_windows:  How many windows to read and correlate at once, which bounds memory use
+        progress:       Whether to show a tqdm progress bar over batches, if tqdm is installed
+
+    Returns a dict of numpy arrays "time" (window centers), "lag" (seconds), and "peak" (correlation at the lag).
+    """
+    if rate is None:
+        rate_a = (len(timestamps_a) - 1) / (timestamps_a[-1] - timestamps_a[0])
+        rate_b = (len(timestamps_b) - 1) / (timestamps_b[-1] - timestamps_b[0])
+        rate = min(rate_a, rate_b)
+    t_common_start = max(timestamps_a[0], timestamps_b[0])
+    t_common_end = min(timestamps_a[-1], timestamps_b[-1])
+    sample_count = int((t_common_end - t_common_start) * rate)
+    step_samples = int(step_sec * rate)
+    blocks_per_window = max(int(round(window_sec / step_sec)), 1)
+    window_samples = blocks_per_window * step_samples
+    max_lag_samples = min(int(np.ceil(max_lag_sec * rate)), window_samples - 1)
+    window_count = max((sample_count - window_samples) // step_samples + 1, 0)
+
+    times = []
+    lags = []
+    peaks = []
+    batches = range(0, window_count, batch_windows)
+    if progress:
+        try:
+            from tqdm import tqdm
+            batches = tqdm(batches, desc='Cross-correlation')
+        except ImportError:
+            pass
+    for first_window in batches:
+        last_window = min(first_window + batch_windows, window_count)
+        first_sample = first_window * step_samples
+        end_sample = (last_window - 1) * step_samples + window_samples
+        t_common = t_common_start + np.arange(first_sample, end_sample) / rate
+        # Read max_lag_samples extra on each side of stream A, for nonzero lags at the edges of the batch.
+        t_extended = t_common_start + np.arange(first_sample - max_lag_samples, end_sample + max_lag_samples) / rate
+        x = read_interpolated(timestamps_a, data_a, channel, t_extended)
+        y = read_interpolated(timestamps_b, data_b, channel, t_common)
+        (batch_lags, batch_peaks) = windowed_lags(x, y, blocks_per_window, step_samples, max_lag_samples)
+        times.append(t_common[0] + (np.arange(last_window - first_window) * step_samples + window_samples // 2) / rate)
+        lags.append(batch_lags / rate)
+        peaks.append(batch_peaks)
+
+    if not times:
+        return {"time": np.empty(0), "lag": np.empty(0), "peak": np.empty(0)}
+    return {"time": np.concatenate(times), "lag": np.concatenate(lags), "peak": np.concatenate(peaks)}
+
+
+def summarize_lags(result: dict, min_peak: float = 0.5) -> dict:
+    # Overall lag and drift, from windows where the streams actually correlate.
+    good = result["peak"] >= min_peak
+    summary = {"windows": int(result["time"].size), "good_windows": int(good.sum()), "min_peak": min_peak}
+    if good.sum() >= 2:
+        (slope, intercept) = np.polyfit(result["time"][good], result["lag"][good], 1)
+        summary.update({
+            "median_lag_s": float(np.median(result["lag"][good])),
+            "lag_range_s": [float(result["lag"][good].min()), float(result["lag"][good].max())],
+            "drift_s_per_hour": float(slope * 3600),
+        })
+    return summary
+
+
+def find_stream(acquisition, name_part: str) -> str:
+    # First continuous stream in the NWB acquisition group with name_part in its name.
+    for name in acquisition.keys():
+        if name_part in name and "TTL" not in name and "data" in acquisition[name] and "timestamps" in acquisition[name]:
+            return name
+    raise ValueError(f"No stream with '{name_part}' in its name, found: {list(acquisition.keys())}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Track the lag between two analog streams in an Open Ephys NWB file.")
+    parser.add_argument("nwb_file", help="Open Ephys NWB file")
+    parser.add_argument("--stream-a", default="acquisition_board", help="part of the name of the first stream (default acquisition_board)")
+    parser.add_argument("--stream-b", default="PXIe-6363", help="part of the name of the second stream (default PXIe-6363)")
+    parser.add_argument("--channel", type=int, default=0, help="channel to compare in both streams (default 0)")
+    parser.add_argument("--window", type=float, default=10.0, help="correlation window in seconds (default 10)")
+    parser.add_argument("--step", type=float, default=2.0, help="step between windows in seconds (default 2)")
+    parser.add_argument("--max-lag", type=float, default=0.05, help="largest lag to look for in seconds (default 0.05)")
+    parser.add_argument("--min-peak", type=float, default=0.5, help="ignore windows with lower peak correlation in the summary (default 0.5)")
+    parser.add_argument("--output", default=None, help="CSV file for time, lag, and peak of each window")
+    parser.add_argument("--summary", default=None, help="JSON file for the summary")
+    parser.add_argument("--plot", default=None, help="image file for a plot of lag and peak correlation over time")
+    cli_args = parser.parse_args(argv)
+
+    with h5py.File(cli_args.nwb_file, "r") as nwb:
+        acquisition = nwb["acquisition"]
+        stream_a = find_stream(acquisition, cli_args.stream_a)
+        stream_b = find_stream(acquisition, cli_args.stream_b)
+        print(f"Comparing channel {cli_args.channel} of {stream_a} (A) and {stream_b} (B)")
+        result = stream_lags(
+            acquisition[stream_a]["timestamps"],
+            acquisition[stream_a]["data"],
+            acquisition[stream_b]["timestamps"],
+            acquisition[stream_b]["data"],
+            channel=cli_args.channel,
+            window_sec=cli_args.window,
+            step_sec=cli_args.step,
+            max_lag_sec=cli_args.max_lag,
+            progress=True
+        )
+
+    summary = summarize_lags(result, cli_args.min_peak)
+    summary.update({"nwb_file": cli_args.nwb_file, "stream_a": stream_a, "stream_b": stream_b, "channel": cli_args.channel})
+    print(json.dumps(summary, indent=2))
+
+    if cli_args.output is not None:
+        np.savetxt(cli_args.output, np.column_stack([result["time"], result["lag"], result["peak"]]), delimiter=",", header="time,lag,peak", comments="")
+    if cli_args.summary is not None:
+        with open(cli_args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+    if cli_args.plot is not None:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        (fig, (ax_lag, ax_peak)) = plt.subplots(2, 1, figsize=(10, 6), sharex=True)
+        ax_lag.plot(result["time"], result["lag"] * 1000, color="orange")
+        ax_lag.set_ylabel("Lag A - B (ms)")
+        ax_lag.set_title(f"{stream_a} vs {stream_b}, channel {cli_args.channel}")
+        ax_peak.plot(result["time"], result["peak"], color="purple")
+        ax_peak.set_ylabel("Peak correlation")
+        ax_peak.set_xlabel("Time (s)")
+        fig.tight_layout()
+        fig.savefig(cli_args.plot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from message_index import MessageIndex
+
+# Check how well "UDP Events sync" text messages line up with the TTL sync pulses they announce, without opening a viewer.
+# For each Open Ephys session this pairs each sync message with the nearest TTL line 1 rising edge and reports:
+#   - residuals: message timestamp minus edge timestamp, and @timestamp (from the UDPEvents plugin) minus edge timestamp
+#   - drift: the slope of a line fit to the residuals over time, in seconds per hour
+#   - jitter: what's left of the residuals after taking out the line, as std, median absolute, 95th and 99th percentile, and max absolute
+#   - missing syncs: TTL edges with no message within --tolerance, and extra syncs: messages with no TTL edge within --tolerance
+#
+# Each session gets a <session>_sync.json report and a <session>_sync.png plot in --output-dir, and sync_quality_summary.json lists them all.
+# Sessions run in parallel worker processes, like Pyramid_Batch_OE.py.  Since this reads only events and messages, not the
+# continuous data, it's quick enough to run before every conversion, and exits with status 1 if any session fails the checks.
+#
+#   cd Lab_Pipelines/experiments/aodr/python
+#   conda activate gold_pipelines
+#   python sync_quality_report.py --directory /path/to/Raw/Neuronal --output-dir sync_reports
+#   python sync_quality_report.py --session /path/to/MrM_2025-09-26_13-28-03 --output-dir sync_reports --max-jitter 0.001
+
+# TTL stream and line the sync pulses go to.
+ttl_stream = "acquisition_board"
+ttl_line = 1
+
+# Largest residual, in seconds, for a sync message and TTL edge to count as a pair.
+tolerance = 0.05
+
+# Limits for a session to pass: jitter 99th percentile in seconds, and fraction of TTL edges or messages left unpaired.
+max_jitter = 0.002
+max_unpaired_fraction = 0.01
+
+
+def rising_edges(ttl_events, stream_name: str, line: int) -> np.ndarray:
+    """Sorted times where a TTL line goes high, ignoring repeated highs, like TtlEdgeIndex in plot_analog_ttl_messages.py."""
+    events = ttl_events[(ttl_events.stream_name == stream_name) & (ttl_events.line == line)].sort_values("timestamp", kind="stable")
+    times = events.timestamp.to_numpy(dtype=float)
+    high = events.state.to_numpy() == 1
+    previous_high = np.concatenate([[False], high[:-1]])
+    return times[high & ~previous_high]
+
+
+def match_nearest(edges: np.ndarray, sync_times: np.ndarray, tolerance: float) -> tuple[np.ndarray, np.ndarray]:
+    """Pair sorted sync times with their nearest sorted edges, at most one sync per edge and within tolerance.
+
+    Returns (sync_rows, edge_rows) of the pairs, sorted by sync time.
+    """
+    if edges.size == 0 or sync_times.size == 0:
+        return (np.empty(0, dtype=int), np.empty(0, dtype=int))
+    # The nearest edge is just before or just after where each sync time would go.
+    after = np.clip(np.searchsorted(edges, sync_times), 1, edges.size - 1) if edges.size > 1 else np.zeros(sync_times.size, dtype=int)
+    before = np.maximum(after - 1, 0)
+    nearest = np.where(np.abs(sync_times - edges[before]) <= np.abs(edges[after] - sync_times), before, after)
+    distance = np.abs(sync_times - edges[nearest])
+    close = np.flatnonzero(distance <= tolerance)
+
+    # When several syncs land nearest to the same edge, keep the closest one.
+    order = close[np.lexsort((distance[close], nearest[close]))]
+    first_per_edge = np.concatenate([[True], nearest[order][1:] != nearest[order][:-1]])[:order.size]
+    sync_rows = np.sort(order[first_per_edge])
+    return (sync_rows, nearest[sync_rows])
+
+
+def residual_stats(edge_times: np.ndarray, residuals: np.ndarray) -> dict:
+    # Drift as the slope of a line fit to the residuals, and jitter as what's left after taking out the line.
+    valid = ~np.isnan(residuals)
+    (edge_times, residuals) = (edge_times[valid], residuals[valid])
+    if residuals.size < 2:
+        return {"count": int(residuals.size)}
+    (slope, intercept) = np.polyfit(edge_times, residuals, 1)
+    jitter = residuals - (slope * edge_times + intercept)
+    return {
+        "count": int(residuals.size),
+        "mean": float(np.mean(residuals)),
+        "median": float(np.median(residuals)),
+        "min": float(np.min(residuals)),
+        "max": float(np.max(residuals)),
+        "drift_s_per_hour": float(slope * 3600),
+        "offset_at_zero": float(intercept),
+        "jitter_std": float(np.std(jitter)),
+        "jitter_median_abs": float(np.median(np.abs(jitter))),
+        "jitter_p95_abs": float(np.percentile(np.abs(jitter), 95)),
+        "jitter_p99_abs": float(np.percentile(np.abs(jitter), 99)),
+        "jitter_max_abs": float(np.max(np.abs(jitter))),
+    }
+
+
+def sync_quality(session_dir: str, stream_name: str = ttl_stream, line: int = ttl_line, tolerance: float = tolerance) -> tuple[dict, dict]:
+    """Pair sync messages with TTL edges for one Open Ephys session.
+
+    Returns (report, arrays), where report is JSON-friendly and arrays has the edge times, residuals, and unpaired times for plotting.
+    """
+    from open_ephys.analysis import Session
+
+    session = Session(session_dir)
+    recording = session.recordnodes[0].recordings[0]
+    edges = rising_edges(recording.events, stream_name, line)
+
+    # Read each messages dataset in one go, rather than one HDF5 read per message.
+    if 'messages' in recording.nwb['acquisition']:
+        messages = MessageIndex(recording.nwb['acquisition']['messages']['timestamps'][:], recording.nwb['acquisition']['messages']['data'][:])
+    else:
+        messages = MessageIndex(np.empty(0), np.empty(0, dtype=str))
+    return pair_syncs(session_dir, edges, messages, stream_name, line, tolerance)
+
+
+def pair_syncs(session_dir: str, edges: np.ndarray, messages: MessageIndex, stream_name: str, line: int, tolerance: float) -> tuple[dict, dict]:
+    # The part of sync_quality() after reading the session: pair sync messages with TTL edges and summarize the residuals.
+    sync_rows = messages.rows("udp_sync")
+    sync_times = messages.timestamps[sync_rows]
+    at_times = messages.at_times[sync_rows]
+
+    (paired_syncs, paired_edges) = match_nearest(edges, sync_times, tolerance)
+    edge_times = edges[paired_edges]
+    residuals = sync_times[paired_syncs] - edge_times
+    at_residuals = at_times[paired_syncs] - edge_times
+    missing = np.setdiff1d(np.arange(edges.size), paired_edges)
+    extra = np.setdiff1d(np.arange(sync_times.size), paired_syncs)
+
+    report = {
+        "session": session_dir,
+        "ttl_stream": stream_name,
+        "ttl_line": line,
+        "tolerance": tolerance,
+        "ttl_edges": int(edges.size),
+        "sync_messages": int(sync_times.size),
+        "paired": int(paired_syncs.size),
+        "missing_syncs": int(missing.size),
+        "extra_syncs": int(extra.size),
+        "first_missing_times": edges[missing][:20].tolist(),
+        "first_extra_times": sync_times[extra][:20].tolist(),
+        "message_minus_ttl": residual_stats(edge_times, residuals),
+        "at_timestamp_minus_ttl": residual_stats(edge_times, at_residuals),
+    }
+    arrays = {
+        "edge_times": edge_times,
+        "residuals": residuals,
+        "at_residuals": at_residuals,
+        "missing_times": edges[missing],
+        "extra_times": sync_times[extra],
+    }
+    return (report, arrays)
+
+
+def check_report(report: dict, max_jitter: float = max_jitter, max_unpaired_fraction: float = max_unpaired_fraction) -> list[str]:
+    # Reasons a session fails the sync checks, if any.
+    problems = []
+    if report["paired"] == 0:
+        problems.append("no sync messages paired with TTL edges")
+        return problems
+    jitter = report["message_minus_ttl"].get("jitter_p99_abs", 0.0)
+    if jitter > max_jitter:
+        problems.append(f"jitter p99 {jitter:.6f}s > {max_jitter}s")
+    if report["missing_syncs"] > max_unpaired_fraction * report["ttl_edges"]:
+        problems.append(f"{report['missing_syncs']} of {report['ttl_edges']} TTL edges have no sync message")
+    if report["extra_syncs"] > max_unpaired_fraction * report["sync_messages"]:
+        problems.append(f"{report['extra_syncs']} of {report['sync_messages']} sync messages have no TTL edge")
+    return problems
+
+
+def plot_sync_quality(report: dict, arrays: dict, png_file: str):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, (ax_residual, ax_hist) = plt.subplots(2, 1, figsize=(10, 7))
+    edge_times = arrays["edge_times"]
+    for residuals, label, color in [(arrays["residuals"], "message - TTL", "green"), (arrays["at_residuals"], "@timestamp - TTL", "orange")]:
+        ax_residual.plot(edge_times, residuals * 1000, ".", markersize=2, label=label, color=color)
+    stats = report["message_minus_ttl"]
+    if "drift_s_per_hour" in stats:
+        fit = (stats["drift_s_per_hour"] / 3600 * edge_times + stats["offset_at_zero"]) * 1000
+        ax_residual.plot(edge_times, fit, color="black", linewidth=1, label=f"drift {stats['drift_s_per_hour'] * 1000:.3f} ms/hour")
+    # Unpaired edges and messages as ticks along the bottom.
+    ax_residual.plot(arrays["missing_times"], np.zeros(arrays["missing_times"].size), "|", color="red", markersize=12, transform=ax_residual.get_xaxis_transform(), label=f"missing syncs ({report['missing_syncs']})")
+    ax_residual.plot(arrays["extra_times"], np.zeros(arrays["extra_times"].size), "|", color="purple", markersize=12, transform=ax_residual.get_xaxis_transform(), label=f"extra syncs ({report['extra_syncs']})")
+    ax_residual.set_xlabel("TTL edge time (s)")
+    ax_residual.set_ylabel("Residual (ms)")
+    ax_residual.set_title(f"{os.path.basename(os.path.normpath(report['session']))}: sync messages vs TTL {report['ttl_stream']} line {report['ttl_line']}")
+    ax_residual.legend(loc="upper right", fontsize=8)
+
+    if "drift_s_per_hour" in stats:
+        jitter = arrays["residuals"] - (stats["drift_s_per_hour"] / 3600 * edge_times + stats["offset_at_zero"])
+        ax_hist.hist(jitter * 1000, bins=100, color="green")
+        ax_hist.set_title(f"Jitter after removing drift: std {stats['jitter_std'] * 1000:.3f} ms, p99 {stats['jitter_p99_abs'] * 1000:.3f} ms")
+    ax_hist.set_xlabel("Residual minus drift line (ms)")
+    ax_hist.set_ylabel("Count")
+    fig.tight_layout()
+    fig.savefig(png_file, dpi=100)
+    plt.close(fig)
+
+
+def session_dirs(directory: str) -> list[str]:
+    # Open Ephys session folders in a directory, meaning folders with a "Record Node ..." folder in them.
+    sessions = []
+    for name in sorted(os.listdir(directory)):
+        session_dir = os.path.join(directory, name)
+        if os.path.isdir(session_dir) and any(
+            entry.startswith("Record Node") and os.path.isdir(os.path.join(session_dir, entry)) for entry in os.listdir(session_dir)
+        ):
+            sessions.append(session_dir)
+    return sessions
+
+
+def report_session(session_dir: str, output_dir: str, stream_name: str, line: int, tolerance: float, max_jitter: float, max_unpaired_fraction: float) -> dict:
+    # Check one session in a worker process, writing its JSON and PNG, and report how it went rather than raising.
+    start_time = time.perf_counter()
+    name = os.path.basename(os.path.normpath(session_dir))
+    try:
+        (report, arrays) = sync_quality(session_dir, stream_name, line, tolerance)
+        problems = check_report(report, max_jitter, max_unpaired_fraction)
+        report["status"] = "ok" if not problems else "failed"
+        report["problems"] = problems
+        report["png"] = os.path.join(output_dir, f"{name}_sync.png")
+        plot_sync_quality(report, arrays, report["png"])
+    except Exception as e:
+        report = {"session": session_dir, "status": "error", "problems": [f"{e.__class__.__name__}: {e}"]}
+    report["seconds"] = time.perf_counter() - start_time
+    report["json"] = os.path.join(output_dir, f"{name}_sync.json")
+    with open(report["json"], "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Report how well UDP Events sync messages line up with TTL sync pulses, for one or more Open Ephys sessions.")
+    parser.add_argument("--directory", default=None, help="check every session folder in this directory, meaning each folder with a Record Node folder in it")
+    parser.add_argument("--session", action="append", default=[], help="check this session folder (repeatable)")
+    parser.add_argument("--output-dir", default="sync_reports", help="where to write <session>_sync.json, <session>_sync.png, and sync_quality_summary.json")
+    parser.add_argument("--stream", default=ttl_stream, help="TTL stream name the sync pulses go to")
+    parser.add_argument("--line", type=int, default=ttl_line, help="TTL line the sync pulses go to")
+    parser.add_argument("--tolerance", type=float, default=tolerance, help="largest residual in seconds for a message and TTL edge to pair up")
+    parser.add_argument("--max-jitter", type=float, default=max_jitter, help="fail sessions whose jitter 99th percentile is over this many seconds")
+    parser.add_argument("--max-unpaired", type=float, default=max_unpaired_fraction, help="fail sessions with more than this fraction of TTL edges or messages unpaired")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1), help="how many sessions to check at once")
+    cli_args = parser.parse_args(argv)
+
+    sessions = list(cli_args.session)
+    if cli_args.directory is not None:
+        sessions += session_dirs(cli_args.directory)
+    if not sessions:
+        parser.error("give a --directory of sessions or at least one --session")
+    os.makedirs(cli_args.output_dir, exist_ok=True)
+
+    batch_start = time.perf_counter()
+    results = []
+    options = (cli_args.output_dir, cli_args.stream, cli_args.line, cli_args.tolerance, cli_args.max_jitter, cli_args.max_unpaired)
+    with ProcessPoolExecutor(max_workers=min(cli_args.workers, len(sessions))) as pool:
+        futures = {pool.submit(report_session, session_dir, *options): session_dir for session_dir in sessions}
+        for future in as_completed(futures):
+            try:
+                report = future.result()
+            except Exception as e: # the worker process itself died
+                report = {"session": futures[future], "status": "error", "problems": [f"{e.__class__.__name__}: {e}"], "seconds": float("nan")}
+            results.append(report)
+            stats = report.get("message_minus_ttl", {})
+            print(f"{report['status']:<7} {os.path.basename(os.path.normpath(report['session']))}: "
+                  f"{report.get('paired', 0)} paired, {report.get('missing_syncs', 0)} missing, {report.get('extra_syncs', 0)} extra, "
+                  f"jitter p99 {stats.get('jitter_p99_abs', float('nan')) * 1000:.3f} ms, drift {stats.get('drift_s_per_hour', float('nan')) * 1000:.3f} ms/hour "
+                  f"({report['seconds']:.1f}s) {'; '.join(report['problems'])}")
+
+    results.sort(key=lambda report: report["session"])
+    summary_file = os.path.join(cli_args.output_dir, "sync_quality_summary.json")
+    with open(summary_file, "w") as f:
+        json.dump(results, f, indent=2)
+    not_ok = [report for report in results if report["status"] != "ok"]
+    print(f"\nChecked {len(results)} sessions in {time.perf_counter() - batch_start:.1f}s, {len(not_ok)} not ok, summary in {summary_file}")
+    return 1 if not_ok else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
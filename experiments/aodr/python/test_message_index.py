@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+
+# Check that MessageIndex classifies UDPEvents messages by category, and handles a session with no messages.
+# These only need numpy.
+#
+#   cd Lab_Pipelines/experiments/aodr/python
+#   conda activate gold_pipelines
+#   python -m pytest test_message_index.py
+
+from message_index import MessageIndex, partition_strings
+
+ecode_rules_csv = os.path.join(os.path.dirname(__file__), "..", "ecodes", "AODR_ecode_rules.csv")
+
+
+def test_messages_by_category():
+    messages = MessageIndex(
+        [3.0, 1.0, 2.0],
+        [b"name=4913,type=unsigned long@2.9=87000", b"UDP Events sync on line 1@0.5=15000", b"no timing info"],
+        ecode_rules_csv
+    )
+    assert messages.text.tolist() == ["UDP Events sync on line 1@0.5=15000", "no timing info", "name=4913,type=unsigned long@2.9=87000"]
+    np.testing.assert_array_equal(messages.rows("udp_sync"), [0])
+    np.testing.assert_array_equal(messages.rows("fix_acq"), [2])
+    np.testing.assert_array_equal(messages.window(None, 1.5, 3.0), [1])
+    np.testing.assert_allclose(messages.at_offsets(np.arange(3)), [0.5, np.nan, 0.1])
+    np.testing.assert_allclose(messages.equals_values, [15000, np.nan, 87000])
+
+
+def test_no_messages():
+    messages = MessageIndex(np.empty(0), np.empty(0, dtype=str), ecode_rules_csv)
+    assert len(messages) == 0
+    assert messages.rows("udp_sync").size == 0
+    assert messages.window("fix_acq", 0.0, 10.0).size == 0
+    assert messages.at_offsets(messages.rows(None)).size == 0
+
+    (before, separator, after) = partition_strings(np.empty(0, dtype=str), "@")
+    assert before.size == separator.size == after.size == 0
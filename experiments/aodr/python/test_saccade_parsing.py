@@ -0,0 +1,354 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+# Check that SaccadeParser, which finds strings of 5 fast samples with run_starts(), parses the same saccades as the
+# original per-trial loop, which found them by np.delete()-ing one candidate sample at a time.
+# Also check that detect_session(), which parses a whole session at once, gives the same saccades and scores as
+# running SaccadesEnhancer and CustomEnhancer on one trial at a time, and that compact_saccades gives the same saccades and scores
+# in a form that trial files can write.  The checks on whole trials need Pyramid, the rest only need numpy.
+#
+#   cd Lab_Pipelines/experiments/aodr/python
+#   conda activate gold_pipelines
+#   python -m pytest test_saccade_parsing.py
+#
+# To also check recorded gaze, point AODR_RECORDED_GAZE at an .npz file with arrays "x" and "y" (whole-session gaze in deg),
+# "sample_frequency", and "fp_off_samples" and "all_off_samples" (the sample index of each trial's fp_off and all_off).
+
+from saccade_detection import SaccadeParser, run_starts, SACCADE_DTYPE
+
+
+def reference_saccades(enhancer: SaccadeParser, x_position: np.ndarray, y_position: np.ndarray, fp_off_time: float, sample_frequency: float) -> list[dict]:
+    # The original SaccadesEnhancer.enhance() loop, from after the gaze window was cut out of the trial.
+    saccades = []
+    smf   = np.array([0.0033, 0.0238, 0.0971, 0.2259, 0.2998, 0.2259, 0.0971, 0.0238, 0.0033])
+    t_int = 1000 / sample_frequency
+    if len(x_position) != len(y_position) or len(x_position) < len(smf):
+        return saccades
+    x_position = np.convolve(x_position, smf, mode='same')
+    y_position = np.convolve(y_position, smf, mode='same')
+    vel  = np.concatenate(([0], np.sqrt(np.diff(x_position)**2 + np.diff(y_position)**2) / t_int))
+    vels = vel - np.median(vel)
+    acc  = np.convolve([0.2, 0.2, 0.2, 0.2, 0.2], np.diff(vels), mode='valid')
+    vps = np.where(vels >= enhancer.velocity_peak_threshold_deg_per_ms)[0]
+    last_end = 0
+    while len(saccades) < enhancer.max_saccades:
+        while len(vps) > 4 and vps[4] - vps[0] != 4:
+            vps = np.delete(vps, 0)
+        if len(vps) < 5:
+            break
+        sac_begin = np.nan
+        acc_thresh = np.where(acc[last_end:vps[0]] < enhancer.acceleration_threshold_deg_per_ms2)
+        other_thresh = np.where(np.logical_or(vels[last_end:vps[0]] <= enhancer.velocity_threshold_deg_per_ms,
+                                              np.logical_and(acc[last_end:vps[0]] < -enhancer.acceleration_threshold_deg_per_ms2,
+                                                             vels[last_end:vps[0]] < enhancer.velocity_peak_threshold_deg_per_ms)))
+        if acc_thresh[0].size != 0:
+            acc_thresh = acc_thresh[0][-1]
+            if other_thresh[0].size != 0:
+                sac_begin = last_end + min(acc_thresh, other_thresh[0][-1])
+            else:
+                sac_begin = last_end + acc_thresh
+        elif other_thresh[0].size != 0:
+            sac_begin = last_end + other_thresh[0][-1]
+        acc_thresh = np.where(acc[vps[4]+1:] < enhancer.acceleration_threshold_deg_per_ms2)
+        decel = vps[4] + acc_thresh[0][0] if acc_thresh[0].size != 0 else np.nan
+        if np.isnan(sac_begin) or np.isnan(decel):
+            last_end = vps[4]
+            vps = vps[4:]
+        else:
+            acc_decel_thresh = np.where(acc[decel+1:-1] > -enhancer.acceleration_threshold_deg_per_ms2)
+            vels_decel_thresh = np.where(vels[decel:-2] <= 0.005)
+            if acc_decel_thresh[0].size != 0 and vels_decel_thresh[0].size != 0:
+                sac_end = decel - 5 + max(acc_decel_thresh[0][0], vels_decel_thresh[0][0])
+            elif acc_decel_thresh[0].size != 0:
+                sac_end = decel - 5 + acc_decel_thresh[0][0]
+            elif vels_decel_thresh[0].size != 0:
+                sac_end = decel - 5 + vels_decel_thresh[0][0]
+            else:
+                sac_end = decel - 5
+            len_ = np.sqrt((x_position[sac_end] - x_position[sac_begin-1])**2 + (y_position[sac_end] - y_position[sac_begin-1])**2)
+            end_pos_len = np.sqrt((x_position[sac_end])**2 + (y_position[sac_end])**2)
+            sac_start_time = fp_off_time + (sac_begin + 1) / sample_frequency
+            sac_end_time = fp_off_time + (sac_end + 1) / sample_frequency
+            sac_duration = sac_end_time - sac_start_time
+            if len_ >= enhancer.min_length_deg and end_pos_len > 5 and end_pos_len < 18:
+                saccades.append({
+                    "t_start": sac_start_time,
+                    "t_end": sac_end_time,
+                    "v_max": np.max(vels[sac_begin:sac_end]),
+                    "v_avg": len_ / sac_duration,
+                    "x_start": x_position[sac_begin],
+                    "y_start": y_position[sac_begin],
+                    "x_end": x_position[sac_end],
+                    "y_end": y_position[sac_end],
+                    "raw_distance": np.sum(vels[sac_begin:sac_end]) / sample_frequency,
+                    "vector_distance": len_,
+                })
+            vps = vps[vps > sac_end]
+            last_end = sac_end + 1
+    if len(saccades) < enhancer.max_saccades and (len(saccades) == 0 or saccades[-1]["t_end"] + saccades[-1]["t_start"] < 500):
+        saccades.append({"t_start": np.nan, "t_end": np.inf, **{name: np.nan for name in SACCADE_DTYPE.names[2:]}})
+    return saccades
+
+
+def synthetic_gaze(rng: np.random.Generator, sample_count: int) -> tuple[np.ndarray, np.ndarray]:
+    # Fixation noise and slow drift, a few saccades with smooth position profiles, and some short glitches.
+    x = np.cumsum(rng.normal(0, 0.003, sample_count)) + rng.normal(0, 0.02, sample_count)
+    y = np.cumsum(rng.normal(0, 0.003, sample_count)) + rng.normal(0, 0.02, sample_count)
+    (x_target, y_target) = (0.0, 0.0)
+    onset = int(rng.integers(80, 300))
+    while onset < sample_count - 100:
+        duration = int(rng.integers(20, 60))
+        angle = rng.uniform(0, 2 * np.pi)
+        amplitude = rng.choice([rng.uniform(1, 4), rng.uniform(6, 16)])
+        (x_start, y_start) = (x_target, y_target)
+        (x_target, y_target) = (amplitude * np.cos(angle), amplitude * np.sin(angle))
+        phase = np.clip((np.arange(sample_count - onset)) / duration, 0, 1)
+        profile = phase**3 * (10 - 15 * phase + 6 * phase**2)  # minimum jerk
+        x[onset:] += (x_target - x_start) * profile
+        y[onset:] += (y_target - y_start) * profile
+        onset += duration + int(rng.integers(60, 400))
+    for start in rng.integers(0, sample_count, int(rng.integers(0, 6))):
+        x[start:start + int(rng.integers(1, 12))] += rng.normal(0, 2)
+    return (x, y)
+
+
+def assert_same_saccades(saccades: list[dict], expected: list[dict]):
+    assert len(saccades) == len(expected)
+    for saccade, expected_saccade in zip(saccades, expected):
+        for name in SACCADE_DTYPE.names:
+            np.testing.assert_allclose(saccade[name], expected_saccade[name], rtol=1e-9, atol=1e-12, err_msg=name)
+
+
+def test_run_starts_finds_every_run():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        is_above = rng.random(int(rng.integers(0, 80))) < rng.uniform(0.3, 0.95)
+        expected = [index for index in range(is_above.size - 4) if is_above[index:index + 5].all()]
+        np.testing.assert_array_equal(run_starts(is_above, 5), expected)
+
+
+enhancer_args = [
+    {},
+    {"max_saccades": 3},
+    {"max_saccades": 2, "velocity_peak_threshold_deg_per_ms": 0.02, "acceleration_threshold_deg_per_ms2": 2},
+    {"max_saccades": 3, "velocity_peak_threshold_deg_per_ms": 0.1, "velocity_threshold_deg_per_ms": 0.1},
+]
+
+
+@pytest.mark.parametrize("args", enhancer_args)
+def test_synthetic_gaze_matches_delete_loop(args):
+    enhancer = SaccadeParser(**args)
+    rng = np.random.default_rng(1)
+    sample_frequency = 1000.0
+    saccade_count = 0
+    for trial in range(100):
+        (x, y) = synthetic_gaze(rng, int(rng.integers(5, 1500)))
+        fp_off_time = trial * 10.0
+        expected = reference_saccades(enhancer, x, y, fp_off_time, sample_frequency)
+        saccades = enhancer.detect_batch([x], [y], [fp_off_time], sample_frequency)[0]
+        assert_same_saccades(saccades or [], expected)
+        saccade_count += sum(np.isfinite(saccade["t_start"]) for saccade in expected)
+    # Make sure the synthetic gaze exercised the parser, not just the "no saccade" case.
+    assert saccade_count > 50
+
+
+@pytest.mark.skipif(not os.environ.get("AODR_RECORDED_GAZE"), reason="set AODR_RECORDED_GAZE to an .npz of recorded gaze to check")
+@pytest.mark.parametrize("args", enhancer_args)
+def test_recorded_gaze_matches_delete_loop(args):
+    recorded = np.load(os.environ["AODR_RECORDED_GAZE"])
+    sample_frequency = float(recorded["sample_frequency"])
+    enhancer = SaccadeParser(**args)
+    for start, end in zip(recorded["fp_off_samples"], recorded["all_off_samples"]):
+        # Center at fp off, like the enhancer does with center_at_fp.
+        x = recorded["x"][start:end] - recorded["x"][start]
+        y = recorded["y"][start:end] - recorded["y"][start]
+        fp_off_time = start / sample_frequency
+        expected = reference_saccades(enhancer, x, y, fp_off_time, sample_frequency)
+        saccades = enhancer.detect_batch([x], [y], [fp_off_time], sample_frequency)[0]
+        assert_same_saccades(saccades or [], expected)
+
+
+def reference_choice(saccades: list[dict], target_angles: list[float], min_angular_distance_to_target_deg: float) -> tuple[int, int]:
+    # The original CustomEnhancer loop over saccades and targets, returning (saccade_index, target_index) or None for no choice.
+    from AODR_custom_enhancers import ang_deg, ang_diff
+    choice = None
+    min_angular_distance = 360
+    for i in range(len(saccades)):
+        sac_angle = ang_deg(saccades[i]["x_end"], saccades[i]["y_end"])
+        for j in range(len(target_angles)):
+            angular_distance = ang_diff(target_angles[j], sac_angle)
+            if angular_distance <= min_angular_distance_to_target_deg and angular_distance < min_angular_distance:
+                min_angular_distance = angular_distance
+                choice = (i, j)
+    return choice
+
+
+def session_gaze(rng: np.random.Generator, trial_count: int, sample_frequency: float = 1000.0) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Whole-session synthetic gaze with 3s trials, fp_off 0.5s and all_off 2s into each trial, and a few missing fp_off.
+    # Times fall between samples so trial windows don't depend on float rounding of sample times.
+    trial_gaze = [synthetic_gaze(rng, int(3.0 * sample_frequency)) for _ in range(trial_count)]
+    x = np.concatenate([trial_x for trial_x, _ in trial_gaze])
+    y = np.concatenate([trial_y for _, trial_y in trial_gaze])
+    start_times = np.arange(trial_count) * 3.0
+    fp_off_times = start_times + 0.5 + 0.3 / sample_frequency
+    fp_off_times[rng.random(trial_count) < 0.1] = np.nan
+    all_off_times = start_times + 2.0 + 0.3 / sample_frequency
+    return (x, y, fp_off_times, all_off_times)
+
+
+def test_detect_session_matches_per_window(tmp_path):
+    sample_frequency = 1000.0
+    (x, y, fp_off_times, all_off_times) = session_gaze(np.random.default_rng(4), 100, sample_frequency)
+    sample_times = np.arange(x.size) / sample_frequency
+    parser = SaccadeParser(max_saccades=3)
+    session_saccades = parser.detect_session(x, y, sample_frequency, fp_off_times, all_off_times)
+    parser.save_session_saccades(tmp_path / "session_saccades.npz")
+    loaded = SaccadeParser(compact_saccades=True)
+    loaded.load_session_saccades(tmp_path / "session_saccades.npz")
+
+    saccade_count = 0
+    for fp_off_time, all_off_time, saccades in zip(fp_off_times, all_off_times, session_saccades):
+        in_window = (sample_times >= fp_off_time) & (sample_times < all_off_time)
+        if not in_window.any():
+            assert saccades is None
+            assert parser.lookup_session_saccades(fp_off_time) is None
+            continue
+        x_window = x[in_window] - x[in_window][0]
+        y_window = y[in_window] - y[in_window][0]
+        expected = parser.detect_batch([x_window], [y_window], [fp_off_time], sample_frequency)[0]
+        assert_same_saccades(saccades, expected)
+        assert_same_saccades(parser.lookup_session_saccades(fp_off_time + 1e-9), expected)
+        columns = loaded.lookup_session_saccades(fp_off_time)
+        assert_same_saccades([dict(zip(columns.keys(), values)) for values in zip(*columns.values())], expected)
+        saccade_count += sum(np.isfinite(saccade["t_start"]) for saccade in expected)
+    assert saccade_count > 20
+
+
+def task_trials(rng: np.random.Generator, trial_count: int, sample_frequency: float = 1000.0) -> tuple[list, tuple]:
+    # MSAC and AODR trials cut from session_gaze(), returned along with the whole-session gaze.
+    from pyramid.model.signals import SignalChunk
+    from pyramid.trials.trials import Trial
+    session = session_gaze(rng, trial_count, sample_frequency)
+    (x, y, fp_off_times, all_off_times) = session
+    trials = []
+    for trial_number in range(trial_count):
+        start_time = trial_number * 3.0
+        trial = Trial(start_time=start_time, end_time=start_time + 2.5)
+        first_sample = int(trial_number * 3.0 * sample_frequency)
+        samples = slice(first_sample, first_sample + int(2.5 * sample_frequency))
+        trial.add_buffer_data("gaze_x", SignalChunk(x[samples].reshape(-1, 1), sample_frequency, start_time, ["CH1"]))
+        trial.add_buffer_data("gaze_y", SignalChunk(y[samples].reshape(-1, 1), sample_frequency, start_time, ["CH2"]))
+        task_id = int(rng.choice([1, 2]))
+        trial.add_enhancement("task_id", task_id, "id")
+        trial.add_enhancement("trial_id", 100 * task_id + int(rng.choice([3, 4, 5, 12, 13, 14])), "id")
+        for name in ["t1", "t2", "sample"]:
+            angle = rng.uniform(0, 2 * np.pi)
+            trial.add_enhancement(f"{name}_x", 10 * np.cos(angle), "id")
+            trial.add_enhancement(f"{name}_y", 10 * np.sin(angle), "id")
+        if np.isfinite(fp_off_times[trial_number]):
+            trial.add_enhancement("fp_off", fp_off_times[trial_number], "time")
+        trial.add_enhancement("targ_acq", start_time + 1.0, "time")
+        trial.add_enhancement("all_off", all_off_times[trial_number], "time")
+        trials.append(trial)
+    return (trials, session)
+
+
+def test_session_lookup_matches_per_trial_enhancers(tmp_path):
+    pytest.importorskip("pyramid")
+    from AODR_custom_enhancers import CustomEnhancer, SaccadesEnhancer
+
+    saccades_args = {"x_buffer_name": "gaze_x", "x_channel_id": "CH1", "y_buffer_name": "gaze_y", "y_channel_id": "CH2", "max_saccades": 3}
+    custom_args = {"min_angular_distance_to_target_deg": 45}
+
+    (per_trial, _) = task_trials(np.random.default_rng(2), 200)
+    saccades_enhancer = SaccadesEnhancer(**saccades_args)
+    custom_enhancer = CustomEnhancer(**custom_args)
+    for trial_number, trial in enumerate(per_trial):
+        saccades_enhancer.enhance(trial, trial_number, {}, {})
+        custom_enhancer.enhance(trial, trial_number, {}, {})
+
+    # Detect the whole session at once, then have the per-trial enhancer look up each trial from a file.
+    (session, (x, y, fp_off_times, all_off_times)) = task_trials(np.random.default_rng(2), 200)
+    batch_enhancer = SaccadesEnhancer(**saccades_args)
+    batch_enhancer.detect_session(x, y, 1000.0, fp_off_times, all_off_times)
+    batch_enhancer.save_session_saccades(tmp_path / "session_saccades.npz")
+    lookup_enhancer = SaccadesEnhancer(session_saccades_file=str(tmp_path / "session_saccades.npz"), **saccades_args)
+    lookup_enhancer.detect_batch = None  # Make sure every trial is looked up, not parsed again.
+    custom_enhancer = CustomEnhancer(**custom_args)
+    for trial_number, trial in enumerate(session):
+        if trial.get_time("fp_off") is not None:
+            lookup_enhancer.enhance(trial, trial_number, {}, {})
+        custom_enhancer.enhance(trial, trial_number, {}, {})
+
+    scores = []
+    for expected, trial in zip(per_trial, session):
+        assert trial.get_one("score") == expected.get_one("score")
+        for name in ["tacp", "choice", "scored_saccade_index", "sac_on", "RT"]:
+            np.testing.assert_allclose(trial.get_one(name, np.nan), expected.get_one(name, np.nan), rtol=1e-9, err_msg=name)
+        for name in ["all_saccades", "saccades"]:
+            expected_saccades = expected.get_enhancement(name)
+            saccades = trial.get_enhancement(name)
+            if isinstance(expected_saccades, dict):
+                (expected_saccades, saccades) = ([expected_saccades], [saccades])
+            assert_same_saccades(saccades or [], expected_saccades or [])
+        np.testing.assert_allclose(trial.signals["gaze_x"].sample_data, expected.signals["gaze_x"].sample_data)
+        scores.append(trial.get_one("score"))
+
+    # Make sure the session had correct, error, no choice, and broken fixation trials to compare.
+    assert set(scores) == {1, 0, -1, -2}
+
+
+def test_compact_saccades_match_and_serialize():
+    pytest.importorskip("pyramid")
+    from AODR_custom_enhancers import CustomEnhancer, SaccadesEnhancer
+
+    saccades_args = {"x_buffer_name": "gaze_x", "x_channel_id": "CH1", "y_buffer_name": "gaze_y", "y_channel_id": "CH2", "max_saccades": 3}
+    results = {}
+    for compact in [False, True]:
+        (trials, _) = task_trials(np.random.default_rng(3), 100)
+        saccades_enhancer = SaccadesEnhancer(compact_saccades=compact, **saccades_args)
+        custom_enhancer = CustomEnhancer(min_angular_distance_to_target_deg=45)
+        for trial_number, trial in enumerate(trials):
+            saccades_enhancer.enhance(trial, trial_number, {}, {})
+            custom_enhancer.enhance(trial, trial_number, {}, {})
+        results[compact] = trials
+
+    scored_count = 0
+    for expected, trial in zip(results[False], results[True]):
+        assert trial.get_one("score") == expected.get_one("score")
+        np.testing.assert_allclose(trial.get_one("RT", np.nan), expected.get_one("RT", np.nan), rtol=1e-9)
+        assert trial.get_one("scored_saccade_index") == expected.get_one("scored_saccade_index")
+
+        # CustomEnhancer scores with array ops now, which should pick the same saccade and target as the original loop.
+        saccades = expected.get_enhancement("all_saccades") or expected.get_enhancement("saccades")
+        if expected.get_time("fp_off") is not None and saccades and np.isfinite(saccades[0]["t_start"]):
+            if trial.get_one("task_id") == 1:
+                target_angles = [expected.get_one("t1_angle")]
+            elif expected.get_one("correct_target") == 1:
+                target_angles = [expected.get_one("t1_angle"), expected.get_one("t2_angle")]
+            else:
+                target_angles = [expected.get_one("t2_angle"), expected.get_one("t1_angle")]
+            choice = reference_choice(saccades, target_angles, 45)
+            if choice is None:
+                assert expected.get_one("score") == -1
+            else:
+                assert expected.get_one("scored_saccade_index") == choice[0]
+                assert expected.get_one("score") == (1 if choice[1] == 0 else 0)
+
+        # Compact saccades are columns of plain floats, which keep their field names through JSON like Pyramid trial files use.
+        for name in ["all_saccades", "saccades"]:
+            columns = trial.get_enhancement(name)
+            if columns is None:
+                continue
+            assert list(columns.keys()) == list(SACCADE_DTYPE.names)
+            round_trip = json.loads(json.dumps(columns))
+            expected_saccades = expected.get_enhancement(name)
+            if isinstance(expected_saccades, dict):
+                expected_saccades = [expected_saccades]
+                scored_count += 1
+            saccades = [dict(zip(round_trip.keys(), values)) for values in zip(*round_trip.values())]
+            assert_same_saccades(saccades, expected_saccades)
+    assert scored_count > 10
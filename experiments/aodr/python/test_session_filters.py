@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+# Check that SmoothingReader smooths a session chunk by chunk the same as smoothing it all at once, and that trials
+# ending near the end of a reader chunk still get full windows, even though smoothed output lags the reader's chunks.
+# To get trial windows, this reads the way Pyramid does: keep reading until the buffered data reach the trial's end time.
+#
+#   cd Lab_Pipelines/experiments/aodr/python
+#   conda activate gold_pipelines
+#   python -m pytest test_session_filters.py
+
+pytest.importorskip("pyramid")
+from pyramid.model.signals import SignalChunk
+from pyramid.neutral_zone.readers.readers import Reader
+
+from session_filters import SmoothingReader, StreamingSmoother
+
+
+class ChunkReader(Reader):
+    # Stand-in for a session reader, reading one signal in chunks of the given sizes.
+
+    def __init__(self, sample_data: np.ndarray, sample_frequency: float, chunk_sizes: list[int]) -> None:
+        self.sample_data = sample_data
+        self.sample_frequency = sample_frequency
+        self.chunk_sizes = list(chunk_sizes)
+        self.position = 0
+
+    def read_next(self) -> dict[str, SignalChunk]:
+        if not self.chunk_sizes:
+            raise StopIteration
+        start = self.position
+        self.position += self.chunk_sizes.pop(0)
+        chunk = SignalChunk(self.sample_data[start:self.position], self.sample_frequency, start / self.sample_frequency, ["x", "y"])
+        return {"gaze": chunk}
+
+
+def chunk_times(chunk: SignalChunk) -> np.ndarray:
+    return chunk.first_sample_time + np.arange(chunk.sample_data.shape[0]) / chunk.sample_frequency
+
+
+def test_unknown_args_raise():
+    with pytest.raises(TypeError):
+        StreamingSmoother(windw_size=301)
+
+
+def test_trials_near_chunk_ends_get_full_windows():
+    rng = np.random.default_rng(5)
+    sample_frequency = 1000.0
+    sample_data = np.cumsum(rng.normal(size=(30000, 2)), axis=0)
+    chunk_sizes = rng.integers(20, 1500, 100)
+    chunk_sizes = chunk_sizes[np.cumsum(chunk_sizes) < sample_data.shape[0]].tolist()
+    chunk_sizes.append(sample_data.shape[0] - sum(chunk_sizes))
+    reader = SmoothingReader(
+        "test_session_filters.ChunkReader",
+        window_size=301,
+        poly_order=2,
+        gaussian_std=5,
+        sample_data=sample_data,
+        sample_frequency=sample_frequency,
+        chunk_sizes=chunk_sizes
+    )
+    expected = StreamingSmoother(301, 2, 5).fused_smoother.smooth_in_stages(sample_data)
+    expected_times = np.arange(sample_data.shape[0]) / sample_frequency
+
+    # Trials 0.5s long that end right around chunk ends, and one with the last sample of the session, which needs the flush.
+    # Trials start and end between samples, so which samples they get doesn't depend on float rounding of sample times.
+    chunk_end_times = np.cumsum(chunk_sizes) / sample_frequency
+    trial_end_times = [end + offset for end in chunk_end_times[5:-1] for offset in (-0.0013, 0.0003)]
+    trial_end_times.append(chunk_end_times[-1] - 0.0007)
+
+    buffered = []
+    buffer_end_time = -np.inf
+    for trial_end_time in trial_end_times:
+        # Like Pyramid, read until the buffered data reach the end of the trial.
+        while buffer_end_time < trial_end_time:
+            try:
+                chunk = reader.read_next()["gaze"]
+            except StopIteration:
+                break
+            if chunk.sample_data.shape[0]:
+                buffered.append(chunk)
+                buffer_end_time = chunk_times(chunk)[-1]
+
+        trial_start_time = trial_end_time - 0.5
+        times = np.concatenate([chunk_times(chunk) for chunk in buffered])
+        values = np.concatenate([chunk.sample_data for chunk in buffered])
+        in_trial = (times >= trial_start_time) & (times < trial_end_time)
+        expected_in_trial = (expected_times >= trial_start_time) & (expected_times < trial_end_time)
+        assert np.count_nonzero(in_trial) == np.count_nonzero(expected_in_trial)
+        np.testing.assert_allclose(values[in_trial], expected[expected_in_trial], rtol=1e-9, atol=1e-9)
+
+    # The whole session came through, once.
+    assert sum(chunk.sample_data.shape[0] for chunk in buffered) == sample_data.shape[0]
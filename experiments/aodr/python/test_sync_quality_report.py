@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+
+# Check that sync_quality_report.py pairs sync messages with TTL edges, summarizes drift and jitter, and fails sessions
+# the way it should, including sessions with no messages.  These only need numpy, not open_ephys.
+#
+#   cd Lab_Pipelines/experiments/aodr/python
+#   conda activate gold_pipelines
+#   python -m pytest test_sync_quality_report.py
+
+from message_index import MessageIndex
+from sync_quality_report import check_report, match_nearest, pair_syncs, residual_stats, session_dirs
+
+
+def sync_messages(times: np.ndarray) -> MessageIndex:
+    texts = [f"UDP Events sync on line 1@{time:.6f}={int(time * 30000)}" for time in times]
+    return MessageIndex(times, np.array(texts, dtype=np.str_))
+
+
+def test_match_nearest():
+    edges = np.array([1.0, 2.0, 3.0, 4.0])
+    sync_times = np.array([0.5, 1.01, 1.98, 2.02, 3.3, 4.001])
+    (sync_rows, edge_rows) = match_nearest(edges, sync_times, 0.05)
+    # 0.5 and 3.3 are too far from any edge, and 2.02 loses edge 2.0 to the closer 1.98.
+    np.testing.assert_array_equal(sync_rows, [1, 2, 5])
+    np.testing.assert_array_equal(edge_rows, [0, 1, 3])
+
+    (sync_rows, edge_rows) = match_nearest(np.array([2.0]), np.array([1.99, 2.005]), 0.05)
+    np.testing.assert_array_equal(sync_rows, [1])
+    np.testing.assert_array_equal(edge_rows, [0])
+
+    for (edges, sync_times) in [(np.empty(0), np.array([1.0])), (np.array([1.0]), np.empty(0))]:
+        (sync_rows, edge_rows) = match_nearest(edges, sync_times, 0.05)
+        assert sync_rows.size == edge_rows.size == 0
+
+
+def test_residual_stats():
+    edge_times = np.arange(0.0, 3600.0, 10.0)
+    jitter = np.where(np.arange(edge_times.size) % 2, 0.0001, -0.0001)
+    residuals = 0.003 + edge_times * 0.001 / 3600 + jitter
+    residuals[[4, 5]] = np.nan
+    stats = residual_stats(edge_times, residuals)
+    assert stats["count"] == edge_times.size - 2
+    np.testing.assert_allclose(stats["drift_s_per_hour"], 0.001, atol=1e-5)
+    np.testing.assert_allclose(stats["offset_at_zero"], 0.003, atol=1e-5)
+    np.testing.assert_allclose(stats["jitter_p99_abs"], 0.0001, rtol=0.05)
+    np.testing.assert_allclose(stats["jitter_std"], 0.0001, rtol=0.05)
+
+    assert residual_stats(np.array([1.0]), np.array([0.001])) == {"count": 1}
+
+
+def test_check_report():
+    edges = np.arange(1.0, 101.0)
+    (report, _) = pair_syncs("session", edges, sync_messages(edges + 0.002), "acquisition_board", 1, 0.05)
+    assert report["paired"] == 100
+    assert check_report(report) == []
+    assert check_report(report, max_jitter=-1.0)[0].startswith("jitter p99")
+
+    (report, _) = pair_syncs("session", edges, sync_messages(edges[:90] + 0.002), "acquisition_board", 1, 0.05)
+    assert check_report(report) == ["10 of 100 TTL edges have no sync message"]
+
+    (report, _) = pair_syncs("session", edges[:90], sync_messages(edges + 0.002), "acquisition_board", 1, 0.05)
+    assert check_report(report) == ["10 of 100 sync messages have no TTL edge"]
+
+
+def test_no_messages():
+    (report, arrays) = pair_syncs("session", np.arange(1.0, 11.0), MessageIndex(np.empty(0), np.empty(0, dtype=str)), "acquisition_board", 1, 0.05)
+    assert report["sync_messages"] == report["paired"] == 0
+    assert report["missing_syncs"] == 10
+    assert arrays["residuals"].size == 0
+    assert check_report(report) == ["no sync messages paired with TTL edges"]
+
+
+def test_session_dirs(tmp_path):
+    os.makedirs(tmp_path / "MrM_2025-09-26_13-28-03" / "Record Node 101")
+    os.makedirs(tmp_path / "sync_reports")
+    (tmp_path / "notes.txt").write_text("not a session")
+    assert session_dirs(str(tmp_path)) == [str(tmp_path / "MrM_2025-09-26_13-28-03")]
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+# Check that UDPEventParser with streaming=True parses chunks of messages the same as the original one-by-one loop,
+# including empty chunks and sync events whose offset carries over from one chunk to the next.
+#
+#   cd Lab_Pipelines/experiments/aodr/python
+#   conda activate gold_pipelines
+#   python -m pytest test_udp_events.py
+
+pytest.importorskip("pyramid")
+from pyramid.model.events import TextEventList
+
+from udp_events import UDPEventParser
+
+
+def message_chunk(rows: list[tuple[float, str]]) -> TextEventList:
+    return TextEventList(np.array([row[0] for row in rows], dtype=np.float64), np.array([row[1] for row in rows], dtype=np.str_))
+
+
+chunks = [
+    [
+        (-1.0, "UDP Events sync on line 1@10.5=315000"),
+        (10.6, "name=4913,type=unsigned long@10.61=318300"),
+    ],
+    [],
+    [
+        (11.0, "name=matlab,value=rSet('dXtarget',[4],'visible',1.00);draw_flag=1;,type=string@11.02=330600"),
+        (-1.0, "UDP Events sync on line 1@12.75=382500"),
+        (12.8, "UDP Events sync on line 1@12.8=384000"),
+    ],
+]
+
+
+def test_empty_chunk():
+    for streaming in [False, True]:
+        parser = UDPEventParser(streaming=streaming)
+        events = parser.transform(message_chunk([]))
+        assert events.timestamp_data.size == 0
+        assert events.text_data.size == 0
+        assert parser.counts()["events_parsed"] == 0
+
+
+def test_streaming_matches_loop_across_chunks():
+    loop_parser = UDPEventParser()
+    streaming_parser = UDPEventParser(streaming=True)
+    results = []
+    for chunk in chunks:
+        expected = loop_parser.parse_events_loop(message_chunk(chunk))
+        events = streaming_parser.transform(message_chunk(chunk))
+        np.testing.assert_array_equal(events.timestamp_data, expected.timestamp_data)
+        assert events.text_data.tolist() == expected.text_data.tolist()
+        results.append((events, expected))
+
+    # The second negative sync timestamp is keyed relative to the first one, from the chunk before.
+    assert results[2][0].text_data[1] == "name=sync|value=UDP Events sync on line 1@12.75=382500|key=2.25"
+    assert streaming_parser.counts() == loop_parser.counts()
+
+    # Each chunk's events are still intact after parsing the chunks that came after.
+    for events, expected in results:
+        np.testing.assert_array_equal(events.timestamp_data, expected.timestamp_data)
+        assert events.text_data.tolist() == expected.text_data.tolist()
+
+
+def test_streaming_skips_malformed_lines():
+    parser = UDPEventParser(streaming=True)
+    events = parser.transform(message_chunk([(1.0, "no timing info"), (2.0, "name=4913@2.5=75000"), (3.0, "bad@time=1")]))
+    np.testing.assert_array_equal(events.timestamp_data, [2.5])
+    assert events.text_data.tolist() == ["name=4913"]
+    assert parser.counts()["malformed_lines"] == 2
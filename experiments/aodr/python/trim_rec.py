@@ -1,61 +1,136 @@
+import argparse
+import math
+
+import numpy as np
 from pynwb import NWBHDF5IO, NWBFile, TimeSeries
 from pynwb.misc import AnnotationSeries
 from pynwb.ecephys import ElectricalSeries, ElectrodeGroup, Device
-from datetime import datetime
-
-input_path = "/Users/lowell/Library/CloudStorage/Box-Box/GoldLab/Data/Physiology/AODR/dlPFC/MrM/Raw/Neuronal/SingleEL/MrM_2025-09-26_13-28-03/Record Node 107/experiment1.nwb"
-output_path = "/Users/lowell/Library/CloudStorage/Box-Box/GoldLab/Data/Physiology/AODR/dlPFC/MrM/Raw/Neuronal/SingleEL/MrM_2025-09-26-Trimmed/Record Node 107/experiment1.nwb"
-cutoff_time = 5000
-
-with NWBHDF5IO(input_path, 'r') as io:
-    nwb_in = io.read()
-
-    # Create new NWBFile, copying metadata
-    nwb_out = NWBFile(
-        session_description=nwb_in.session_description,
-        identifier=nwb_in.identifier + "_trimmed",
-        session_start_time=nwb_in.session_start_time,
-        experimenter=nwb_in.experimenter,
-        lab=nwb_in.lab,
-        institution=nwb_in.institution,
-        experiment_description=nwb_in.experiment_description,
-        subject=nwb_in.subject,
-    )
+from hdmf.common.table import DynamicTableRegion
+from hdmf.data_utils import GenericDataChunkIterator
+from hdmf.backends.hdf5.h5_utils import H5DataIO
 
-    # Trim and add TTL events
-    ttl = nwb_in.acquisition['Acquisition Board-106.acquisition_board.TTL']
-    mask = ttl.timestamps[:] >= cutoff_time
-    trimmed_ttl = TimeSeries(
-        name=ttl.name,
-        data=ttl.data[mask],
-        timestamps=ttl.timestamps[mask],
-        unit=ttl.unit,
-        description=ttl.description
-    )
-    nwb_out.add_acquisition(trimmed_ttl)
-
-    # Trim and add messages
-    messages = nwb_in.acquisition['messages']
-    mask = messages.timestamps[:] >= cutoff_time
-    trimmed_messages = AnnotationSeries(
-        name=messages.name,
-        data=messages.data[mask],
-        timestamps=messages.timestamps[mask],
-        description=messages.description
+# Usage:
+# Trim an Open Ephys NWB recording to the samples and events between a start and end time (in seconds), like:
+#   python trim_rec.py "Raw/MrM_2025-09-26_13-28-03/Record Node 107/experiment1.nwb" "Raw/MrM_2025-09-26-Trimmed/Record Node 107/experiment1.nwb" --start 5000
+#   python trim_rec.py input.nwb output.nwb --start 5000 --end 9000 --chunk-samples 600000
+#
+# The continuous data is copied a chunk of samples at a time, so this works for multi-hour neuropixel files without loading them into memory.
+# Since timestamps are sorted, the start and end samples are found by binary search, reading only a few dozen timestamps.
+#
+# The continuous data is written in HDF5 chunks of --chunk-rows samples by all channels (or --chunk-channels), so reading a time range
+# for all channels, as spikeinterface does, touches only a few chunks.  By default it's not compressed, like the Open Ephys original,
+# so read_nwb_recording stays as fast as it is on the original.  Lossless compression is opt-in, with the shuffle filter by default,
+# which groups the high and low bytes of the int16 samples:
+#   python trim_rec.py input.nwb output.nwb --start 5000 --compression gzip          # smallest files, about 10x slower reads
+#   python trim_rec.py input.nwb output.nwb --start 5000 --compression lzf           # faster to write than gzip, not as small, h5py only
+#
+# From benchmark_nwb_compression.py with 60s of 32 channel synthetic data (real data will differ, so try it on a real session):
+#   layout              compression ratio   write s   read MB/s, all channels   read MB/s, 4 channels
+#   uncompressed              1.00x           0.5             1177                     214
+#   lzf+shuffle               1.27x           2.1              149                      21
+#   gzip1+shuffle             1.82x           4.2              108                      14
+#   gzip4+shuffle             1.90x           5.0              115                      15
+#   gzip9+shuffle             1.92x           265              143                      18
+# Compression ratio is uncompressed size over compressed size.  Any compression cuts reads about 8-10x, which is still faster than
+# real time for 32 channels at 30kHz, so it can be worth it for trimmed files that mostly get archived or moved around.
+# gzip 9 is barely smaller than gzip 4 and takes forever to write.  For reading a few channels at a time, --chunk-channels 16 doubles read speed.
+
+default_continuous_name = 'Acquisition Board-106.acquisition_board'
+default_ttl_name = 'Acquisition Board-106.acquisition_board.TTL'
+default_messages_name = 'messages'
+default_chunk_rows = 30000
+default_compression = 'none'
+default_compression_level = 4
+default_shuffle = True
+
+
+def find_time_index(timestamps, time, side='left'):
+    # Like np.searchsorted(timestamps, time, side), but reading only log2(n) values from a possibly huge HDF5 dataset.
+    low = 0
+    high = len(timestamps)
+    while low < high:
+        mid = (low + high) // 2
+        if timestamps[mid] < time or (side == 'right' and timestamps[mid] == time):
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+
+def find_time_range(timestamps, start_time=None, end_time=None):
+    # Rows with start_time <= timestamp < end_time, where None means from the start or through the end.
+    start = 0 if start_time is None else find_time_index(timestamps, start_time, 'left')
+    end = len(timestamps) if end_time is None else find_time_index(timestamps, end_time, 'left')
+    return (start, max(start, end))
+
+
+class DatasetSliceIterator(GenericDataChunkIterator):
+    """Write rows start:end of a dataset, a buffer of rows at a time, without reading the rest of the dataset.
+
+    Args:
+        dataset:        An h5py dataset (or anything with shape, dtype, and slicing) to copy rows from
+        start:          First row to copy
+        end:            Row after the last one to copy
+        buffer_rows:    How many rows to read and write at once
+        chunk_rows:     How many rows in each HDF5 chunk of the output (default 1s at 30kHz)
+        chunk_columns:  How many columns (channels) in each HDF5 chunk of the output, or None for all of them
+    """
+
+    def __init__(self, dataset, start: int, end: int, buffer_rows: int = 300000, chunk_rows: int = default_chunk_rows, chunk_columns: int = None, **kwargs):
+        self.dataset = dataset
+        self.start = start
+        self.end = end
+        row_count = end - start
+        if row_count <= 0:
+            raise ValueError(f"No rows to copy from {start}:{end}, GenericDataChunkIterator can't chunk an empty dataset.")
+        # Buffers need to be a whole number of chunks, as GenericDataChunkIterator requires.
+        chunk_rows = min(chunk_rows, row_count)
+        buffer_rows = min(max(buffer_rows // chunk_rows, 1) * chunk_rows, row_count)
+        buffer_shape = (buffer_rows,) + tuple(dataset.shape[1:])
+        chunk_shape = (chunk_rows,) + tuple(dataset.shape[1:])
+        if chunk_columns is not None and len(chunk_shape) > 1:
+            chunk_shape = (chunk_rows, min(chunk_columns, chunk_shape[1])) + chunk_shape[2:]
+        super().__init__(buffer_shape=buffer_shape, chunk_shape=chunk_shape, display_progress=kwargs.pop('display_progress', True), **kwargs)
+
+    def _get_data(self, selection: tuple[slice]) -> np.ndarray:
+        rows = selection[0]
+        return self.dataset[(slice(self.start + rows.start, self.start + rows.stop),) + tuple(selection[1:])]
+
+    def _get_maxshape(self) -> tuple[int]:
+        return (self.end - self.start,) + tuple(self.dataset.shape[1:])
+
+    def _get_dtype(self) -> np.dtype:
+        return self.dataset.dtype
+
+
+def compressed(data, compression: str = None, compression_level: int = None, shuffle: bool = False):
+    """Wrap data for writing with an HDF5 compression filter, or leave it alone if compression is None.
+
+    Args:
+        data:               Data or iterator to write, where an iterator also sets the HDF5 chunk shape
+        compression:        None or "none", "gzip" (smaller, slower), or "lzf" (faster, not as small, and only readable by h5py)
+        compression_level:  For gzip, 0-9, where the default 4 gets most of the size savings for much less time than 9
+        shuffle:            Whether to add the shuffle filter before compression, which helps a lot for int16 samples
+    """
+    if compression is None or compression == "none":
+        return data
+    if compression == "gzip" and compression_level is None:
+        compression_level = default_compression_level
+    return H5DataIO(
+        data=data,
+        compression=compression,
+        compression_opts=compression_level if compression == "gzip" else None,
+        shuffle=shuffle,
     )
-    nwb_out.add_acquisition(trimmed_messages)
 
-    # Trim and add continuous data
-    cont = nwb_in.acquisition['Acquisition Board-106.acquisition_board']
-    mask = cont.timestamps[:] >= cutoff_time
-    
-    channel_conversion = getattr(cont, 'channel_conversion', None)
 
-    if 'sync' in cont.fields:
-        sync_data = cont.fields['sync']
-    else:
-        sync_data = None
+def trim_events(series, start_time, end_time):
+    # TTL and message series are small, but slice them the same way anyway.
+    (start, end) = find_time_range(series.timestamps, start_time, end_time)
+    return (series.data[start:end], series.timestamps[start:end])
+
 
+def copy_electrodes(nwb_in, nwb_out):
     # Copy devices first
     for dev in nwb_in.devices.values():
         new_dev = Device(name=dev.name, description=getattr(dev, 'description', ''))
@@ -88,29 +163,158 @@ with NWBHDF5IO(input_path, 'r') as io:
         electrode_kwargs['group'] = nwb_out.electrode_groups[electrode_kwargs['group_name']]
         nwb_out.add_electrode(**electrode_kwargs)
 
-    # Create the DynamicTableRegion for the new file
-    from hdmf.common.table import DynamicTableRegion
-    electrodes_region = DynamicTableRegion(
-        name='electrodes',
-        data=cont.electrodes.data,
-        description=cont.electrodes.description,
-        table=nwb_out.electrodes
-    )
 
-    trimmed_cont = ElectricalSeries(
-        name=cont.name,
-        data=cont.data[mask],
-        timestamps=cont.timestamps[mask],
-        electrodes=electrodes_region,
-        description=cont.description,
+def trim_recording(
+    input_path,
+    output_path,
+    start_time=None,
+    end_time=None,
+    continuous_name=default_continuous_name,
+    ttl_name=default_ttl_name,
+    messages_name=default_messages_name,
+    chunk_samples=300000,
+    chunk_rows=default_chunk_rows,
+    chunk_channels=None,
+    compression=default_compression,
+    compression_level=default_compression_level,
+    shuffle=default_shuffle
+):
+    """Copy an Open Ephys NWB file, keeping only samples and events with start_time <= timestamp < end_time.
+
+    Args:
+        input_path:         NWB file to read
+        output_path:        NWB file to write
+        start_time:         Keep data at or after this time in seconds, or None to keep from the start
+        end_time:           Keep data before this time in seconds, or None to keep through the end
+        continuous_name:    Name of the continuous ElectricalSeries in the acquisition group
+        ttl_name:           Name of the TTL TimeSeries in the acquisition group
+        messages_name:      Name of the messages AnnotationSeries in the acquisition group
+        chunk_samples:      How many samples of continuous data to copy at a time, which bounds memory use
+        chunk_rows:         How many samples in each HDF5 chunk of the continuous output
+        chunk_channels:     How many channels in each HDF5 chunk of the continuous output, or None for all of them
+        compression:        None, "gzip", or "lzf" compression for the continuous output, see compressed()
+        compression_level:  Level for gzip compression, 0-9
+        shuffle:            Whether to shuffle bytes before compression
+    """
+    with NWBHDF5IO(input_path, 'r') as io:
+        nwb_in = io.read()
+
+        # Create new NWBFile, copying metadata
+        nwb_out = NWBFile(
+            session_description=nwb_in.session_description,
+            identifier=nwb_in.identifier + "_trimmed",
+            session_start_time=nwb_in.session_start_time,
+            experimenter=nwb_in.experimenter,
+            lab=nwb_in.lab,
+            institution=nwb_in.institution,
+            experiment_description=nwb_in.experiment_description,
+            subject=nwb_in.subject,
+        )
+
+        # Trim and add TTL events
+        ttl = nwb_in.acquisition[ttl_name]
+        (ttl_data, ttl_timestamps) = trim_events(ttl, start_time, end_time)
+        trimmed_ttl = TimeSeries(
+            name=ttl.name,
+            data=ttl_data,
+            timestamps=ttl_timestamps,
+            unit=ttl.unit,
+            description=ttl.description
+        )
+        nwb_out.add_acquisition(trimmed_ttl)
+
+        # Trim and add messages
+        messages = nwb_in.acquisition[messages_name]
+        (messages_data, messages_timestamps) = trim_events(messages, start_time, end_time)
+        trimmed_messages = AnnotationSeries(
+            name=messages.name,
+            data=messages_data,
+            timestamps=messages_timestamps,
+            description=messages.description
+        )
+        nwb_out.add_acquisition(trimmed_messages)
+
+        # Find the continuous samples to keep, without reading all the timestamps
+        cont = nwb_in.acquisition[continuous_name]
+        (start, end) = find_time_range(cont.timestamps, start_time, end_time)
+        print(f"Keeping samples {start}:{end} of {len(cont.timestamps)} ({end - start} samples, {math.ceil((end - start) / chunk_samples)} chunks)")
+
+        channel_conversion = getattr(cont, 'channel_conversion', None)
+
+        if 'sync' in cont.fields:
+            sync_data = cont.fields['sync']
+        else:
+            sync_data = None
+
+        copy_electrodes(nwb_in, nwb_out)
+
+        # Create the DynamicTableRegion for the new file
+        electrodes_region = DynamicTableRegion(
+            name='electrodes',
+            data=cont.electrodes.data,
+            description=cont.electrodes.description,
+            table=nwb_out.electrodes
+        )
+
+        if end > start:
+            trimmed_data = compressed(DatasetSliceIterator(cont.data, start, end, chunk_samples, chunk_rows, chunk_channels), compression, compression_level, shuffle)
+            trimmed_timestamps = compressed(DatasetSliceIterator(cont.timestamps, start, end, chunk_samples, chunk_rows, display_progress=False), compression, compression_level)
+            trimmed_sync = DatasetSliceIterator(sync_data, start, end, chunk_samples, chunk_rows, display_progress=False) if sync_data is not None else None
+        else:
+            # Nothing to stream, so write empty datasets, like slice_nwb.py does for empty windows.
+            print(f"No continuous samples between {start_time} and {end_time}, writing an empty {cont.name}")
+            trimmed_data = cont.data[start:end]
+            trimmed_timestamps = cont.timestamps[start:end]
+            trimmed_sync = sync_data[start:end] if sync_data is not None else None
+
+        trimmed_cont = ElectricalSeries(
+            name=cont.name,
+            data=trimmed_data,
+            timestamps=trimmed_timestamps,
+            electrodes=electrodes_region,
+            description=cont.description,
+        )
+        trimmed_cont.channel_conversion = channel_conversion
+        trimmed_cont.sync = trimmed_sync  # None if the input has no sync
+        nwb_out.add_acquisition(trimmed_cont)
+
+        # Save the new NWB file, reading and writing the continuous data a chunk at a time
+        with NWBHDF5IO(output_path, 'w') as out_io:
+            out_io.write(nwb_out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Trim an Open Ephys NWB recording to a time range, streaming the continuous data in chunks.")
+    parser.add_argument("input", help="NWB file to read")
+    parser.add_argument("output", help="NWB file to write")
+    parser.add_argument("--start", type=float, default=None, help="keep data at or after this time in seconds (default: from the start)")
+    parser.add_argument("--end", type=float, default=None, help="keep data before this time in seconds (default: through the end)")
+    parser.add_argument("--chunk-samples", type=int, default=300000, help="samples of continuous data to copy at a time (default 300000, 10s at 30kHz)")
+    parser.add_argument("--chunk-rows", type=int, default=default_chunk_rows, help=f"samples per HDF5 chunk of continuous output (default {default_chunk_rows})")
+    parser.add_argument("--chunk-channels", type=int, default=None, help="channels per HDF5 chunk of continuous output (default all)")
+    parser.add_argument("--compression", choices=["none", "gzip", "lzf"], default=default_compression, help=f"lossless compression for continuous output (default {default_compression})")
+    parser.add_argument("--compression-level", type=int, default=default_compression_level, help=f"gzip level 0-9 (default {default_compression_level})")
+    parser.add_argument("--shuffle", action=argparse.BooleanOptionalAction, default=default_shuffle, help="shuffle bytes before compression, good for int16 samples")
+    parser.add_argument("--continuous", default=default_continuous_name, help="name of the continuous ElectricalSeries")
+    parser.add_argument("--ttl", default=default_ttl_name, help="name of the TTL TimeSeries")
+    parser.add_argument("--messages", default=default_messages_name, help="name of the messages AnnotationSeries")
+    cli_args = parser.parse_args(argv)
+    trim_recording(
+        cli_args.input,
+        cli_args.output,
+        start_time=cli_args.start,
+        end_time=cli_args.end,
+        continuous_name=cli_args.continuous,
+        ttl_name=cli_args.ttl,
+        messages_name=cli_args.messages,
+        chunk_samples=cli_args.chunk_samples,
+        chunk_rows=cli_args.chunk_rows,
+        chunk_channels=cli_args.chunk_channels,
+        compression=cli_args.compression,
+        compression_level=cli_args.compression_level,
+        shuffle=cli_args.shuffle
     )
-    trimmed_cont.channel_conversion = channel_conversion
-    if sync_data is not None:
-        trimmed_cont.sync = sync_data[mask]  # If sync is an array and needs trimming
-    else:
-        trimmed_cont.sync = None
-    nwb_out.add_acquisition(trimmed_cont)
-
-    # Save the new NWB file
-    with NWBHDF5IO(output_path, 'w') as out_io:
-        out_io.write(nwb_out)
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ from pyramid.model.model import BufferData
 from pyramid.model.events import TextEventList
 from pyramid.neutral_zone.transformers.transformers import Transformer
 
+from message_index import partition_strings
+
 
 class UDPEventParser(Transformer):
     """Parse timestamp info that our Open Ephys UDPEvents plugin appended to text messsages.
@@ -22,21 +24,142 @@ class UDPEventParser(Transformer):
         - name=4930,type=unsigned long@842.369=4212738
 
     This parses out the @timestamps and updates each event's timestamp with the parsed value.
+
+    With streaming=True this expects to see the session's messages a chunk at a time, as Pyramid reads them.
+    Malformed lines are logged, counted, and dropped, instead of raising an error partway through a session.
+    Pyramid doesn't tell transformers when a session ends, so each warning also logs the running counts(),
+    and the last one has the session totals.  Each chunk gets its own new arrays, so Pyramid can hold on to them.
+
+    Either way, the sync offset from the first negative timestamp carries over across chunks, and counters
+    of what was parsed so far are available from counts().
+
+    Args:
+        timestamp_delimiter:        Delimiter between the message text and timing info (default "@").
+        sample_number_delimiter:    Delimiter between the timestamp and sample number (default "=").
+        streaming:                  Whether to drop malformed lines, as above (default False).
     """
 
     def __init__(
         self,
         timestamp_delimiter: str = "@",
         sample_number_delimiter: str = "=",
+        streaming: bool = False,
         **kwargs
     ) -> None:
         self.timestamp_delimiter = timestamp_delimiter
         self.sample_number_delimiter = sample_number_delimiter
         self.first_timestamp_rec = None
         self.first_timestamp_offset = None
+
+        self.streaming = streaming
+
+        self.events_parsed = 0
+        self.sync_events = 0
+        self.negative_timestamp_fallbacks = 0
+        self.malformed_lines = 0
         return None
 
+    def counts(self) -> dict[str, int]:
+        return {
+            "events_parsed": self.events_parsed,
+            "sync_events": self.sync_events,
+            "negative_timestamp_fallbacks": self.negative_timestamp_fallbacks,
+            "malformed_lines": self.malformed_lines,
+        }
+
+    def split_events(self, events: TextEventList) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # Split up all the raw text around delimiters at once, like this:
+        # <raw_message>@<messge_timestamp>=<sample_number>
+        raw_text = np.asarray(events.text_data, dtype=np.str_)
+        (message, found_timestamp, timing_info) = partition_strings(raw_text, self.timestamp_delimiter)
+        (messge_timestamp, found_sample_number, _) = partition_strings(timing_info, self.sample_number_delimiter)
+        is_valid = (found_timestamp != "") & (found_sample_number != "")
+        return (raw_text, message, messge_timestamp, is_valid)
+
+    def sync_text(self, raw_text: str, raw_timestamp: float, messge_timestamp: float) -> str:
+        # Same as in parse_events_loop(), below, for one sync event at a time.
+        self.sync_events += 1
+        if raw_timestamp<0:
+            logging.info(f"Raw timestamp is negative: {raw_timestamp}. Using message client timestamp instead: {messge_timestamp}")
+            self.negative_timestamp_fallbacks += 1
+            if self.first_timestamp_rec is None:
+                self.first_timestamp_rec = True
+                self.first_timestamp_offset = messge_timestamp
+            return f"name=sync|value={raw_text}|key={str(messge_timestamp - self.first_timestamp_offset)}"
+        else:
+            return f"name=sync|value={raw_text}|key={raw_timestamp}"
+
     def parse_events(self, events: TextEventList) -> TextEventList:
+        # Parse all the events at once with numpy string operations.
+        # Rows that don't split cleanly around the delimiters fall back to the one-by-one loop below.
+        if len(events.text_data) == 0:
+            return self.parse_events_loop(events)
+        (raw_text, message, messge_timestamp, is_valid) = self.split_events(events)
+        if not np.all(is_valid):
+            return self.parse_events_loop(events)
+        try:
+            # Converting via a list of str is faster than astype() on a numpy str array.
+            timestamp_data = np.array(messge_timestamp.tolist(), dtype=np.float64)
+        except ValueError:
+            return self.parse_events_loop(events)
+        self.events_parsed += timestamp_data.size
+
+        # Sync events are a special case, as below, but there are only a few of them.
+        is_sync = np.char.startswith(message, "UDP Events sync")
+        if not np.any(is_sync):
+            return TextEventList(timestamp_data, message)
+
+        raw_timestamps = np.asarray(events.timestamp_data)
+        sync_text = [
+            self.sync_text(raw_text[index], raw_timestamps[index], float(timestamp_data[index]))
+            for index in np.flatnonzero(is_sync)
+        ]
+
+        # Widen the message strings as needed to fit the sync text.
+        text_data = message.astype(np.dtype((np.str_, max(message.dtype.itemsize // 4, max(len(text) for text in sync_text)))))
+        text_data[is_sync] = sync_text
+        return TextEventList(timestamp_data, text_data)
+
+    def parse_events_streaming(self, events: TextEventList) -> TextEventList:
+        # Like parse_events(), but dropping malformed lines.
+        if len(events.text_data) == 0:
+            return TextEventList(np.empty(0, dtype=np.float64), np.empty(0, dtype=np.str_))
+        (raw_text, message, messge_timestamp, is_valid) = self.split_events(events)
+        timestamp_data = np.full(raw_text.size, np.nan)
+        try:
+            timestamp_data[is_valid] = np.array(messge_timestamp[is_valid].tolist(), dtype=np.float64)
+        except ValueError:
+            for index in np.flatnonzero(is_valid):
+                try:
+                    timestamp_data[index] = float(messge_timestamp[index])
+                except ValueError:
+                    is_valid[index] = False
+
+        valid_count = int(np.count_nonzero(is_valid))
+        if valid_count < raw_text.size:
+            for line in raw_text[~is_valid]:
+                logging.warning(f"UDPEventParser skipping malformed line: {line}")
+            self.malformed_lines += raw_text.size - valid_count
+        self.events_parsed += valid_count
+
+        is_sync = np.char.startswith(message, "UDP Events sync") & is_valid
+        raw_timestamps = np.asarray(events.timestamp_data)
+        sync_text = [
+            self.sync_text(raw_text[index], raw_timestamps[index], float(timestamp_data[index]))
+            for index in np.flatnonzero(is_sync)
+        ]
+        if valid_count < raw_text.size:
+            logging.warning(f"UDPEventParser counts so far: {self.counts()}")
+
+        # Widen the message strings as needed to fit the sync text.
+        timestamp_out = timestamp_data[is_valid]
+        text_out = message[is_valid]
+        if sync_text:
+            text_out = text_out.astype(np.dtype((np.str_, max(message.dtype.itemsize // 4, max(len(text) for text in sync_text)))))
+            text_out[is_sync[is_valid]] = sync_text
+        return TextEventList(timestamp_out, text_out)
+
+    def parse_events_loop(self, events: TextEventList) -> TextEventList:
         # Parse incoming events to choose a new timestamp and text messages for each.
         timestamp_data = []
         text_data = []
@@ -48,6 +171,7 @@ class UDPEventParser(Transformer):
 
             # New events will take their timestamps from parsed input text.
             timestamp_data.append(float(messge_timestamp))
+            self.events_parsed += 1
 
             if message.startswith("UDP Events sync"):
                 # Sync events are a special case.
@@ -55,8 +179,10 @@ class UDPEventParser(Transformer):
                 # to make it easier to pair up sync events from different readers.
                 # Choose a format with key=value pairs separated by pipes |
                 # This just makes it easier for downstram code to read sync events along with other events from Rex.
+                self.sync_events += 1
                 if raw_timestamp<0:
                     logging.info(f"Raw timestamp is negative: {raw_timestamp}. Using message client timestamp instead: {messge_timestamp}")
+                    self.negative_timestamp_fallbacks += 1
                     if self.first_timestamp_rec is None:
                         self.first_timestamp_rec = True
                         self.first_timestamp_offset = float(messge_timestamp) # offset based on the first client timestamp for simplicity
@@ -74,6 +200,8 @@ class UDPEventParser(Transformer):
 
     def transform(self, data: BufferData):
         if isinstance(data, TextEventList):
+            if self.streaming:
+                return self.parse_events_streaming(data)
             return self.parse_events(data)
         else:
             logging.warning(f"UDPEventsMessageTimes doesn't know how to apply to {data.__class__.__name__}")
@@ -0,0 +1,122 @@
+# THE ORIGINAL, MAIN VERSION OF THIS FILE IS LOCATED IN THE AODR EXPERIMENT FOLDER. THIS IS A COPY FOR TESTING AND DEVELOPMENT PURPOSES.
+import csv
+
+import numpy as np
+
+# Decode and classify Open Ephys text messages once, so plots can pick out the ones in view with a searchsorted.
+#
+# Our messages come from the UDPEvents plugin (see udp_events.py) with @timestamp=sample_number appended, like:
+#   UDP Events sync on line 1@0.251607=79808
+#   name=4913,type=unsigned long@842.369=4212738
+#
+# Messages go into categories:
+#   - "udp_sync" for UDP Events sync messages
+#   - one category per ecode in an ecode rules CSV, like "fix_acq" for name=4913, from AODR_ecode_rules.csv
+#
+#   index = MessageIndex(timestamps, texts, "../ecodes/AODR_ecode_rules.csv")
+#   rows = index.window("fix_acq", t_start, t_end)
+#   ax.vlines(index.timestamps[rows], 0, 1)
+
+
+def partition_strings(text: np.ndarray, separator: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Split each string in an array around the first separator, like str.partition(), giving before, separator, and after."""
+    if text.size == 0:
+        # np.strings.partition raises on empty arrays, at least in numpy 2.4.
+        empty = np.asarray(text, dtype=np.str_)
+        return (empty, empty.copy(), empty.copy())
+    if hasattr(np, "strings") and hasattr(np.strings, "partition"):
+        # numpy 2.2+ does this with fast string ufuncs.
+        return np.strings.partition(text, separator)
+    parts = np.char.partition(text, separator)
+    return (parts[..., 0], parts[..., 1], parts[..., 2])
+
+
+def decode_strings(values) -> np.ndarray:
+    # Bytes or objects from h5py, or str already, to a numpy str array.
+    values = np.asarray(values)
+    if values.dtype.kind == "O":
+        values = values.astype(bytes) if values.size and isinstance(values.flat[0], bytes) else values.astype(str)
+    if values.dtype.kind == "S":
+        values = np.char.decode(values, "utf-8", errors="replace")
+    return values.astype(str)
+
+
+def parse_floats(text: np.ndarray) -> np.ndarray:
+    # Strings to floats, with nan for empty or malformed ones.
+    values = np.full(text.shape, np.nan)
+    present = text != ""
+    try:
+        values[present] = text[present].astype(np.float64)
+    except ValueError:
+        for index in np.flatnonzero(present):
+            try:
+                values[index] = float(text[index])
+            except ValueError:
+                pass
+    return values
+
+
+def read_ecode_names(ecode_rules_csv: str) -> dict[str, str]:
+    # Ecode value to name, like {"4913": "fix_acq"}, from a Pyramid ecode rules CSV with value and name columns.
+    with open(ecode_rules_csv, newline="") as f:
+        return {row["value"].strip(): row["name"].strip() for row in csv.DictReader(f) if row.get("value") and row.get("name")}
+
+
+class MessageIndex:
+    """Open Ephys text messages decoded and classified once, sorted by time.
+
+    Args:
+        timestamps:         Message times
+        texts:              Message text, as bytes, objects, or str, like recording.nwb['acquisition']['messages']['data'][:]
+        ecode_rules_csv:    Optional Pyramid ecode rules CSV, for a category per ecode name
+    """
+
+    def __init__(self, timestamps, texts, ecode_rules_csv: str = None):
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        order = np.argsort(timestamps, kind="stable")
+        self.timestamps = timestamps[order]
+        self.text = decode_strings(texts)[order]
+        ecode_names = {} if ecode_rules_csv is None else read_ecode_names(ecode_rules_csv)
+
+        if self.timestamps.size == 0:
+            # No messages, like a session without a messages dataset: every category is empty.
+            self.at_times = np.empty(0)
+            self.equals_values = np.empty(0)
+            self.ecode = np.empty(0, dtype=np.str_)
+            self.categories = {name: np.empty(0, dtype=int) for name in ["udp_sync"] + list(ecode_names.values())}
+            return
+
+        # Parts appended by UDPEvents: message@timestamp=sample_number
+        (body, _, appended) = partition_strings(self.text, "@")
+        (at_text, _, equals_text) = partition_strings(appended, "=")
+        self.at_times = parse_floats(at_text)
+        # The first word after "=", in case anything follows it.
+        self.equals_values = parse_floats(partition_strings(np.char.strip(equals_text), " ")[0])
+
+        # Ecode from "name=value," or "name=value|" in the message body.
+        (_, name_key, name_text) = partition_strings(body, "name=")
+        name_value = partition_strings(partition_strings(name_text, ",")[0], "|")[0]
+        self.ecode = np.where(name_key != "", name_value, "")
+
+        self.categories = {"udp_sync": np.flatnonzero(np.char.find(body, "UDP Events sync") >= 0)}
+        for value, name in ecode_names.items():
+            self.categories[name] = np.flatnonzero(self.ecode == value)
+
+    def __len__(self):
+        return self.timestamps.size
+
+    def rows(self, category: str) -> np.ndarray:
+        """All rows in a category, or all rows for category None."""
+        if category is None:
+            return np.arange(self.timestamps.size)
+        return self.categories.get(category, np.empty(0, dtype=int))
+
+    def window(self, category: str, t_start: float, t_end: float) -> np.ndarray:
+        """Rows in a category with t_start <= timestamp < t_end."""
+        rows = self.rows(category)
+        times = self.timestamps[rows]
+        return rows[np.searchsorted(times, t_start, side="left"):np.searchsorted(times, t_end, side="left")]
+
+    def at_offsets(self, rows: np.ndarray) -> np.ndarray:
+        """Message timestamp minus the @timestamp in the text, nan where there isn't one."""
+        return self.timestamps[rows] - self.at_times[rows]